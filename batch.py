@@ -0,0 +1,46 @@
+import asyncio
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+from src.batch import (
+    BatchRunner,
+    export_parquet,
+)
+from src.pipeline import Pipeline
+from src.utils import _load_configs
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description = "Analyze financial statements of many companies without the UI.",
+    )
+    parser.add_argument(
+        "source",
+        help = "Directory with PDF files or CSV manifest with `path` and `company_name` columns.",
+    )
+    parser.add_argument(
+        "--output",
+        default = "outputs/results.jsonl",
+        help = "JSONL file the results are appended to; finished companies are skipped on rerun.",
+    )
+    parser.add_argument(
+        "--parquet",
+        default = None,
+        help = "Optional Parquet file to export the results to once the batch finishes.",
+    )
+    args = parser.parse_args()
+
+    load_dotenv(override = True)
+
+    config = _load_configs('config')
+
+    runner = BatchRunner(
+        Pipeline.from_config(config),
+        config.get('batch'),
+    )
+
+    stats = asyncio.run(runner.run(args.source, args.output))
+    print(stats)
+
+    if args.parquet:
+        export_parquet(Path(args.output), Path(args.parquet))
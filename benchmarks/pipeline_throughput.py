@@ -0,0 +1,272 @@
+"""
+End-to-end benchmark of the pipeline (OCR, web scraping and financial analysis)
+against the local stand-ins of S3, Textract, Bedrock and Tavily in `benchmarks.stand_ins`:
+p50/p95/p99 latency of an analysis of one company (the eight TWSA statements
+in `.pdf_examples`), throughput and peak RSS per concurrency level. Every level runs
+in its own process, so that its peak RSS is not inflated by the previous levels.
+
+    python -m benchmarks.pipeline_throughput
+    python -m benchmarks.pipeline_throughput --levels 1,16,256 --time-scale 0.02
+    python -m benchmarks.pipeline_throughput --latency bedrock=8:0.6 --throttle bedrock=0.1
+    python -m benchmarks.pipeline_throughput --output base.json
+    python -m benchmarks.pipeline_throughput --baseline base.json --tolerance 0.2
+
+Latencies are those of `benchmarks.stand_ins.DEFAULT_PROFILES` multiplied by
+--time-scale (Textract polling intervals included). The process-wide rate limits of
+`config/rate_limits.yaml` are only applied with --rate-limits.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import statistics
+import subprocess
+from pathlib import Path
+
+from src.batch import LocalFile
+from src.clients import CLIENTS
+from src.pipeline import Pipeline
+from src.utils import _load_configs
+
+from benchmarks.stand_ins import StandIns
+
+PDF_DIR = Path('.pdf_examples')
+
+# Offline credentials and resource names, so that nothing can reach AWS or Tavily
+OFFLINE_ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_REGION': 'eu-central-1',
+    'S3_BUCKET_NAME': 'benchmark',
+    'TEXTRACT_ADAPTER_BALANCE_SHEET_ID': 'benchmark-bs01',
+    'TEXTRACT_ADAPTER_PROFIT_LOSS_ID': 'benchmark-pl01',
+    'TAVILY_API_KEY': 'benchmark',
+}
+
+
+def parse_profiles(
+        latency: list,
+        throttle: list,
+) -> dict:
+    """Parses `service=median:sigma` and `service=p` options into service profiles."""
+    profiles = {}
+    for values, keys in ((latency, ('median', 'sigma')), (throttle, ('throttle',))):
+        for value in values:
+            service, numbers = value.split('=')
+            profiles.setdefault(service, {}).update(
+                zip(keys, (float(number) for number in numbers.split(':')))
+            )
+    return profiles
+
+
+def company_files(
+        index: int,
+        unique: bool,
+) -> list:
+    """
+    Returns the TWSA statements as the uploaded files of company `twsa<index>`,
+    made unique by a trailing PDF comment so that their uploads are not deduplicated.
+    """
+    files = []
+    for path in sorted(PDF_DIR.glob('twsa_*.pdf')):
+        file = LocalFile(path)
+        file.name = path.name.replace('twsa_', f"twsa{index:04d}_", 1)
+        if unique:
+            file.seek(0, os.SEEK_END)
+            file.write(f"\n% benchmark {index}\n".encode('ascii'))
+            file.seek(0)
+        files.append(file)
+    return files
+
+
+def build_pipeline(
+        args: argparse.Namespace,
+        stand_ins: StandIns,
+) -> Pipeline:
+    """Builds the pipeline from the app configuration with its calls served by the stand-ins."""
+    os.environ.update(OFFLINE_ENVIRONMENT)
+
+    config = _load_configs('config')
+    config['cache'] = {}
+    config['store'] = {'enabled': False}
+    config['tracing'] = {'enabled': False}
+    config['scraper'] = {** config['scraper'], 'url': stand_ins.start_tavily()}
+    if not args.rate_limits:
+        config['rate_limits'] = {}
+
+    completion = config['aws']['textract']['completion']
+    completion['mode'] = 'adaptive'
+    completion['adaptive'] = {
+        ** completion['adaptive'],
+        'initial_interval': completion['adaptive']['initial_interval'] * args.time_scale,
+        'max_interval': completion['adaptive']['max_interval'] * args.time_scale,
+    }
+
+    pipeline = Pipeline.from_config(config)
+    stand_ins.install({
+        service: CLIENTS.get(service)
+        for service in ('s3', 'textract', 'bedrock-runtime')
+    })
+
+    return pipeline
+
+
+async def run_level(
+        pipeline: Pipeline,
+        concurrency: int,
+        requests: int,
+        unique: bool,
+) -> dict:
+    """Runs `requests` company analyses, `concurrency` of them at a time."""
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def _request(index):
+        files = company_files(index, unique)
+        async with limit:
+            start = time.perf_counter()
+            results = await pipeline.run(files)
+            latencies.append(time.perf_counter() - start)
+        return any('error' in result for result in results.values())
+
+    start = time.perf_counter()
+    errors = sum(await asyncio.gather(*(_request(index) for index in range(requests))))
+    wall_time = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n = 100, method = 'inclusive')
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'p50': percentiles[49],
+        'p95': percentiles[94],
+        'p99': percentiles[98],
+        'throughput': requests / wall_time,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_worker(
+        args: argparse.Namespace,
+) -> dict:
+    """Runs one concurrency level in this process."""
+    stand_ins = StandIns(
+        profiles = parse_profiles(args.latency, args.throttle),
+        time_scale = args.time_scale,
+        fixtures = (
+            json.loads(Path(args.fixtures).read_text(encoding = 'utf-8'))
+            if args.fixtures else None
+        ),
+        seed = args.seed,
+    )
+    pipeline = build_pipeline(args, stand_ins)
+    requests = args.requests or max(16, 2 * args.concurrency)
+
+    try:
+        result = asyncio.run(run_level(pipeline, args.concurrency, requests, not args.same_files))
+    finally:
+        stand_ins.stop()
+
+    result['calls'] = stand_ins.calls
+    result['throttled'] = stand_ins.throttled
+
+    return result
+
+
+def compare(
+        results: list,
+        baseline: list,
+        tolerance: float,
+) -> list:
+    """Returns the regressions of the p95 latency and the throughput against a baseline."""
+    regressions = []
+    baseline = {result['concurrency']: result for result in baseline}
+    for result in results:
+        base = baseline.get(result['concurrency'])
+        if base is None:
+            continue
+        if result['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append(
+                f"concurrency {result['concurrency']}: p95 {result['p95']:.3f} s "
+                f"> {base['p95']:.3f} s"
+            )
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(
+                f"concurrency {result['concurrency']}: throughput {result['throughput']:.2f}/s "
+                f"< {base['throughput']:.2f}/s"
+            )
+    return regressions
+
+
+def main(
+        args: argparse.Namespace,
+) -> int:
+    """Runs every concurrency level in a subprocess and reports the results."""
+    results = []
+    for concurrency in (int(level) for level in args.levels.split(',')):
+        command = [
+            sys.executable, '-m', 'benchmarks.pipeline_throughput',
+            * sys.argv[1:], '--worker', '--concurrency', str(concurrency),
+        ]
+        output = subprocess.run(command, check = True, stdout = subprocess.PIPE, text = True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+        result = results[-1]
+        print(
+            f"concurrency {result['concurrency']:>4}: {result['requests']:>4} requests "
+            f"({result['errors']} failed), "
+            f"p50 {result['p50']:.3f} s, p95 {result['p95']:.3f} s, p99 {result['p99']:.3f} s, "
+            f"{result['throughput']:.2f} companies/s, peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent = 2), encoding = 'utf-8')
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding = 'utf-8'))
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--levels", default = "1,4,16,64,256",
+                        help = "Comma-separated numbers of concurrent company analyses.")
+    parser.add_argument("--requests", type = int, default = 0,
+                        help = "Company analyses per level (default: max(16, 2 x concurrency)).")
+    parser.add_argument("--time-scale", type = float, default = 0.05,
+                        help = "Multiplier of all simulated latencies.")
+    parser.add_argument("--latency", action = "append", default = [],
+                        help = "Latency of a service as service=median:sigma (seconds).")
+    parser.add_argument("--throttle", action = "append", default = [],
+                        help = "Throttling probability of a service as service=p.")
+    parser.add_argument("--fixtures", help = "JSON file with recorded responses.")
+    parser.add_argument("--rate-limits", action = "store_true",
+                        help = "Apply the rate limits of config/rate_limits.yaml.")
+    parser.add_argument("--same-files", action = "store_true",
+                        help = "Upload identical files, deduplicated after the first one.")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "Write the results to a JSON file.")
+    parser.add_argument("--baseline", help = "Fail on regressions against a results JSON file.")
+    parser.add_argument("--tolerance", type = float, default = 0.2,
+                        help = "Allowed relative regression against the baseline.")
+    parser.add_argument("--worker", action = "store_true", help = argparse.SUPPRESS)
+    parser.add_argument("--concurrency", type = int, default = 1, help = argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.worker:
+        logging.getLogger().setLevel(logging.ERROR)
+        print(json.dumps(run_worker(arguments)))
+        sys.exit(0)
+
+    sys.exit(main(arguments))
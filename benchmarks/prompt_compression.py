@@ -0,0 +1,127 @@
+"""
+Benchmark of the scrape compression stage: prompt tokens and, with --live,
+Bedrock summarisation latency per call with and without compression.
+
+    python -m benchmarks.prompt_compression
+    python -m benchmarks.prompt_compression --live --repeats 3
+"""
+import time
+import random
+import argparse
+import statistics
+from dotenv import load_dotenv
+
+from src.compress import ScrapeCompressor, estimate_tokens
+from src.utils import _load_configs
+
+WORDS = (
+    "spolecnost vyroba obchod sluzby logistika stavebnictvi energie trzby zisk "
+    "zamestnanci investice export zakaznici dodavatele kapital aktiva rust trh "
+    "region praha brno ostrava smlouva projekt technologie vyzkum kvalita"
+).split()
+
+
+def synthetic_response(
+        company_name: str,
+        n_results: int = 100,
+        duplicate_ratio: float = 0.3,
+        seed: int = 0,
+) -> dict:
+    """
+    Builds a Tavily-like search response with a share of near-duplicate snippets,
+    as returned for syndicated news and company register mirrors.
+    """
+    rng = random.Random(seed)
+    results = []
+    for i in range(n_results):
+        if results and rng.random() < duplicate_ratio:
+            content = rng.choice(results)['content'] + " " + rng.choice(WORDS)
+        else:
+            content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(60, 160)))
+        results.append({
+            'title': f"{company_name} - {' '.join(rng.choice(WORDS) for _ in range(5))}",
+            'url': f"https://example{i}.cz/{company_name.lower()}/{i}",
+            'content': content,
+            'score': rng.random(),
+            'raw_content': None,
+        })
+
+    return {
+        'query': f"{company_name} czech republic",
+        'follow_up_questions': None,
+        'answer': None,
+        'images': [],
+        'results': results,
+        'response_time': 1.5,
+    }
+
+
+def bench_offline(
+        compressor: ScrapeCompressor,
+        response: dict,
+        repeats: int,
+):
+    """Reports the token reduction and the overhead of the compression stage."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _, stats = compressor.compress(response)
+        timings.append(time.perf_counter() - start)
+
+    print(
+        f"results {stats['results_in']} -> {stats['results_out']} "
+        f"({stats['duplicates']} duplicates)\n"
+        f"tokens  {stats['tokens_before']} -> {stats['tokens_after']} "
+        f"(saved {stats['tokens_saved']}, "
+        f"{100 * stats['tokens_saved'] / stats['tokens_before']:.1f}%)\n"
+        f"compression time median {1000 * statistics.median(timings):.1f} ms"
+    )
+
+
+def bench_live(
+        config: dict,
+        response: dict,
+        repeats: int,
+):
+    """Reports the Bedrock summarisation latency per call with and without compression."""
+    # pylint: disable=import-outside-toplevel,protected-access
+    from src.llm import LLMScraper
+
+    for label, compression in (
+        ('raw', None),
+        ('compressed', config['scraper'].get('compression')),
+    ):
+        scraper = LLMScraper(
+            {** config['scraper'], 'compression': compression},
+            config['llm']['web_scraping'],
+        )
+        payload = scraper._format_payload('TWSA', response)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            scraper.invoke(payload)
+            timings.append(time.perf_counter() - start)
+        print(
+            f"{label:>10}: ~{estimate_tokens(str(payload))} input tokens, "
+            f"median latency {statistics.median(timings):.2f} s"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--results", type = int, default = 100)
+    parser.add_argument("--repeats", type = int, default = 20)
+    parser.add_argument("--live", action = "store_true", help = "Call Bedrock (needs .env).")
+    args = parser.parse_args()
+
+    configs = _load_configs('config')
+    compression_config = dict(configs['scraper']['compression'])
+    compression_config.pop('enabled', None)
+
+    scrape_response = synthetic_response('TWSA', args.results)
+    bench_offline(ScrapeCompressor(** compression_config), scrape_response, args.repeats)
+
+    if args.live:
+        load_dotenv(override = True)
+        bench_live(configs, scrape_response, args.repeats)
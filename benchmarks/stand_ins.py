@@ -0,0 +1,328 @@
+"""
+Local stand-ins of S3, Textract, Bedrock and Tavily for offline benchmarks.
+
+AWS calls go through the real boto3 clients (serialisation, response parsing and
+botocore retries included) and are answered by a `before-send` hook instead of the
+network. Tavily is served by a local HTTP server. Every call sleeps for a latency
+drawn from a log-normal distribution per service and is throttled with a given
+probability. Textract jobs stay IN_PROGRESS for a drawn job duration, so the
+completion strategy polls them as it would in production.
+
+Replies replay the fixtures below for the TWSA statements in `.pdf_examples`
+(Textract answers by query alias, a Tavily search response, Bedrock summaries and
+analyses), or recorded responses loaded from a JSON file with the same keys.
+"""
+import json
+import math
+import time
+import uuid
+import random
+import threading
+from urllib.parse import urlsplit, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.awsrequest import AWSResponse
+
+from benchmarks.prompt_compression import synthetic_response
+
+# Textract answers of the TWSA balance sheets and profit and loss statements by alias,
+# chosen so that the fast-path rules leave the company to the financial analysis LLM
+TEXTRACT_ANSWERS = {
+    'ASSETS_TOTAL': "152 340",
+    'FIXED_ASSETS': "61 020",
+    'CURRENT_ASSETS': "90 115",
+    'INVENTORIES': "21 400",
+    'RECEIVABLES': "48 730",
+    'CASH_AND_CASH_EQUIVALENTS': "19 985",
+    'EQUITY': "53 880",
+    'REGISTERED_CAPITAL': "2 000",
+    'RETAINED_EARNINGS_PREVIOUS_YEARS': "38 410",
+    'PROFIT_LOSS_CURRENT_PERIOD': "6 470",
+    'LIABILITIES': "96 950",
+    'PROVISIONS': "3 100",
+    'PAYABLES': "60 020",
+    'OPERATING_PROFIT': "8 950",
+    'PROFIT_BEFORE_TAXES': "7 990",
+    'PROFIT_AFTER_TAXES': "6 470",
+    'NET_TURNOVER': "211 560",
+}
+
+BEDROCK_SUMMARY = (
+    "TWSA is a Czech manufacturing company with a stable customer base, "
+    "no reported insolvency proceedings and a growing export share."
+)
+
+BEDROCK_ANALYSIS = {
+    'financial_analysis': (
+        "The company is **LIQUID** (current ratio 1.50), profitable (net margin 3.1 %) "
+        "and moderately leveraged (debt ratio 0.64)."
+    ),
+    'recommendations': "Business with this company is **RECOMMENDED**.",
+}
+
+# Log-normal latency (median and sigma, in seconds) and throttling probability per service;
+# `textract_job` is the duration of a Textract job between its start and its completion.
+# Throttling is off by default: the retry delays of botocore and `exponential_backoff`
+# are not scaled with the latencies and would dominate the variance of the results.
+DEFAULT_PROFILES = {
+    's3': {'median': 0.08, 'sigma': 0.5, 'throttle': 0.0},
+    'textract': {'median': 0.12, 'sigma': 0.4, 'throttle': 0.0},
+    'textract_job': {'median': 8.0, 'sigma': 0.4, 'throttle': 0.0},
+    'bedrock': {'median': 6.0, 'sigma': 0.5, 'throttle': 0.0},
+    'tavily': {'median': 1.5, 'sigma': 0.5, 'throttle': 0.0},
+}
+
+SERVICE_PROFILES = {
+    's3': 's3',
+    'textract': 'textract',
+    'bedrock-runtime': 'bedrock',
+}
+
+
+class _Raw:  # pylint: disable=too-few-public-methods
+    """A minimal raw HTTP body, as read by botocore from `AWSResponse.raw`."""
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **_):
+        """Yields the body."""
+        yield self.body
+
+
+class StandIns:  # pylint: disable=too-many-instance-attributes
+    """
+    Answers S3, Textract and Bedrock requests of boto3 clients and Tavily requests
+    of a local HTTP server with fixtures, simulated latencies and throttling.
+    """
+
+    def __init__(
+            self,
+            profiles: dict = None,
+            time_scale: float = 1.0,
+            fixtures: dict = None,
+            seed: int = 0,
+    ):
+        self.profiles = {
+            service: {** profile, ** (profiles or {}).get(service, {})}
+            for service, profile in DEFAULT_PROFILES.items()
+        }
+        self.time_scale = time_scale
+        self.fixtures = {
+            'textract': TEXTRACT_ANSWERS,
+            'tavily': synthetic_response('TWSA'),
+            'bedrock_summary': BEDROCK_SUMMARY,
+            'bedrock_analysis': BEDROCK_ANALYSIS,
+            ** (fixtures or {}),
+        }
+        self.calls = {}
+        self.throttled = {}
+
+        self._tavily_body = json.dumps(self.fixtures['tavily']).encode('utf-8')
+        self._objects = set()
+        self._jobs = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _delay(self, service: str) -> float:
+        """Draws a latency of a service, in seconds, scaled by the time scale."""
+        profile = self.profiles[service]
+        with self._lock:
+            latency = self._rng.lognormvariate(math.log(profile['median']), profile['sigma'])
+        return latency * self.time_scale
+
+    def _call(self, service: str) -> bool:
+        """Counts and delays a call of a service and returns whether it is throttled."""
+        time.sleep(self._delay(service))
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            throttled = self._rng.random() < self.profiles[service]['throttle']
+            if throttled:
+                self.throttled[service] = self.throttled.get(service, 0) + 1
+        return throttled
+
+    def install(self, clients: dict):
+        """Answers all requests of the given boto3 clients by service name."""
+        for service, client in clients.items():
+            client.meta.events.register(
+                'before-send',
+                lambda request, service = service, **kwargs: self.handle(
+                    service, request, **kwargs,
+                ),
+            )
+
+    def handle(self, service: str, request, event_name: str = '', **_) -> AWSResponse:
+        """Returns the response of a request of a boto3 client."""
+        operation = event_name.rsplit('.', 1)[-1]
+        if self._call(SERVICE_PROFILES[service]):
+            return self._throttle(service, request)
+
+        handler = getattr(self, f"_{service.replace('-', '_')}_{operation}", None)
+        if handler is None:
+            raise NotImplementedError(f"No stand-in for {service} {operation}.")
+
+        status, headers, body = handler(request)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers = {'Content-Type': 'application/json', ** headers}
+
+        return AWSResponse(request.url, status, headers, _Raw(body))
+
+    @staticmethod
+    def _throttle(service: str, request) -> AWSResponse:
+        if service == 's3':
+            body = b"<Error><Code>SlowDown</Code><Message>Slow down.</Message></Error>"
+            return AWSResponse(request.url, 503, {}, _Raw(body))
+
+        body = json.dumps({
+            '__type': 'ThrottlingException',
+            'message': 'Rate exceeded',
+        }).encode('utf-8')
+        headers = {'x-amzn-ErrorType': 'ThrottlingException'}
+
+        status = 429 if service == 'bedrock-runtime' else 400
+
+        return AWSResponse(request.url, status, headers, _Raw(body))
+
+    @staticmethod
+    def _body(request) -> dict:
+        body = request.body
+        if hasattr(body, 'read'):
+            body = body.read()
+        return json.loads(body or b'{}')
+
+    @staticmethod
+    def _key(request) -> str:
+        return unquote(urlsplit(request.url).path)
+
+    # S3
+
+    def _s3_HeadObject(self, request):  # pylint: disable=invalid-name
+        with self._lock:
+            exists = self._key(request) in self._objects
+        return (200, {'ETag': '"0"', 'Content-Length': '0'}, b'') if exists else (404, {}, b'')
+
+    def _s3_PutObject(self, request):  # pylint: disable=invalid-name
+        with self._lock:
+            self._objects.add(self._key(request))
+        return 200, {'ETag': '"0"'}, b''
+
+    def _s3_CreateMultipartUpload(self, request):  # pylint: disable=invalid-name
+        return 200, {}, (
+            "<InitiateMultipartUploadResult><Bucket>bench</Bucket>"
+            f"<Key>{self._key(request)}</Key><UploadId>{uuid.uuid4().hex}</UploadId>"
+            "</InitiateMultipartUploadResult>"
+        ).encode('utf-8')
+
+    def _s3_UploadPart(self, _request):  # pylint: disable=invalid-name
+        return 200, {'ETag': '"0"'}, b''
+
+    def _s3_CompleteMultipartUpload(self, request):  # pylint: disable=invalid-name
+        with self._lock:
+            self._objects.add(self._key(request))
+        return 200, {}, (
+            b"<CompleteMultipartUploadResult><ETag>\"0\"</ETag></CompleteMultipartUploadResult>"
+        )
+
+    # Textract
+
+    def _textract_StartDocumentAnalysis(self, request):  # pylint: disable=invalid-name
+        job_id = uuid.uuid4().hex
+        queries = self._body(request)['QueriesConfig']['Queries']
+        ready_at = time.monotonic() + self._delay('textract_job')
+        with self._lock:
+            self._jobs[job_id] = (ready_at, queries)
+        return 200, {}, {'JobId': job_id}
+
+    def _textract_GetDocumentAnalysis(self, request):  # pylint: disable=invalid-name
+        job_id = self._body(request)['JobId']
+        with self._lock:
+            ready_at, queries = self._jobs[job_id]
+        if time.monotonic() < ready_at:
+            return 200, {}, {'JobStatus': 'IN_PROGRESS'}
+
+        blocks = []
+        for i, query in enumerate(queries):
+            answer = self.fixtures['textract'].get(query['Alias'])
+            blocks.append({
+                'BlockType': 'QUERY',
+                'Id': f"q{i}",
+                'Query': {'Text': query['Text'], 'Alias': query['Alias']},
+                'Relationships': [{'Type': 'ANSWER', 'Ids': [f"r{i}"]}] if answer else [],
+            })
+            if answer:
+                blocks.append({'BlockType': 'QUERY_RESULT', 'Id': f"r{i}", 'Text': answer})
+
+        return 200, {}, {
+            'JobStatus': 'SUCCEEDED',
+            'DocumentMetadata': {'Pages': 1},
+            'Blocks': blocks,
+        }
+
+    # Bedrock
+
+    def _bedrock_runtime_Converse(self, request):  # pylint: disable=invalid-name
+        payload = self._body(request)
+        tools = payload.get('toolConfig', {}).get('tools', [])
+        if tools:
+            content = [{'toolUse': {
+                'toolUseId': uuid.uuid4().hex,
+                'name': tools[0]['toolSpec']['name'],
+                'input': self.fixtures['bedrock_analysis'],
+            }}]
+        else:
+            content = [{'text': self.fixtures['bedrock_summary']}]
+
+        input_tokens = len(request.body or b'') // 4
+        output_tokens = len(json.dumps(content)) // 4
+
+        return 200, {}, {
+            'output': {'message': {'role': 'assistant', 'content': content}},
+            'stopReason': 'tool_use' if tools else 'end_turn',
+            'usage': {
+                'inputTokens': input_tokens,
+                'outputTokens': output_tokens,
+                'totalTokens': input_tokens + output_tokens,
+            },
+            'metrics': {'latencyMs': 0},
+        }
+
+    # Tavily
+
+    def start_tavily(self) -> str:
+        """Starts the local Tavily server and returns its search URL."""
+        stand_ins = self
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Answers a search request."""
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stand_ins._call('tavily'):  # pylint: disable=protected-access
+                    self.send_response(429)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stand_ins._tavily_body)))  # pylint: disable=protected-access
+                self.end_headers()
+                self.wfile.write(stand_ins._tavily_body)  # pylint: disable=protected-access
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Silences the access log."""
+
+        class _Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        threading.Thread(target = self._server.serve_forever, daemon = True).start()
+
+        return f"http://127.0.0.1:{self._server.server_port}/search"
+
+    def stop(self):
+        """Stops the local Tavily server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
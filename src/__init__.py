@@ -3,6 +3,7 @@ __init__.py
 """
 from src.aws import (
     S3,
+    MemoryReader,
     Textract,
     Bedrock,
 )
@@ -14,8 +15,47 @@ from src.llm import (
 
 from src.ocr import OCR
 
+from src.classify import (
+    DocumentClassifier,
+    page_ranges,
+)
+
+from src.locate import (
+    PageLocator,
+    build_locator,
+)
+
+from src.textlayer import (
+    TextLayerExtractor,
+    build_text_layer,
+)
+
+from src.store import (
+    FinStore,
+    build_store,
+)
+
 from src.scraper import TavilyScraper
 
+from src.pipeline import (
+    Dag,
+    Pipeline,
+)
+
+from src.batch import (
+    BatchRunner,
+    LocalFile,
+    collect_files,
+    load_checkpoint,
+    export_parquet,
+)
+
+from src.jobs import (
+    JobQueue,
+    Worker,
+    build_job_queue,
+)
+
 from src.ui import App
 
 from src.utils import (
@@ -23,4 +63,69 @@ from src.utils import (
     _load_config,
     exponential_backoff,
     wait_for_completion,
+    file_digest,
+    fingerprint,
+    normalize_name,
+)
+
+from src.clients import (
+    ClientRegistry,
+    CLIENTS,
+    get_client,
+)
+
+from src.completion import (
+    AdaptivePoller,
+    NotificationListener,
+    FakeQueue,
+    build_completion,
+)
+
+from src.ratelimit import (
+    TokenBucket,
+    ServiceLimiter,
+    RateLimiter,
+    RATE_LIMITER,
+    rate_limited,
+)
+
+from src.tracing import (
+    Span,
+    JsonLinesExporter,
+    PrometheusExporter,
+    Tracer,
+    TRACER,
+    traced,
+)
+
+from src.singleflight import (
+    SingleFlight,
+    SINGLE_FLIGHT,
+)
+
+from src.compress import (
+    ScrapeCompressor,
+    estimate_tokens,
+)
+
+from src.template import PayloadTemplate
+
+from src.ratios import (
+    RatioEngine,
+    build_ratio_engine,
+    parse_amounts,
+)
+
+from src.scoring import (
+    FastPathScorer,
+    build_scorer,
+)
+
+from src.cache import (
+    LocalCache,
+    S3Cache,
+    SQLiteCache,
+    TieredCache,
+    TTLCache,
+    build_cache,
 )
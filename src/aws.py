@@ -2,51 +2,227 @@
 """
 A module for interacting with AWS services such as S3, Textract, and Bedrock.
 """
+import io
 import os
-from typing import Dict, Any
-import boto3
-
+import json
+import mmap
+import asyncio
+import logging
+import posixpath
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.exceptions import ClientError
+
+from src.clients import get_client
+from src.completion import build_completion
+from src.ratelimit import rate_limited
+from src.tracing import (
+    TRACER,
+    Span,
+    traced,
+)
 from src.utils import (
     exponential_backoff,
-    wait_for_completion,
+    file_digest,
 )
 
+logger = logging.getLogger(__name__)
+
+CACHE_POINT = {'cachePoint': {'type': 'default'}}
+
+class MemoryReader(io.RawIOBase):
+    """
+    A seekable, read-only file object over a buffer (e.g. the memoryview of an uploaded
+    file or a memory-mapped file), which copies only the chunks that are read.
+    """
+
+    def __init__(
+            self,
+            buffer: Any,
+    ):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(
+            self,
+            offset: int,
+            whence: int = io.SEEK_SET,
+    ) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}
+        self._position = min(max(base[whence] + offset, 0), len(self._view))
+        return self._position
+
+    def read(
+            self,
+            size: int = -1,
+    ) -> bytes:
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        chunk = self._view[self._position:end].tobytes()
+        self._position += len(chunk)
+        return chunk
+
+    def readinto(
+            self,
+            buffer: Any,
+    ) -> int:
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        """
+        Releases the view of the buffer, so that the buffer can be closed or resized.
+        """
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+@contextmanager
+def _buffer(
+        file: Any,
+) -> Iterator[Optional[memoryview]]:
+    """
+    Exposes the content of a file object as a buffer without copying it: the buffer
+    of in-memory files (e.g. a Streamlit UploadedFile) or a memory map of files on disk.
+    Yields:
+        Optional[memoryview]: The content, or None if the file cannot be exposed as a buffer.
+    """
+    if hasattr(file, 'getbuffer'):
+        with file.getbuffer() as view:
+            yield view
+        return
+
+    try:
+        fileno = file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        yield None
+        return
+
+    with mmap.mmap(fileno, 0, access = mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        yield view
+
+
 class S3:
     """
     A class for interacting with AWS S3 to upload files.
+    Uploads run on one transfer manager, so the multipart threshold, the chunk size and
+    the concurrency budget are shared by all uploads of the instance, and they read the
+    file content from its buffer without copying the whole file.
     Attributes:
-        s3_client (boto3.client): The S3 client for performing operations.
+        s3_client (boto3.client): The shared S3 client for performing operations.
+        transfer_config (TransferConfig): The multipart transfer settings.
+        deduplicate (bool): If True, files are stored under the SHA-256 hash of their
+            content and not uploaded again if an object with the hash already exists.
     Methods:
+        exists: Checks whether an object exists in the specified S3 bucket.
         upload: Uploads a file to the specified S3 bucket.
     """
 
-    def __init__(self):
+    def __init__(
+            self,
+            config: Optional[Dict[str, Any]] = None,
+    ):
 
-        self.s3_client = boto3.client(
-            's3',
-            aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY'],
-            region_name = os.environ['AWS_REGION']
+        self.s3_client = get_client('s3')
+
+        config = dict(config or {})
+        self.deduplicate = config.pop('deduplicate', False)
+        self.transfer_config = TransferConfig(** config)
+        self._transfer_manager = create_transfer_manager(
+            self.s3_client,
+            self.transfer_config,
         )
 
+    def exists(
+            self,
+            bucket_name: str,
+            file_name: str,
+    ) -> bool:
+        """
+        Checks whether an object exists in the specified S3 bucket.
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            file_name (str): The key of the object.
+        Returns:
+            bool: True if the object exists.
+        """
+        try:
+            self.s3_client.head_object(
+                Bucket = bucket_name,
+                Key = file_name,
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+        return True
+
+    @traced('s3.upload')
     def upload(
             self,
             file: Any,
             bucket_name: str,
             file_name: str,
-    ):
+            digest: Optional[str] = None,
+    ) -> str:
         """
-        Uploads a file to the specified S3 bucket.
+        Uploads a file to the specified S3 bucket, in parts above the multipart threshold.
+        With deduplication enabled, the file is stored as `<directory of file_name>/<sha256>
+        <extension>` and the upload is skipped if that object already exists.
         Args:
             file: The file object to upload.
             bucket_name (str): The name of the S3 bucket.
             file_name (str): The name under which the file will be stored in the bucket.
+            digest (Optional[str]): The SHA-256 digest of the file content, if already known.
+        Returns:
+            str: The key under which the file is stored.
         """
-        self.s3_client.upload_fileobj(
-            file,
-            bucket_name,
-            file_name,
-        )
+        digest = digest or file_digest(file)
+
+        if self.deduplicate:
+            directory, name = posixpath.split(file_name)
+            file_name = posixpath.join(directory, digest + posixpath.splitext(name)[1])
+            if self.exists(bucket_name, file_name):
+                logger.info("Skipping the upload of %s, the object already exists.", file_name)
+                TRACER.add(deduplicated = 1)
+                return file_name
+
+        position = file.tell()
+        file.seek(0)
+        try:
+            with _buffer(file) as view:
+                reader = MemoryReader(view) if view is not None else file
+                TRACER.set(upload_bytes = len(view) if view is not None else None)
+                try:
+                    self._transfer_manager.upload(
+                        reader,
+                        bucket_name,
+                        file_name,
+                        extra_args = {'Metadata': {'sha256': digest}},
+                    ).result()
+                finally:
+                    if reader is not file:
+                        reader.close()
+        finally:
+            file.seek(position)
+
+        return file_name
 
 
 
@@ -54,33 +230,46 @@ class Textract:
     """
     A class for interacting with AWS Textract to analyze documents.
     Attributes:
-        textract_client (boto3.client): The Textract client for performing operations.
+        textract_client (boto3.client): The shared Textract client for performing operations.
+        completion: The strategy waiting for job completion (adaptive polling
+            or SNS/SQS notifications).
     Methods:
         _start_analyze:
             Starts a document analysis job with specified queries and adapter configuration.
-        _analyze(job_response:
-            Processes the response from a Textract document analysis job to extract query results.
+        _iter_pages:
+            Iterates over all result pages of a completed document analysis job.
+        _analyze(pages):
+            Processes the result pages of a Textract document analysis job
+            to extract query results.
         _wait_for_analyze:
             Waits for the Textract document analysis job to complete and retrieves the results.
-        extract(file_name: str, queries: Dict[str, Any], adapter_id: str, version: str = '1'):
+        extract(file_name, queries, adapter_id, version, pages):
             Starts a document analysis job and waits for its completion, returning the results. 
     """
 
-    def __init__(self):
+    def __init__(
+            self,
+            config: Optional[Dict[str, Any]] = None,
+    ):
 
-        self.textract_client = boto3.client(
-            'textract',
-            aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY'],
-            region_name = os.environ['AWS_REGION'],
+        self.textract_client = get_client('textract')
+        self.completion = build_completion(
+            (config or {}).get('completion'),
         )
 
+    @traced(
+        'textract.start_analyze',
+        lambda self, file_name, queries, *args, **kwargs: {'queries': len(queries)},
+    )
+    @exponential_backoff()
+    @rate_limited('textract')
     def _start_analyze(
             self,
             file_name: str,
             queries: Dict[str, Any],
             adapter_id: str,
             version: str = '1',
+            pages: Optional[List[str]] = None,
     ) -> Dict[str, Any]:
         """
         Starts a document analysis job with specified queries and adapter configuration.
@@ -89,10 +278,14 @@ class Textract:
             queries (Dict[str, Any]): A dictionary containing queries to be processed.
             adapter_id (str): The ID of the adapter to use for the analysis.
             version (str): The version of the adapter to use. Defaults to '1'.
+            pages (Optional[List[str]]): The pages or page ranges the adapter is applied to
+                (e.g. ['1-2']). Defaults to all pages.
         Returns:
             Dict[str, Any]: The response from the Textract service containing job details.
         """
 
+        notification_channel = self.completion.notification_channel
+
         response = self.textract_client.start_document_analysis(
             DocumentLocation = {
                 'S3Object': {
@@ -107,53 +300,104 @@ class Textract:
             AdaptersConfig = {
                 'Adapters': [{
                     'AdapterId': adapter_id,
-                    'Pages': ['*'],
+                    'Pages': pages or ['*'],
                     'Version': version,
                 }],
             },
+            ** (
+                {'NotificationChannel': notification_channel}
+                if notification_channel else {}
+            ),
         )
 
         return response
 
+    @exponential_backoff()
+    def _get_analysis(
+            self,
+            **kwargs: Any,
+    ) -> Dict[str, Any]:
+        """
+        Returns the status or a result page of a Textract document analysis job,
+        retrying throttled calls (the client itself does not retry them).
+        Args:
+            **kwargs: The arguments of GetDocumentAnalysis (JobId, NextToken).
+        Returns:
+            Dict[str, Any]: The response from the Textract service.
+        """
+        return self.textract_client.get_document_analysis(
+            ** kwargs,
+        )
+
+    def _iter_pages(
+            self,
+            job_id: str,
+            job_response: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Iterates over all result pages of a completed Textract document analysis job,
+        following the NextToken of each page.
+        Args:
+            job_id (str): The ID of the Textract job.
+            job_response (Dict[str, Any]): The first result page of the job.
+        Yields:
+            Dict[str, Any]: The result pages of the job, one at a time.
+        """
+        page = job_response
+        yield page
+
+        while 'NextToken' in page:
+            page = self._get_analysis(
+                JobId = job_id,
+                NextToken = page['NextToken'],
+            )
+            yield page
+
     def _analyze(
         self,
-        job_response: Dict[str, Any],
+        pages: Iterable[Dict[str, Any]],
     ) -> Dict[str, str]:
         """
-        Processes the response from a Textract document analysis job to extract query results.
+        Processes the result pages of a Textract document analysis job to extract query results.
+        QUERY blocks are joined with their QUERY_RESULT blocks as the pages stream in,
+        so only the blocks of not yet joined queries are kept in memory.
         Args:
-            job_response (Dict[str, Any]): The response from the Textract service
+            pages (Iterable[Dict[str, Any]]): The result pages from the Textract service
                 containing job details.
         Returns:
             Dict[str, str]: A dictionary mapping query texts to their corresponding results.
         """
-        if job_response['JobStatus'] != 'SUCCEEDED':
-            raise ValueError(
-                f"Textract job failed with status: {job_response['JobStatus']}"
-            )
-
         ocr_results = {}
-        blocks = job_response['Blocks']
-
-        query_results = {
-            block['Id']: block['Text']
-            for block in blocks
-            if block['BlockType'] == 'QUERY_RESULT'
-        }
-
-        for block in blocks:
-            if block['BlockType'] != 'QUERY' or 'Relationships' not in block:
-                continue
-
-            query_text = block['Query']['Text']
-            for rel_id in block['Relationships'][0]['Ids']:
-                if rel_id in query_results:
-                    ocr_results[query_text] = query_results[rel_id]
+        # QUERY_RESULT ID -> query text, for results referenced by an already seen query
+        pending_queries = {}
+        # QUERY_RESULT ID -> result text, for results seen before their query
+        pending_results = {}
+
+        for page in pages:
+            if page['JobStatus'] != 'SUCCEEDED':
+                raise ValueError(
+                    f"Textract job failed with status: {page['JobStatus']}"
+                )
+
+            for block in page['Blocks']:
+                if block['BlockType'] == 'QUERY_RESULT':
+                    if block['Id'] in pending_queries:
+                        ocr_results[pending_queries.pop(block['Id'])] = block['Text']
+                    else:
+                        pending_results[block['Id']] = block['Text']
+
+                elif block['BlockType'] == 'QUERY' and 'Relationships' in block:
+                    query_text = block['Query']['Text']
+                    for rel_id in block['Relationships'][0]['Ids']:
+                        if rel_id in pending_results:
+                            ocr_results[query_text] = pending_results.pop(rel_id)
+                        else:
+                            pending_queries[rel_id] = query_text
 
         return ocr_results
 
 
-    @wait_for_completion()
+    @traced('textract.wait_for_analyze')
     def _wait_for_analyze(
             self,
             start_response: Dict[str, Any],
@@ -167,8 +411,21 @@ class Textract:
             Dict[str, Any]: The response from the Textract service containing the analysis results.
         """
 
-        response = self.textract_client.get_document_analysis(
-            JobId = start_response['JobId'],
+        job_id = start_response['JobId']
+
+        def _poll():
+            TRACER.add(polls = 1)
+            return self._get_analysis(
+                JobId = job_id,
+            )
+
+        response = self.completion.wait(
+            job_id,
+            _poll,
+        )
+        TRACER.set(
+            job_id = job_id,
+            pages = response.get('DocumentMetadata', {}).get('Pages'),
         )
 
         return response
@@ -180,14 +437,18 @@ class Textract:
             queries: Dict[str, Any],
             adapter_id: str,
             version: str = '1',
+            pages: Optional[List[str]] = None,
     ) -> Dict[str, str]:
         """
-        Starts a document analysis job and waits for its completion, returning the results.
+        Starts a document analysis job and waits for its completion, returning the results
+        collected from all of its result pages.
         Args:
             file_name (str): The name of the file to analyze.
             queries (Dict[str, Any]): A dictionary containing queries to be processed.
             adapter_id (str): The ID of the adapter to use for the analysis.
             version (str): The version of the adapter to use. Defaults to '1'.
+            pages (Optional[List[str]]): The pages or page ranges the adapter is applied to.
+                Defaults to all pages.
         Returns:
             Dict[str, str]: A dictionary mapping query texts to their corresponding results.
         """
@@ -197,6 +458,7 @@ class Textract:
             queries = queries,
             adapter_id = adapter_id,
             version = version,
+            pages = pages,
         )
 
         job_response = self._wait_for_analyze(
@@ -204,7 +466,10 @@ class Textract:
         )
 
         ocr_results = self._analyze(
-            job_response = job_response,
+            pages = self._iter_pages(
+                start_response['JobId'],
+                job_response,
+            ),
         )
 
         return ocr_results
@@ -218,22 +483,149 @@ class Bedrock:
     """
     A class for interacting with AWS Bedrock LLM's.
     Attributes:
-        bedrock_client (boto3.client): The Bedrock client for performing operations.
+        bedrock_client (boto3.client): The shared Bedrock client for performing operations.
+        usage (Dict[str, int]): The token usage accumulated over all calls, including
+            the tokens read from and written to the prompt cache.
     Methods:
+        with_cache_points: Inserts prompt cache points into a payload as configured in it.
         invoke: Sends a request to the Bedrock LLM
             and returns the response.
+        invoke_async: Asynchronous version of `invoke`.
+        invoke_stream: Sends a request to the Bedrock LLM
+            and returns the stream of response events.
     """
 
     def __init__(self):
 
-        self.bedrock_client = boto3.client(
-            'bedrock-runtime',
-            aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY'],
-            region_name = os.environ['AWS_REGION']
-        )
+        self.bedrock_client = get_client('bedrock-runtime')
+        self.usage = {
+            'inputTokens': 0,
+            'outputTokens': 0,
+            'cacheReadInputTokens': 0,
+            'cacheWriteInputTokens': 0,
+        }
+        self._usage_lock = threading.Lock()
+
+    @staticmethod
+    def with_cache_points(
+            payload: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Inserts Converse prompt cache points after the static parts of a payload listed
+        in its `cache_points` key ('system' and/or 'tools'), so that Bedrock can reuse
+        the processed prefix across calls. The `cache_points` key itself is removed.
+        Args:
+            payload (Dict[str, Any]): The payload, optionally with a `cache_points` list.
+        Returns:
+            Dict[str, Any]: A new payload with the cache points inserted.
+        """
+        payload = dict(payload)
+        cache_points = payload.pop('cache_points', None) or []
+
+        if 'system' in cache_points:
+            payload['system'] = [* payload['system'], CACHE_POINT]
+
+        if 'tools' in cache_points:
+            payload['toolConfig'] = {
+                ** payload['toolConfig'],
+                'tools': [* payload['toolConfig']['tools'], CACHE_POINT],
+            }
+
+        return payload
+
+    def _record_usage(
+            self,
+            response: Dict[str, Any],
+            span: Optional[Span] = None,
+    ):
+        """
+        Accumulates the token usage of a call, records it and the server-side latency
+        in the span of the call and logs its prompt cache usage.
+        Args:
+            response (Dict[str, Any]): A Converse response or the metadata event
+                of a ConverseStream response, with the `usage` and `metrics` of the call.
+            span (Optional[Span]): The span of the call, if traced.
+        """
+        usage = response.get('usage', {})
+        with self._usage_lock:
+            for key in self.usage:
+                self.usage[key] += usage.get(key, 0)
+
+        if span is not None:
+            span.set(
+                server_latency_ms = response.get('metrics', {}).get('latencyMs'),
+                ** {key: usage.get(key, 0) for key in self.usage},
+            )
+
+        if usage.get('cacheReadInputTokens') or usage.get('cacheWriteInputTokens'):
+            logger.info(
+                "Bedrock prompt cache: %d tokens read, %d written, %d uncached input tokens.",
+                usage.get('cacheReadInputTokens', 0),
+                usage.get('cacheWriteInputTokens', 0),
+                usage.get('inputTokens', 0),
+            )
+
+    def _track_usage(
+            self,
+            stream: Iterable[Dict[str, Any]],
+            span: Optional[Span] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        error = None
+        try:
+            for event in stream:
+                if span is not None and 'first_event_seconds' not in span.attributes:
+                    span.set(first_event_seconds = span.elapsed())
+                if 'metadata' in event:
+                    self._record_usage(event['metadata'], span)
+                yield event
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            TRACER.end_span(span, error)
+
+    @staticmethod
+    def _estimate_tokens(
+            payload: Dict[str, Any],
+    ) -> int:
+        """
+        Estimates the tokens a Converse request counts against the tokens-per-minute quota,
+        i.e. its input (approximately four characters per token) and its maximum output.
+        Args:
+            payload (Dict[str, Any]): The payload to send to the Bedrock LLM.
+        Returns:
+            int: The estimated number of tokens.
+        """
+        input_chars = len(json.dumps(
+            [payload.get('system'), payload.get('messages'), payload.get('toolConfig')],
+            ensure_ascii = False,
+        ))
+
+        return input_chars // 4 + payload.get('inferenceConfig', {}).get('maxTokens', 0)
 
+    @staticmethod
+    def _payload_size(
+            payload: Dict[str, Any],
+    ) -> int:
+        """
+        Returns the size of a Converse request payload.
+        Args:
+            payload (Dict[str, Any]): The payload to send to the Bedrock LLM.
+        Returns:
+            int: The size of the payload serialized as JSON, in bytes.
+        """
+        return len(json.dumps(payload, ensure_ascii = False, default = str).encode('utf-8'))
+
+    @traced(
+        'bedrock.invoke',
+        lambda self, payload: {'model': payload.get('modelId')},
+    )
     @exponential_backoff()
+    @rate_limited(
+        'bedrock',
+        estimate_tokens = lambda self, payload: self._estimate_tokens(payload),
+        used_tokens = lambda response: response['usage']['totalTokens'],
+    )
     def invoke(
             self,
             payload: Dict[str, Any],
@@ -246,8 +638,69 @@ class Bedrock:
             Dict[str, Any]: The response from the Bedrock LLM.
         """
 
+        if TRACER.enabled:
+            TRACER.set(request_bytes = self._payload_size(payload))
         response = self.bedrock_client.converse(
             ** payload,
         )
+        self._record_usage(response, TRACER.current_span())
 
         return response
+
+    async def invoke_async(
+            self,
+            payload: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Asynchronous version of `invoke`, running the blocking Bedrock call
+        in the default executor of the event loop.
+        Args:
+            payload (Dict[str, Any]): The payload to send to the Bedrock LLM.
+        Returns:
+            Dict[str, Any]: The response from the Bedrock LLM.
+        """
+        return await asyncio.to_thread(
+            self.invoke,
+            payload,
+        )
+
+    @exponential_backoff()
+    @rate_limited(
+        'bedrock',
+        estimate_tokens = lambda self, payload: self._estimate_tokens(payload),
+    )
+    def _converse_stream(
+            self,
+            payload: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        return self.bedrock_client.converse_stream(
+            ** payload,
+        )
+
+    def invoke_stream(
+            self,
+            payload: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Sends a request to the Bedrock LLM using ConverseStream and returns
+        the stream of response events (contentBlockDelta, messageStop, metadata, ...)
+        as they are generated. The span of the call ends with the stream.
+        Args:
+            payload (Dict[str, Any]): The payload to send to the Bedrock LLM.
+        Returns:
+            Iterator[Dict[str, Any]]: The stream of response events.
+        """
+
+        span = TRACER.start_span(
+            'bedrock.invoke_stream',
+            model = payload.get('modelId'),
+            request_bytes = self._payload_size(payload) if TRACER.enabled else None,
+        )
+        try:
+            with TRACER.activate(span):
+                response = self._converse_stream(payload)
+        except Exception as e:
+            TRACER.end_span(span, e)
+            raise
+
+        return self._track_usage(response['stream'], span)
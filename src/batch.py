@@ -0,0 +1,280 @@
+# pylint: disable=too-few-public-methods
+"""
+A module for headless batch analysis of many companies' financial statements,
+read from a directory or a CSV manifest, with bounded concurrency per pipeline
+stage, streaming JSONL output and resuming from previously finished companies.
+"""
+import io
+import csv
+import json
+import asyncio
+import logging
+from pathlib import Path
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Set
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.ocr import OCR
+from src.pipeline import (
+    STAGES,
+    Pipeline,
+)
+from src.tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class LocalFile(io.BytesIO):
+    """
+    An in-memory copy of a local PDF file, exposing its base name as `name`
+    like a Streamlit UploadedFile does.
+    Attributes:
+        name (str): The base name of the file.
+    """
+
+    def __init__(
+            self,
+            path: Path,
+    ):
+        super().__init__(path.read_bytes())
+        self.name = path.name
+
+
+def collect_files(
+        source: str,
+) -> Dict[str, List[Path]]:
+    """
+    Collects PDF files from a directory or a CSV manifest and groups them by company.
+    The manifest has a `path` column (relative to the manifest location) and an optional
+    `company_name` column; otherwise the company name is derived from the file name.
+    Args:
+        source (str): The path to a directory with PDF files or to a CSV manifest.
+    Returns:
+        Dict[str, List[Path]]: The PDF file paths grouped by company name.
+    """
+    source_path = Path(source)
+    companies = defaultdict(list)
+
+    if source_path.is_dir():
+        for path in sorted(source_path.glob('*.pdf')):
+            companies[OCR.get_company_name(path.name)].append(path)
+
+    else:
+        with open(source_path, 'r', encoding = 'utf-8', newline = '') as file:
+            for row in csv.DictReader(file):
+                path = source_path.parent / row['path']
+                company_name = row.get('company_name') or OCR.get_company_name(path.name)
+                companies[company_name].append(path)
+
+    return dict(companies)
+
+
+def load_checkpoint(
+        output_path: Path,
+) -> Set[str]:
+    """
+    Reads the companies already analyzed successfully from a JSONL output file,
+    ignoring a truncated last line left behind by a crash.
+    Args:
+        output_path (Path): The path to the JSONL output file.
+    Returns:
+        Set[str]: The names of the finished companies.
+    """
+    finished = set()
+    if not output_path.exists():
+        return finished
+
+    with open(output_path, 'r', encoding = 'utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('error') is None:
+                finished.add(record['company_name'])
+
+    return finished
+
+
+def export_parquet(
+        output_path: Path,
+        parquet_path: Path,
+):
+    """
+    Exports the records of a JSONL output file to a Parquet file, keeping the latest
+    record per company and storing the nested OCR results as JSON strings.
+    Args:
+        output_path (Path): The path to the JSONL output file.
+        parquet_path (Path): The path to the Parquet file to write.
+    """
+    records = {}
+    with open(output_path, 'r', encoding = 'utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record['company_name']] = record
+
+    rows = [
+        {
+            'company_name': record['company_name'],
+            'files': record['files'],
+            'ocr_results': json.dumps(record.get('ocr_results'), ensure_ascii = False),
+            'scrape_results': record.get('scrape_results'),
+            'financial_analysis': (record.get('fin_results') or {}).get('financial_analysis'),
+            'recommendations': (record.get('fin_results') or {}).get('recommendations'),
+            'error': record.get('error'),
+        }
+        for record in records.values()
+    ]
+
+    pq.write_table(
+        pa.Table.from_pylist(rows),
+        parquet_path,
+    )
+
+
+class BatchRunner:
+    """
+    Runs many companies through the pipeline concurrently, limiting the number of
+    companies at the same time and of files or companies in every pipeline stage,
+    and appends one JSONL record per company as soon as it finishes.
+    Attributes:
+        pipeline (Pipeline): The pipeline holding the OCR, LLMScraper
+            and LLMFinAnalyzer instances.
+        concurrency (Dict[str, int]): The maximum number of `companies` analyzed at
+            the same time and of files or companies in every stage.
+    Methods:
+        run: Analyzes all companies from a directory or a CSV manifest.
+    """
+
+    def __init__(
+            self,
+            pipeline: Pipeline,
+            config: Optional[Dict[str, Any]] = None,
+    ):
+        config = config or {}
+
+        self.pipeline = pipeline
+        self.concurrency = {
+            'companies': 8,
+            'ocr_results': 8,
+            'scrape_results': 4,
+            'fin_results': 4,
+            ** config.get('concurrency', {}),
+        }
+
+    async def _analyze_company(
+            self,
+            company_name: str,
+            paths: List[Path],
+            limits: Dict[str, asyncio.Semaphore],
+    ) -> Dict[str, Any]:
+        record = {
+            'company_name': company_name,
+            'files': [path.name for path in paths],
+            'error': None,
+        }
+
+        try:
+            files = await asyncio.to_thread(lambda: [LocalFile(path) for path in paths])
+        except OSError as e:
+            logger.exception("Reading the files of %s failed.", company_name)
+            record['error'] = f"{type(e).__name__}: {e}"
+            return record
+
+        results = await self.pipeline.run(
+            files,
+            limits = limits,
+            company_name = company_name,
+        )
+        result = results[company_name]
+
+        if 'error' in result:
+            record['error'] = f"{type(result['error']).__name__}: {result['error']}"
+        else:
+            record.update({
+                stage: result[stage]
+                for stage in STAGES
+            })
+
+        return record
+
+    async def run(
+            self,
+            source: str,
+            output_path: str,
+    ) -> Dict[str, Any]:
+        """
+        Analyzes all companies from a directory or a CSV manifest, skipping companies
+        already finished in the output file, and appends their records to the output file.
+        Args:
+            source (str): The path to a directory with PDF files or to a CSV manifest.
+            output_path (str): The path to the JSONL output file.
+        Returns:
+            Dict[str, Any]: The numbers of succeeded, failed and skipped companies and,
+                with fast-path scoring enabled, of companies decided without the LLM
+                and the fraction of financial analysis LLM calls avoided.
+        """
+        output_path = Path(output_path)
+        companies = collect_files(source)
+        finished = load_checkpoint(output_path)
+
+        limits = {
+            stage: asyncio.Semaphore(self.concurrency[stage])
+            for stage in STAGES
+        }
+        slots = asyncio.Semaphore(self.concurrency['companies'])
+
+        async def _bounded(company_name, paths):
+            async with slots:
+                return await self._analyze_company(company_name, paths, limits)
+
+        pending = [
+            _bounded(company_name, paths)
+            for company_name, paths in companies.items()
+            if company_name not in finished
+        ]
+        stats = {
+            'succeeded': 0,
+            'failed': 0,
+            'skipped': len(companies) - len(pending),
+        }
+        logger.info(
+            "Analyzing %d companies (%d already finished).",
+            len(pending), stats['skipped'],
+        )
+
+        output_path.parent.mkdir(parents = True, exist_ok = True)
+        if output_path.exists() and not output_path.read_bytes().endswith(b'\n'):
+            with open(output_path, 'ab') as file:
+                file.write(b'\n')
+
+        with open(output_path, 'a', encoding = 'utf-8') as file:
+            for future in asyncio.as_completed(pending):
+                record = await future
+                file.write(json.dumps(record, ensure_ascii = False) + '\n')
+                file.flush()
+
+                stats['failed' if record['error'] else 'succeeded'] += 1
+                logger.info(
+                    "%s %s (%d/%d).",
+                    record['company_name'],
+                    'failed' if record['error'] else 'finished',
+                    stats['succeeded'] + stats['failed'], len(pending),
+                )
+
+        TRACER.flush()
+
+        scorer = self.pipeline.fin_analyzer.scorer
+        if scorer is not None:
+            stats['decided_without_llm'] = scorer.metrics['decided']
+            stats['fin_analysis_calls_avoided'] = round(scorer.avoided_fraction(), 4)
+            logger.info(
+                "%d companies decided without the LLM (%.1f %% of financial analysis calls).",
+                scorer.metrics['decided'], 100 * scorer.avoided_fraction(),
+            )
+
+        return stats
@@ -0,0 +1,509 @@
+# pylint: disable=too-few-public-methods
+"""
+A module providing caches for expensive pipeline results, backed by the local
+file system, a SQLite database or an S3 bucket, and a TTL layer with
+stale-while-revalidate refreshes on top of them.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, Callable, Optional
+
+from botocore.exceptions import ClientError
+
+from src.clients import get_client
+from src.tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    An on-disk JSON cache with size-bounded LRU eviction.
+    Every entry is stored as a single file named after its key; the file
+    modification time doubles as the last access time used for eviction.
+    Attributes:
+        cache_dir (Path): The directory holding the cache entries.
+        max_bytes (int): The maximum total size of all entries in bytes.
+    Methods:
+        get: Returns the cached value for a key, or None on a miss.
+        set: Stores a value under a key, evicting the least recently used entries.
+    """
+
+    def __init__(
+            self,
+            cache_dir: str,
+            max_bytes: int = 100 * 1024 * 1024,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        self._lock = threading.Lock()
+        self._size = sum(
+            f.stat().st_size for f in self.cache_dir.glob('*.json')
+        )
+
+    def _path(
+            self,
+            key: str,
+    ) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(
+            self,
+            key: str,
+    ) -> Optional[Any]:
+        """
+        Returns the cached value for a key and marks it as recently used.
+        Args:
+            key (str): The cache key.
+        Returns:
+            Optional[Any]: The cached value, or None if the key is not cached.
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding = 'utf-8') as file:
+                    value = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return None
+            os.utime(path)
+
+        return value
+
+    def set(
+            self,
+            key: str,
+            value: Any,
+    ):
+        """
+        Stores a value under a key, evicting the least recently used entries
+        once the cache grows over its size limit.
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serializable value.
+        """
+        path = self._path(key)
+        data = json.dumps(value, ensure_ascii = False).encode('utf-8')
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+
+        with self._lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self._size += len(data) - old_size
+            self._evict()
+
+    def _evict(
+            self,
+    ):
+        if self._size <= self.max_bytes:
+            return
+
+        entries = sorted(
+            (
+                (f.stat().st_mtime, f.stat().st_size, f)
+                for f in self.cache_dir.glob('*.json')
+            ),
+            key = lambda entry: entry[0],
+        )
+        for _, size, path in entries:
+            if self._size <= self.max_bytes:
+                break
+            path.unlink(missing_ok = True)
+            self._size -= size
+
+
+class SQLiteCache:
+    """
+    A JSON cache stored in a local SQLite database with count-bounded LRU eviction.
+    Attributes:
+        path (str): The path to the SQLite database file.
+        max_entries (int): The maximum number of entries.
+    Methods:
+        get: Returns the cached value for a key, or None on a miss.
+        set: Stores a value under a key, evicting the least recently used entries.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_entries: int = 10000,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path,
+            check_same_thread = False,
+        )
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "accessed_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(cache)")]
+            if 'accessed_at' not in columns:
+                self._connection.execute(
+                    "ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0"
+                )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+
+    def get(
+            self,
+            key: str,
+    ) -> Optional[Any]:
+        """
+        Returns the cached value for a key and marks it as recently used.
+        Args:
+            key (str): The cache key.
+        Returns:
+            Optional[Any]: The cached value, or None if the key is not cached.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ? RETURNING value",
+                (time.time(), key),
+            ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def set(
+            self,
+            key: str,
+            value: Any,
+    ):
+        """
+        Stores a value under a key, evicting the least recently used entries
+        once the cache grows over its entry limit.
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serializable value.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, accessed_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii = False), time.time()),
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+class S3Cache:
+    """
+    A JSON cache stored in an S3 bucket, shared by all replicas of the app.
+    Attributes:
+        s3_client (boto3.client): The S3 client for performing operations.
+        bucket_name (str): The name of the S3 bucket.
+        prefix (str): The key prefix under which entries are stored.
+    Methods:
+        get: Returns the cached value for a key, or None on a miss.
+        set: Stores a value under a key.
+    """
+
+    def __init__(
+            self,
+            s3_client: Any,
+            bucket_name: str,
+            prefix: str = 'cache/',
+    ):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def get(
+            self,
+            key: str,
+    ) -> Optional[Any]:
+        """
+        Returns the cached value for a key.
+        Args:
+            key (str): The cache key.
+        Returns:
+            Optional[Any]: The cached value, or None if the key is not cached.
+        """
+        try:
+            response = self.s3_client.get_object(
+                Bucket = self.bucket_name,
+                Key = f"{self.prefix}{key}.json",
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+        return json.loads(
+            response['Body'].read()
+            .decode('utf-8')
+        )
+
+    def set(
+            self,
+            key: str,
+            value: Any,
+    ):
+        """
+        Stores a value under a key.
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serializable value.
+        """
+        self.s3_client.put_object(
+            Bucket = self.bucket_name,
+            Key = f"{self.prefix}{key}.json",
+            Body = json.dumps(
+                value,
+                ensure_ascii = False,
+            ),
+            ContentType = "application/json",
+        )
+
+
+class TieredCache:
+    """
+    A two-level cache reading from a fast local cache first and falling back
+    to a shared remote cache, whose hits are copied into the local one.
+    Attributes:
+        local (LocalCache | SQLiteCache): The first-level, per-replica cache.
+        remote (S3Cache): The second-level, shared cache.
+    Methods:
+        get: Returns the cached value for a key, or None on a miss.
+        set: Stores a value under a key in both levels.
+    """
+
+    def __init__(
+            self,
+            local: Any,
+            remote: S3Cache,
+    ):
+        self.local = local
+        self.remote = remote
+
+    def get(
+            self,
+            key: str,
+    ) -> Optional[Any]:
+        """
+        Returns the cached value for a key from the first level that has it.
+        Args:
+            key (str): The cache key.
+        Returns:
+            Optional[Any]: The cached value, or None if the key is not cached.
+        """
+        value = self.local.get(key)
+        if value is None:
+            value = self.remote.get(key)
+            if value is not None:
+                self.local.set(key, value)
+
+        return value
+
+    def set(
+            self,
+            key: str,
+            value: Any,
+    ):
+        """
+        Stores a value under a key in both levels.
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serializable value.
+        """
+        self.local.set(key, value)
+        self.remote.set(key, value)
+
+
+class TTLCache:
+    """
+    A layer over a cache backend expiring entries after a time-to-live. Entries
+    past their TTL but within the stale window are still served, while a refresh
+    is computed in the background (stale-while-revalidate).
+    Attributes:
+        backend: The underlying cache backend.
+        ttl_seconds (float): The time in seconds during which an entry is fresh.
+        stale_seconds (float): The additional time in seconds during which
+            a stale entry is served while being refreshed.
+        metrics (Dict[str, int]): The numbers of fresh hits, stale hits, misses
+            and background refreshes, also added to the current span as `cache_*`
+            attributes.
+    Methods:
+        get: Returns the value of a key if it is fresh or stale, or None on a miss.
+        set: Stores a value under a key.
+        get_or_compute: Returns the value of a key, computing and caching it if needed.
+    """
+
+    def __init__(
+            self,
+            backend: Any,
+            ttl_seconds: float,
+            stale_seconds: float = 0,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+
+        self.metrics = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+        }
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _count(
+            self,
+            metric: str,
+    ):
+        with self._lock:
+            self.metrics[metric] += 1
+        TRACER.add(** {f"cache_{metric}": 1})
+
+    def _refresh(
+            self,
+            key: str,
+            compute: Callable[[], Any],
+    ):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        # The refresh finishes after the span of its caller, so it is traced on start
+        TRACER.add(cache_refreshes_started = 1)
+
+        def _run():
+            try:
+                self.set(key, compute())
+                self._count('refreshes')
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Background refresh of %s failed.", key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target = _run, daemon = True).start()
+
+    def get(
+            self,
+            key: str,
+            refresh: Optional[Callable[[], Any]] = None,
+    ) -> Optional[Any]:
+        """
+        Returns the value of a key if it is fresh or stale, refreshing stale values
+        in the background.
+        Args:
+            key (str): The cache key.
+            refresh (Optional[Callable[[], Any]]): A function recomputing a stale value.
+        Returns:
+            Optional[Any]: The cached value, or None on a miss.
+        """
+        entry = self.backend.get(key)
+        if entry is not None:
+            age = time.time() - entry['created_at']
+
+            if age < self.ttl_seconds:
+                self._count('hits')
+                return entry['value']
+
+            if age < self.ttl_seconds + self.stale_seconds:
+                self._count('stale_hits')
+                if refresh is not None:
+                    self._refresh(key, refresh)
+                return entry['value']
+
+        self._count('misses')
+
+        return None
+
+    def set(
+            self,
+            key: str,
+            value: Any,
+    ):
+        """
+        Stores a value under a key, fresh from now on.
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serializable value.
+        """
+        self.backend.set(key, {
+            'value': value,
+            'created_at': time.time(),
+        })
+
+    def get_or_compute(
+            self,
+            key: str,
+            compute: Callable[[], Any],
+    ) -> Any:
+        """
+        Returns the value of a key from the cache if it is fresh or stale,
+        refreshing stale values in the background; otherwise computes and caches it.
+        Args:
+            key (str): The cache key.
+            compute (Callable[[], Any]): A function computing the value.
+        Returns:
+            Any: The cached or computed value.
+        """
+        value = self.get(key, compute)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+
+        return value
+
+
+def build_cache(
+        config: Optional[Dict[str, Any]],
+        s3_client: Any = None,
+):
+    """
+    Builds a cache backend from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The cache configuration with the `backend`
+            (local, sqlite, s3 or tiered) and the per-backend `local`, `sqlite` and `s3`
+            settings. A tiered cache uses the `local_backend` (local or sqlite) in front of S3.
+        s3_client (Any): The S3 client used by the S3 backend, the shared one by default.
+    Returns:
+        The configured cache backend, or None if caching is disabled.
+    """
+    if not config or not config.get('enabled', True):
+        return None
+
+    backend = config.get('backend', 'local')
+
+    def _local(kind):
+        if kind == 'sqlite':
+            return SQLiteCache(**config.get('sqlite', {}))
+        return LocalCache(**config.get('local', {}))
+
+    def _remote():
+        return S3Cache(
+            s3_client or get_client('s3'),
+            os.environ['S3_BUCKET_NAME'],
+            ** config.get('s3', {}),
+        )
+
+    if backend in ('local', 'sqlite'):
+        return _local(backend)
+    if backend == 's3':
+        return _remote()
+    if backend == 'tiered':
+        return TieredCache(
+            _local(config.get('local_backend', 'local')),
+            _remote(),
+        )
+
+    raise ValueError(f"Unsupported cache backend: {backend}")
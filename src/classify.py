@@ -0,0 +1,181 @@
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+"""
+A module that classifies uploaded PDFs into document types (balance sheet, profit and
+loss statement) locally from their text layer, with the file name as a fallback,
+so that unsupported files are rejected before they are uploaded anywhere.
+"""
+import logging
+from typing import Dict, Any, Iterable, List, Optional, Sequence
+
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+
+from src.utils import normalize_name
+
+logger = logging.getLogger(__name__)
+
+
+def page_ranges(
+        pages: Sequence[int],
+) -> List[str]:
+    """
+    Formats page numbers as Textract page ranges, e.g. [1, 2, 3, 5] as ['1-3', '5'].
+    Args:
+        pages (Sequence[int]): The page numbers (1-based); empty for all pages.
+    Returns:
+        List[str]: The page ranges, ['*'] for all pages.
+    """
+    if not pages:
+        return ['*']
+
+    ranges = []
+    pages = sorted(set(pages))
+    start = previous = pages[0]
+    for page in [* pages[1:], None]:
+        if page is not None and page == previous + 1:
+            previous = page
+            continue
+        ranges.append(str(start) if start == previous else f"{start}-{previous}")
+        start = previous = page
+
+    return ranges
+
+
+class DocumentClassifier:
+    """
+    Classifies the pages of a PDF by the statement headers found in its text layer.
+    A page with a header of a document type starts a document of that type, a page with
+    a header of another statement ends it, and pages without a header continue the
+    document of the previous page. PDFs without a text layer (scans) or without any
+    header are classified by keywords in their file name.
+    Attributes:
+        headers (Dict[str, List[str]]): The normalized page headers per document type.
+        other_headers (List[str]): The normalized headers of statements not analysed.
+        filename_keywords (Dict[str, List[str]]): The file name keywords per document type.
+        header_lines (int): The number of lines at the top of a page searched for headers.
+        min_text_chars (int): The minimum length of the text layer of a PDF.
+    Methods:
+        read_pages: Reads the text layer of every page of a PDF.
+        classify_name: Determines the document type from the file name.
+        classify: Determines the document types of a PDF and their pages.
+    """
+
+    def __init__(
+            self,
+            headers: Optional[Dict[str, Iterable[str]]] = None,
+            other_headers: Iterable[str] = (),
+            filename_keywords: Optional[Dict[str, Iterable[str]]] = None,
+            header_lines: int = 15,
+            min_text_chars: int = 50,
+    ):
+        self.headers = {
+            doc_type: [normalize_name(header) for header in doc_headers]
+            for doc_type, doc_headers in (headers or {}).items()
+        }
+        self.other_headers = [normalize_name(header) for header in other_headers]
+        self.filename_keywords = {
+            doc_type: [keyword.lower() for keyword in keywords]
+            for doc_type, keywords in (filename_keywords or {}).items()
+        }
+        self.header_lines = header_lines
+        self.min_text_chars = min_text_chars
+
+    @staticmethod
+    def read_pages(
+            file: Any,
+    ) -> List[str]:
+        """
+        Reads the text layer of every page of a PDF in layout mode, which keeps
+        the columns of tables apart, and rewinds the file.
+        Args:
+            file: The PDF file object.
+        Returns:
+            List[str]: The text of every page, empty if the PDF cannot be read.
+        """
+        position = file.tell()
+        try:
+            return [
+                page.extract_text(extraction_mode = 'layout') or ''
+                for page in PdfReader(file).pages
+            ]
+        except (PdfReadError, ValueError) as e:
+            logger.warning("Cannot read the text layer of %s: %s", file.name, e)
+            return []
+        finally:
+            file.seek(position)
+
+    def classify_name(
+            self,
+            file_name: str,
+    ) -> Optional[str]:
+        """
+        Determines the document type from keywords in the file name.
+        Args:
+            file_name (str): The name of the PDF file.
+        Returns:
+            Optional[str]: The document type, or None if no keyword matches.
+        """
+        for doc_type, keywords in self.filename_keywords.items():
+            if any(keyword in file_name.lower() for keyword in keywords):
+                return doc_type
+
+        return None
+
+    def _page_type(
+            self,
+            text: str,
+    ) -> Optional[str]:
+        """
+        Determines the statement a page starts from the headers at its top.
+        Returns:
+            Optional[str]: The document type, 'other' for statements not analysed,
+                or None if the page has no header.
+        """
+        top = normalize_name(' '.join(text.splitlines()[:self.header_lines]))
+        padded = f" {top} "
+
+        for doc_type, headers in self.headers.items():
+            if any(f" {header} " in padded for header in headers):
+                return doc_type
+
+        if any(f" {header} " in padded for header in self.other_headers):
+            return 'other'
+
+        return None
+
+    def classify(
+            self,
+            file_name: str,
+            pages: List[str],
+    ) -> Dict[str, List[int]]:
+        """
+        Determines the document types of a PDF and the pages of each of them.
+        Args:
+            file_name (str): The name of the PDF file.
+            pages (List[str]): The text of every page, as returned by `read_pages`.
+        Returns:
+            Dict[str, List[int]]: The page numbers (1-based) by document type,
+                in order of appearance; an empty list stands for all pages.
+        Raises:
+            TypeError: If the document type cannot be determined.
+        """
+        documents: Dict[str, List[int]] = {}
+
+        if sum(len(text.strip()) for text in pages) >= self.min_text_chars:
+            current = None
+            for number, text in enumerate(pages, start = 1):
+                current = self._page_type(text) or current
+                if current is not None and current != 'other':
+                    documents.setdefault(current, []).append(number)
+
+        if len(documents) == 1 and len(next(iter(documents.values()))) == len(pages):
+            return {doc_type: [] for doc_type in documents}
+
+        if documents:
+            return documents
+
+        doc_type = self.classify_name(file_name)
+        if doc_type is None:
+            raise TypeError(f"Unsupported file type: {file_name}")
+
+        return {doc_type: []}
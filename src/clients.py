@@ -0,0 +1,116 @@
+"""
+A module providing a process-wide registry of boto3 clients, created once from a
+single shared session with pooled keep-alive connections and adaptive retries.
+"""
+import os
+import threading
+from typing import Dict, Any, Optional
+
+import boto3
+from botocore.config import Config
+
+
+class ClientRegistry:
+    """
+    A thread-safe registry creating each boto3 client once per process and sharing it
+    between all S3, Textract and Bedrock instances. boto3 clients are thread-safe,
+    while sessions are not, so clients are created under a lock.
+    Attributes:
+        config (Dict[str, Any]): The client settings, with `default` botocore Config
+            options and per-service overrides in `services`.
+    Methods:
+        configure: Applies new client settings, dropping clients created with other settings.
+        get: Returns the shared client of a service, creating it on first use.
+        register: Registers a client (e.g. a stub) to be returned for a service.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.config: Dict[str, Any] = {}
+        self._session = None
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def configure(
+            self,
+            config: Optional[Dict[str, Any]],
+    ):
+        """
+        Applies new client settings, dropping clients created with other settings.
+        Reconfiguring with unchanged settings keeps the existing clients and their pools.
+        Args:
+            config (Optional[Dict[str, Any]]): The client settings.
+        """
+        config = config or {}
+        with self._lock:
+            if config != self.config:
+                self.config = config
+                self._clients = {}
+
+    def _client_config(
+            self,
+            service: str,
+    ) -> Config:
+        options = {
+            ** self.config.get('default', {}),
+            ** self.config.get('services', {}).get(service, {}),
+        }
+
+        return Config(** options)
+
+    def get(
+            self,
+            service: str,
+    ) -> Any:
+        """
+        Returns the shared client of a service, creating it on first use.
+        Args:
+            service (str): The name of the AWS service, e.g. 's3' or 'bedrock-runtime'.
+        Returns:
+            Any: The boto3 client.
+        """
+        with self._lock:
+            if service not in self._clients:
+                if self._session is None:
+                    self._session = boto3.Session(
+                        aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY'],
+                        region_name = os.environ['AWS_REGION'],
+                    )
+                self._clients[service] = self._session.client(
+                    service,
+                    config = self._client_config(service),
+                )
+
+            return self._clients[service]
+
+    def register(
+            self,
+            service: str,
+            client: Any,
+    ):
+        """
+        Registers a client to be returned for a service, e.g. a stub for testing.
+        Args:
+            service (str): The name of the AWS service.
+            client (Any): The client.
+        """
+        with self._lock:
+            self._clients[service] = client
+
+
+CLIENTS = ClientRegistry()
+
+
+def get_client(
+        service: str,
+) -> Any:
+    """
+    Returns the process-wide client of an AWS service.
+    Args:
+        service (str): The name of the AWS service, e.g. 's3' or 'bedrock-runtime'.
+    Returns:
+        Any: The boto3 client.
+    """
+    return CLIENTS.get(service)
@@ -0,0 +1,455 @@
+# pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+"""
+A module providing strategies for waiting on asynchronous AWS Textract jobs,
+either by adaptive polling or by consuming completion notifications
+published by Textract to an SNS topic and delivered to an SQS queue.
+"""
+import os
+import json
+import time
+import queue
+import uuid
+import logging
+import threading
+import statistics
+from collections import deque
+from typing import Dict, Any, Callable, Optional
+
+from src.clients import get_client
+from src.utils import fingerprint
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS")
+
+
+class AdaptivePoller:
+    """
+    Waits for a job by polling its status with exponential backoff, starting at
+    sub-second intervals. The first poll is delayed based on the durations of
+    previously observed jobs, so typical jobs are picked up shortly after they finish
+    without polling them throughout their whole run.
+    Attributes:
+        initial_interval (float): The first interval in seconds between status checks.
+        max_interval (float): The maximum interval in seconds between status checks.
+        backoff (float): The factor by which the interval grows after each check.
+        max_wait_seconds (float): The maximum time in seconds to wait for job completion.
+        durations (deque): The durations in seconds of recently completed jobs.
+        poll_count (int): The total number of status checks performed.
+    Methods:
+        notification_channel: Returns None, as polling needs no notification channel.
+        wait: Polls a job until it reaches a terminal status.
+    """
+
+    def __init__(
+            self,
+            initial_interval: float = 0.5,
+            max_interval: float = 5,
+            backoff: float = 1.5,
+            max_wait_seconds: float = 150,
+            history: int = 20,
+    ):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_wait_seconds = max_wait_seconds
+
+        self.durations = deque(maxlen = history)
+        self.poll_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def notification_channel(
+            self,
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the Textract NotificationChannel to start jobs with.
+        Returns:
+            Optional[Dict[str, str]]: None, as polling needs no notification channel.
+        """
+        return None
+
+    def _first_delay(
+            self,
+    ) -> float:
+        with self._lock:
+            if not self.durations:
+                return 0
+            # Undershoot the typical duration so that fast jobs are not overslept
+            return 0.8 * statistics.median(self.durations)
+
+    def wait(
+            self,
+            job_id: str,
+            poll: Callable[[], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """
+        Polls a job until it reaches a terminal status.
+        Args:
+            job_id (str): The ID of the job.
+            poll (Callable[[], Dict[str, Any]]): A function returning the current job response.
+        Returns:
+            Dict[str, Any]: The job response with a terminal status.
+        Raises:
+            TimeoutError: If the job does not complete within the maximum wait time.
+        """
+        start_time = time.time()
+        interval = self.initial_interval
+
+        time.sleep(self._first_delay())
+
+        while True:
+            result = poll()
+            with self._lock:
+                self.poll_count += 1
+
+            if result["JobStatus"] in TERMINAL_STATUSES:
+                with self._lock:
+                    self.durations.append(time.time() - start_time)
+                return result
+
+            if time.time() - start_time > self.max_wait_seconds:
+                raise TimeoutError(
+                    f"Job {job_id} did not complete within {self.max_wait_seconds} seconds."
+                )
+
+            time.sleep(interval)
+            interval = min(self.max_interval, interval * self.backoff)
+
+
+class FakeQueue:
+    """
+    An in-memory stand-in for an SQS queue subscribed to the Textract SNS topic,
+    implementing the subset of the SQS client API used by NotificationListener.
+    Methods:
+        publish: Publishes a Textract completion notification for a job.
+        send_message: Sends a raw message, e.g. one that is no Textract notification.
+        receive_message: Receives up to `MaxNumberOfMessages` messages, waiting up to
+            `WaitTimeSeconds` for the first one.
+        delete_message: Acknowledges a received message.
+        change_message_visibility: Returns a received message to the queue.
+    """
+
+    def __init__(
+            self,
+    ):
+        self._messages = queue.Queue()
+        self._received = {}
+
+    def publish(
+            self,
+            job_id: str,
+            status: str = "SUCCEEDED",
+    ):
+        """
+        Publishes a Textract completion notification for a job, wrapped in an SNS envelope.
+        Args:
+            job_id (str): The ID of the completed job.
+            status (str): The terminal status of the job.
+        """
+        self._messages.put({
+            'ReceiptHandle': str(uuid.uuid4()),
+            'Body': json.dumps({
+                'Type': 'Notification',
+                'Message': json.dumps({
+                    'JobId': job_id,
+                    'Status': status,
+                    'API': 'StartDocumentAnalysis',
+                }),
+            }),
+        })
+
+    def send_message(
+            self,
+            MessageBody: str,  # pylint: disable=invalid-name
+            **_,
+    ):
+        """
+        Sends a raw message, e.g. one that is no Textract notification.
+        """
+        self._messages.put({
+            'ReceiptHandle': str(uuid.uuid4()),
+            'Body': MessageBody,
+        })
+
+    def receive_message(
+            self,
+            MaxNumberOfMessages: int = 1,  # pylint: disable=invalid-name
+            WaitTimeSeconds: int = 0,  # pylint: disable=invalid-name
+            **_,
+    ) -> Dict[str, Any]:
+        """
+        Receives up to `MaxNumberOfMessages` messages, waiting up to `WaitTimeSeconds`
+        for the first one.
+        Returns:
+            Dict[str, Any]: A response in the shape of SQS ReceiveMessage.
+        """
+        messages = []
+        try:
+            messages.append(self._messages.get(timeout = WaitTimeSeconds or None))
+            while len(messages) < MaxNumberOfMessages:
+                messages.append(self._messages.get_nowait())
+        except queue.Empty:
+            pass
+
+        for message in messages:
+            self._received[message['ReceiptHandle']] = message
+
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(
+            self,
+            ReceiptHandle: str,  # pylint: disable=invalid-name
+            **_,
+    ):
+        """
+        Acknowledges a received message.
+        """
+        self._received.pop(ReceiptHandle, None)
+
+    def change_message_visibility(
+            self,
+            ReceiptHandle: str,  # pylint: disable=invalid-name
+            VisibilityTimeout: int = 0,  # pylint: disable=invalid-name
+            **_,
+    ):
+        """
+        Returns a received message to the queue after `VisibilityTimeout` seconds.
+        """
+        message = self._received.pop(ReceiptHandle, None)
+        if message is None:
+            return
+
+        if VisibilityTimeout > 0:
+            timer = threading.Timer(VisibilityTimeout, self._messages.put, (message,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._messages.put(message)
+
+
+class NotificationListener:
+    """
+    Waits for jobs by consuming the completion notifications Textract publishes to an
+    SNS topic subscribed by an SQS queue. A single background thread consumes the
+    queue for all in-flight jobs of the process and wakes up their waiters.
+    The queue may be shared by several processes (e.g. the app and its workers):
+    notifications of jobs not waited for by this process are returned to the queue
+    after `release_seconds` for the process waiting for them. Notifications nobody
+    waits for (e.g. of timed-out jobs) are left to the retention or the dead-letter
+    queue of the SQS queue.
+    Attributes:
+        sqs_client: The SQS client (or a FakeQueue) to receive notifications from.
+        queue_url (str): The URL of the SQS queue.
+        sns_topic_arn (str): The ARN of the SNS topic Textract publishes to.
+        role_arn (str): The ARN of the IAM role allowing Textract to publish to the topic.
+        max_wait_seconds (float): The maximum time in seconds to wait for job completion.
+        receive_wait_seconds (int): The long polling time of the queue in seconds.
+        release_seconds (int): The visibility timeout in seconds of the returned
+            notifications of jobs of other processes.
+    Methods:
+        notification_channel: Returns the Textract NotificationChannel to start jobs with.
+        wait: Waits for the completion notification of a job and returns its response.
+    """
+
+    def __init__(
+            self,
+            sqs_client: Any,
+            queue_url: str,
+            sns_topic_arn: str,
+            role_arn: str,
+            max_wait_seconds: float = 150,
+            receive_wait_seconds: int = 20,
+            release_seconds: int = 1,
+    ):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.sns_topic_arn = sns_topic_arn
+        self.role_arn = role_arn
+        self.max_wait_seconds = max_wait_seconds
+        self.receive_wait_seconds = receive_wait_seconds
+        self.release_seconds = release_seconds
+
+        self._lock = threading.Lock()
+        self._events: Dict[str, threading.Event] = {}
+        self._thread = None
+
+    @property
+    def notification_channel(
+            self,
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the Textract NotificationChannel to start jobs with.
+        Returns:
+            Optional[Dict[str, str]]: The SNS topic and the role Textract publishes with.
+        """
+        return {
+            'SNSTopicArn': self.sns_topic_arn,
+            'RoleArn': self.role_arn,
+        }
+
+    def _event(
+            self,
+            job_id: str,
+    ) -> Optional[threading.Event]:
+        with self._lock:
+            return self._events.get(job_id)
+
+    def _ensure_started(
+            self,
+    ):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target = self._listen,
+                    name = "textract-notification-listener",
+                    daemon = True,
+                )
+                self._thread.start()
+
+    def _listen(
+            self,
+    ):
+        while True:
+            try:
+                response = self.sqs_client.receive_message(
+                    QueueUrl = self.queue_url,
+                    MaxNumberOfMessages = 10,
+                    WaitTimeSeconds = self.receive_wait_seconds,
+                )
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to receive Textract notifications.")
+                time.sleep(1)
+                continue
+
+            for message in response.get('Messages', []):
+                try:
+                    self._handle(message)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    # E.g. an expired receipt handle; the message is received again
+                    logger.exception("Failed to handle a Textract notification.")
+
+    @staticmethod
+    def _job_id(
+            message: Dict[str, Any],
+    ) -> Optional[str]:
+        try:
+            body = json.loads(message['Body'])
+            notification = json.loads(body.get('Message', message['Body']))
+            job_id = notification['JobId']
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+        return job_id if isinstance(job_id, str) else None
+
+    def _handle(
+            self,
+            message: Dict[str, Any],
+    ):
+        """
+        Wakes up the waiter of the job a notification is about, returns notifications
+        of jobs not waited for to the queue and deletes messages that are no Textract
+        notifications (e.g. SNS subscription or test events).
+        """
+        job_id = self._job_id(message)
+        if job_id is None:
+            logger.warning(
+                "Deleting a message that is no Textract notification: %.200s",
+                message.get('Body'),
+            )
+            self.sqs_client.delete_message(
+                QueueUrl = self.queue_url,
+                ReceiptHandle = message['ReceiptHandle'],
+            )
+            return
+
+        event = self._event(job_id)
+        if event is None:
+            # A job of another process, or of this one finishing before its
+            # waiter registered: leave the notification to its waiter
+            self.sqs_client.change_message_visibility(
+                QueueUrl = self.queue_url,
+                ReceiptHandle = message['ReceiptHandle'],
+                VisibilityTimeout = self.release_seconds,
+            )
+            return
+
+        event.set()
+        self.sqs_client.delete_message(
+            QueueUrl = self.queue_url,
+            ReceiptHandle = message['ReceiptHandle'],
+        )
+
+    def wait(
+            self,
+            job_id: str,
+            poll: Callable[[], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """
+        Waits for the completion notification of a job and returns its response.
+        Args:
+            job_id (str): The ID of the job.
+            poll (Callable[[], Dict[str, Any]]): A function returning the current job response.
+        Returns:
+            Dict[str, Any]: The job response with a terminal status.
+        Raises:
+            TimeoutError: If no notification arrives within the maximum wait time.
+        """
+        with self._lock:
+            event = self._events.setdefault(job_id, threading.Event())
+        self._ensure_started()
+
+        try:
+            if not event.wait(self.max_wait_seconds):
+                raise TimeoutError(
+                    f"Job {job_id} did not complete within {self.max_wait_seconds} seconds."
+                )
+        finally:
+            with self._lock:
+                self._events.pop(job_id, None)
+
+        return poll()
+
+
+_STRATEGIES: Dict[str, Any] = {}
+_STRATEGIES_LOCK = threading.Lock()
+
+def build_completion(
+        config: Optional[Dict[str, Any]] = None,
+):
+    """
+    Returns the process-wide completion strategy for the given configuration,
+    so that all Textract instances share one poller history or one listener.
+    A changed configuration gets a new strategy.
+    Args:
+        config (Optional[Dict[str, Any]]): The completion configuration with the `mode`
+            (adaptive or notification) and the per-mode `adaptive` settings.
+    Returns:
+        The configured completion strategy.
+    """
+    config = config or {}
+    mode = config.get('mode', 'adaptive')
+    key = fingerprint(config)
+
+    with _STRATEGIES_LOCK:
+        if key in _STRATEGIES:
+            return _STRATEGIES[key]
+
+        if mode == 'adaptive':
+            strategy = AdaptivePoller(
+                ** config.get('adaptive', {}),
+            )
+        elif mode == 'notification':
+            strategy = NotificationListener(
+                sqs_client = get_client('sqs'),
+                queue_url = os.environ['TEXTRACT_SQS_QUEUE_URL'],
+                sns_topic_arn = os.environ['TEXTRACT_SNS_TOPIC_ARN'],
+                role_arn = os.environ['TEXTRACT_SNS_ROLE_ARN'],
+                ** config.get('notification', {}),
+            )
+        else:
+            raise ValueError(f"Unsupported completion mode: {mode}")
+
+        _STRATEGIES[key] = strategy
+
+    return strategy
@@ -0,0 +1,175 @@
+# pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+"""
+A module that shrinks Tavily search results before they are injected into an LLM prompt,
+keeping only their content fields, dropping near-duplicate snippets (MinHash over word
+shingles) and packing the most relevant results into a token budget.
+"""
+import zlib
+import logging
+import threading
+from typing import Dict, Any, List, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def estimate_tokens(
+        text: str,
+) -> int:
+    """
+    Estimates the number of LLM tokens of a text, assuming about four characters per token.
+    Args:
+        text (str): The text.
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(text) // 4
+
+
+class ScrapeCompressor:
+    """
+    Compresses a Tavily search response into a compact prompt snippet.
+    Results are ranked by their relevance score, near-duplicates are removed by comparing
+    MinHash signatures of their word shingles, and the remaining results are packed
+    greedily into the token budget.
+    Attributes:
+        fields (Sequence[str]): The result fields kept in the prompt.
+        max_tokens (int): The token budget of the compressed results.
+        similarity_threshold (float): The estimated Jaccard similarity above which
+            a result is considered a duplicate of a higher-ranked one.
+        shingle_size (int): The number of words per shingle.
+        metrics (Dict[str, int]): The numbers of compressed responses, estimated tokens
+            before and after compression and dropped duplicates.
+    Methods:
+        compress: Compresses a Tavily search response into a prompt snippet.
+    """
+
+    def __init__(
+            self,
+            fields: Sequence[str] = ('title', 'content'),
+            max_tokens: int = 4000,
+            similarity_threshold: float = 0.8,
+            num_perm: int = 64,
+            shingle_size: int = 5,
+            seed: int = 42,
+    ):
+        self.fields = fields
+        self.max_tokens = max_tokens
+        self.similarity_threshold = similarity_threshold
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 31, size = num_perm, dtype = np.uint64)
+        self._b = rng.integers(0, 1 << 31, size = num_perm, dtype = np.uint64)
+
+        self.metrics = {
+            'responses': 0,
+            'tokens_before': 0,
+            'tokens_after': 0,
+            'duplicates': 0,
+        }
+        self._lock = threading.Lock()
+
+    def _signature(
+            self,
+            text: str,
+    ) -> np.ndarray:
+        words = text.lower().split()
+        shingles = {
+            ' '.join(words[i:i + self.shingle_size])
+            for i in range(max(1, len(words) - self.shingle_size + 1))
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+            dtype = np.uint64,
+            count = len(shingles),
+        )
+
+        return (
+            (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MERSENNE_PRIME
+        ).min(axis = 1)
+
+    def _format_result(
+            self,
+            result: Dict[str, Any],
+    ) -> str:
+        return '\n'.join(
+            str(result[field]).strip()
+            for field in self.fields
+            if result.get(field)
+        )
+
+    def compress(
+            self,
+            scrape_response: Dict[str, Any],
+    ) -> Tuple[str, Dict[str, int]]:
+        """
+        Compresses a Tavily search response into a prompt snippet.
+        Args:
+            scrape_response (Dict[str, Any]): The response from the Tavily API.
+        Returns:
+            Tuple[str, Dict[str, int]]: The compressed results and the statistics
+                of the compression (results in and out, duplicates, tokens before,
+                after and saved).
+        """
+        results = sorted(
+            scrape_response.get('results', []),
+            key = lambda result: result.get('score', 0),
+            reverse = True,
+        )
+
+        kept: List[str] = []
+        signatures: List[np.ndarray] = []
+        duplicates = 0
+        tokens = 0
+
+        for result in results:
+            text = self._format_result(result)
+            if not text:
+                continue
+
+            signature = self._signature(text)
+            if any(
+                np.mean(signature == other) >= self.similarity_threshold
+                for other in signatures
+            ):
+                duplicates += 1
+                continue
+
+            result_tokens = estimate_tokens(text)
+            if tokens + result_tokens > self.max_tokens:
+                continue
+
+            kept.append(text)
+            signatures.append(signature)
+            tokens += result_tokens
+
+        compressed = '\n\n'.join(
+            f"[{i}] {text}" for i, text in enumerate(kept, start = 1)
+        )
+
+        stats = {
+            'results_in': len(results),
+            'results_out': len(kept),
+            'duplicates': duplicates,
+            'tokens_before': estimate_tokens(str(scrape_response)),
+            'tokens_after': estimate_tokens(compressed),
+        }
+        stats['tokens_saved'] = stats['tokens_before'] - stats['tokens_after']
+
+        with self._lock:
+            self.metrics['responses'] += 1
+            self.metrics['tokens_before'] += stats['tokens_before']
+            self.metrics['tokens_after'] += stats['tokens_after']
+            self.metrics['duplicates'] += duplicates
+
+        logger.info(
+            "Compressed %d scrape results to %d (%d duplicates), saving ~%d of %d tokens.",
+            stats['results_in'], stats['results_out'], duplicates,
+            stats['tokens_saved'], stats['tokens_before'],
+        )
+
+        return compressed, stats
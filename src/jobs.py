@@ -0,0 +1,565 @@
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+"""
+A module providing a durable job queue of company analyses, stored in a local SQLite
+database, and the worker running them, so that long-running OCR, web scraping and
+financial analyses are decoupled from the Streamlit script run: the UI submits a job
+per company and polls its results, which survive reruns, while worker processes
+(`worker.py`) run the jobs and scale independently of the web process.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from src.batch import LocalFile
+from src.pipeline import (
+    STAGES,
+    Pipeline,
+)
+from src.utils import (
+    file_digest,
+    fingerprint,
+)
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ('done', 'failed')
+
+
+class JobQueue:
+    """
+    A queue of company analyses stored in a SQLite database shared by the web and
+    the worker processes. The uploaded files of a job are spooled to a directory under
+    their content hash. A job is identified by its company and the content of its
+    files, so submitting the same files again returns the job already queued, running
+    or done. Running jobs are leased to their worker, and jobs whose worker stopped
+    renewing the lease (e.g. a crashed process) are handed to another worker.
+    Attributes:
+        path (str): The path to the SQLite database file.
+        spool_dir (Path): The directory holding the uploaded files of the jobs.
+        max_attempts (int): The number of times a job is started before it fails.
+        retention_seconds (float): The time in seconds finished jobs are kept.
+    Methods:
+        submit: Queues the analysis of a company, unless the same analysis is known.
+        claim: Leases the oldest runnable job to a worker.
+        heartbeat: Renews the lease of a running job.
+        save: Stores the result or the partial result of a stage of a job.
+        finish: Marks a job as done or failed.
+        get: Returns the status and the results of a job.
+        purge: Deletes the finished jobs past the retention time and their files.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            spool_dir: str,
+            max_attempts: int = 3,
+            retention_seconds: float = 86400,
+    ):
+        self.path = path
+        self.spool_dir = Path(spool_dir)
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+        self.spool_dir.mkdir(parents = True, exist_ok = True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path,
+            timeout = 30,
+            check_same_thread = False,
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, key TEXT NOT NULL, company_name TEXT NOT NULL, "
+                "files TEXT NOT NULL, status TEXT NOT NULL, "
+                "results TEXT NOT NULL DEFAULT '{}', partials TEXT NOT NULL DEFAULT '{}', "
+                "error TEXT, attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, "
+                "lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+
+    def _spool(
+            self,
+            file: Any,
+    ) -> Dict[str, str]:
+        """
+        Writes an uploaded file to the spool directory under its content hash.
+        Returns:
+            Dict[str, str]: The name of the uploaded file, its digest and its spooled path.
+        """
+        digest = file_digest(file)
+        path = self.spool_dir / f"{digest}.pdf"
+        if not path.exists():
+            position = file.tell()
+            file.seek(0)
+            temporary = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            temporary.write_bytes(file.read())
+            file.seek(position)
+            os.replace(temporary, path)
+
+        return {
+            'name': file.name,
+            'digest': digest,
+            'path': str(path),
+        }
+
+    def submit(
+            self,
+            company_name: str,
+            files: List[Any],
+    ) -> str:
+        """
+        Queues the analysis of a company, unless an analysis of the same company and
+        files is already queued, running or done.
+        Args:
+            company_name (str): The company name.
+            files (List[Any]): The uploaded PDF file objects of the company.
+        Returns:
+            str: The ID of the job.
+        """
+        spooled = [self._spool(file) for file in files]
+        key = fingerprint(
+            company_name,
+            sorted((file['name'], file['digest']) for file in spooled),
+        )
+
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT id FROM jobs WHERE key = ? AND status != 'failed' "
+                "ORDER BY created_at DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            if row:
+                return row[0]
+
+            job_id = uuid.uuid4().hex
+            self._connection.execute(
+                "INSERT INTO jobs (id, key, company_name, files, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, key, company_name, json.dumps(spooled, ensure_ascii = False), now, now),
+            )
+
+        return job_id
+
+    def claim(
+            self,
+            worker: str,
+            lease_seconds: float,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Leases the oldest queued job, or the oldest running job with an expired lease,
+        to a worker. Jobs with an expired lease and no attempts left fail.
+        Args:
+            worker (str): The ID of the worker.
+            lease_seconds (float): The duration of the lease in seconds.
+        Returns:
+            Optional[Dict[str, Any]]: The ID, company name and files of the job,
+                or None if no job is runnable.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET status = 'failed', updated_at = ?, "
+                "error = 'The job was abandoned by its workers.' "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = self._connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1, partials = '{}', updated_at = ? "
+                "WHERE id = ("
+                "SELECT id FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1"
+                ") RETURNING id, company_name, files, attempts",
+                (worker, now + lease_seconds, now, now),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'id': row[0],
+            'company_name': row[1],
+            'files': json.loads(row[2]),
+            'attempts': row[3],
+        }
+
+    def heartbeat(
+            self,
+            job_id: str,
+            worker: str,
+            lease_seconds: float,
+    ) -> bool:
+        """
+        Renews the lease of a running job.
+        Args:
+            job_id (str): The ID of the job.
+            worker (str): The ID of the worker holding the lease.
+            lease_seconds (float): The duration of the lease in seconds.
+        Returns:
+            bool: False if the job is no longer leased to the worker.
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET lease_until = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + lease_seconds, job_id, worker),
+            )
+
+        return cursor.rowcount > 0
+
+    def save(
+            self,
+            job_id: str,
+            worker: str,
+            stage: str,
+            result: Any,
+            partial: bool = False,
+    ) -> bool:
+        """
+        Stores the result of a stage of a running job, or its partial result while
+        it is generated, if the job is still leased to the worker.
+        Args:
+            job_id (str): The ID of the job.
+            worker (str): The ID of the worker holding the lease.
+            stage (str): The name of the stage (ocr_results, scrape_results, fin_results).
+            result (Any): The JSON-serializable result.
+            partial (bool): If True, the result is partial.
+        Returns:
+            bool: False if the job is no longer leased to the worker.
+        """
+        column = 'partials' if partial else 'results'
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                f"UPDATE jobs SET {column} = json_set({column}, '$.' || ?, json(?)), "
+                "updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (stage, json.dumps(result, ensure_ascii = False), time.time(), job_id, worker),
+            )
+
+        return cursor.rowcount > 0
+
+    def finish(
+            self,
+            job_id: str,
+            worker: str,
+            error: Optional[str] = None,
+    ) -> bool:
+        """
+        Marks a running job as done, or as failed with an error, if it is still leased
+        to the worker.
+        Args:
+            job_id (str): The ID of the job.
+            worker (str): The ID of the worker holding the lease.
+            error (Optional[str]): The error of a failed job.
+        Returns:
+            bool: False if the job is no longer leased to the worker.
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, partials = '{}', lease_until = NULL, "
+                "updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                ('failed' if error else 'done', error, time.time(), job_id, worker),
+            )
+
+        return cursor.rowcount > 0
+
+    def get(
+            self,
+            job_id: str,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Returns the status and the results of a job.
+        Args:
+            job_id (str): The ID of the job.
+        Returns:
+            Optional[Dict[str, Any]]: The ID, company name, status (queued, running, done,
+                failed), stage results, partial stage results, error and number of attempts
+                of the job, or None if the job is unknown.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, company_name, status, results, partials, error, attempts "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'id': row[0],
+            'company_name': row[1],
+            'status': row[2],
+            'results': json.loads(row[3]),
+            'partials': json.loads(row[4]),
+            'error': row[5],
+            'attempts': row[6],
+        }
+
+    def purge(
+            self,
+    ) -> int:
+        """
+        Deletes the finished jobs past the retention time and the spooled files
+        no longer referenced by any job.
+        Returns:
+            int: The number of deleted jobs.
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - self.retention_seconds,),
+            )
+            referenced = {
+                file['path']
+                for (files,) in self._connection.execute("SELECT files FROM jobs")
+                for file in json.loads(files)
+            }
+
+        # Files spooled after the query above are younger than the retention time
+        for path in self.spool_dir.glob('*.pdf'):
+            if (
+                    str(path) not in referenced
+                    and time.time() - path.stat().st_mtime > self.retention_seconds
+            ):
+                path.unlink(missing_ok = True)
+
+        return cursor.rowcount
+
+
+class Worker:
+    """
+    Runs the jobs of a queue through the pipeline, several jobs at a time, with
+    the number of files in OCR and of companies in the LLM stages bounded per stage
+    across all jobs of the worker. Stage results are saved as soon as they are
+    ready, and partial LLM responses while they are generated.
+    Attributes:
+        pipeline (Pipeline): The pipeline running the analyses.
+        queue (JobQueue): The job queue.
+        concurrency (Dict[str, int]): The maximum number of `jobs` running at the same
+            time and of files or companies in every stage.
+        lease_seconds (float): The duration of the lease of a running job in seconds.
+        poll_interval (float): The time in seconds between polls of an empty queue.
+        partial_interval (float): The minimum time in seconds between saves of
+            the partial results of a stage, or None to save no partial results.
+        worker_id (str): The ID of the worker.
+    Methods:
+        run: Runs jobs until stopped.
+    """
+
+    def __init__(
+            self,
+            pipeline: Pipeline,
+            queue: JobQueue,
+            config: Optional[Dict[str, Any]] = None,
+    ):
+        config = config or {}
+
+        self.pipeline = pipeline
+        self.queue = queue
+        self.concurrency = {
+            'jobs': 8,
+            'ocr_results': 8,
+            'scrape_results': 4,
+            'fin_results': 4,
+            ** config.get('concurrency', {}),
+        }
+        self.lease_seconds = config.get('lease_seconds', 60)
+        self.poll_interval = config.get('poll_interval', 1)
+        self.partial_interval = config.get('partial_interval', 0.5)
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    async def _heartbeat(
+            self,
+            job_id: str,
+            run: asyncio.Future,
+    ) -> bool:
+        """
+        Renews the lease of a running job until it finishes, and cancels the job
+        once the lease is lost (e.g. after it expired and another worker claimed the job).
+        Returns:
+            bool: True if the lease was lost.
+        """
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            renewed = await asyncio.to_thread(
+                self.queue.heartbeat, job_id, self.worker_id, self.lease_seconds,
+            )
+            if not renewed:
+                logger.warning("Job %s is no longer leased to %s.", job_id, self.worker_id)
+                run.cancel()
+                return True
+
+    async def _save_partial(
+            self,
+            job_id: str,
+            stage: str,
+            partial: Any,
+    ):
+        try:
+            await asyncio.to_thread(
+                self.queue.save, job_id, self.worker_id, stage, partial, True,
+            )
+        except sqlite3.Error:
+            logger.exception("Saving the partial %s of job %s failed.", stage, job_id)
+
+    @staticmethod
+    def _load_files(
+            job: Dict[str, Any],
+    ) -> List[LocalFile]:
+        files = []
+        for spooled in job['files']:
+            file = LocalFile(Path(spooled['path']))
+            file.name = spooled['name']
+            files.append(file)
+
+        return files
+
+    async def _run_job(
+            self,
+            job: Dict[str, Any],
+            limits: Dict[str, asyncio.Semaphore],
+    ):
+        # The queue is written from threads, so that a busy database does not stall
+        # the event loop and the other jobs of the worker
+        saves = []
+        partial_saves = {}
+        saved_at = {}
+
+        def on_done(_company_name, stage, result):
+            if stage in STAGES:
+                saves.append(asyncio.ensure_future(asyncio.to_thread(
+                    self.queue.save, job['id'], self.worker_id, stage, result,
+                )))
+
+        def on_delta(_company_name, stage, partial):
+            now = time.monotonic()
+            previous = partial_saves.get(stage)
+            # A partial result is skipped while the previous one of the stage is being saved
+            if previous is not None and not previous.done():
+                return
+            if now - saved_at.get(stage, 0) >= self.partial_interval:
+                saved_at[stage] = now
+                partial_saves[stage] = asyncio.ensure_future(
+                    self._save_partial(job['id'], stage, partial),
+                )
+
+        logger.info(
+            "Running job %s of %s (attempt %d).",
+            job['id'], job['company_name'], job['attempts'],
+        )
+        files = await asyncio.to_thread(self._load_files, job)
+        run = asyncio.ensure_future(self.pipeline.run(
+            files,
+            on_done = on_done,
+            on_delta = on_delta if self.partial_interval is not None else None,
+            limits = limits,
+        ))
+        heartbeat = asyncio.ensure_future(self._heartbeat(job['id'], run))
+        try:
+            results = await run
+            await asyncio.gather(*saves)
+            errors = [
+                f"{type(result['error']).__name__}: {result['error']}"
+                for result in results.values()
+                if 'error' in result
+            ]
+            await asyncio.to_thread(
+                self.queue.finish, job['id'], self.worker_id, '; '.join(errors) or None,
+            )
+
+        except asyncio.CancelledError:
+            # A job cancelled because its lease was lost belongs to another worker now
+            if not (heartbeat.done() and not heartbeat.cancelled() and heartbeat.result()):
+                raise
+
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.exception("Job %s failed.", job['id'])
+            await asyncio.gather(*saves, return_exceptions = True)
+            await asyncio.to_thread(
+                self.queue.finish, job['id'], self.worker_id, f"{type(e).__name__}: {e}",
+            )
+
+        finally:
+            heartbeat.cancel()
+
+    async def run(
+            self,
+            stop: Optional[asyncio.Event] = None,
+    ):
+        """
+        Claims and runs jobs until stopped, then waits for the running jobs to finish.
+        Finished jobs past the retention time are purged while the queue is empty.
+        Args:
+            stop (Optional[asyncio.Event]): An event stopping the worker once set.
+        """
+        stop = stop or asyncio.Event()
+        limits = {
+            stage: asyncio.Semaphore(self.concurrency[stage])
+            for stage in STAGES
+        }
+        slots = asyncio.Semaphore(self.concurrency['jobs'])
+        running = set()
+        purged_at = 0.0
+
+        while not stop.is_set():
+            await slots.acquire()
+            job = await asyncio.to_thread(self.queue.claim, self.worker_id, self.lease_seconds)
+
+            if job is None:
+                slots.release()
+                if time.monotonic() - purged_at > self.queue.retention_seconds / 24:
+                    purged_at = time.monotonic()
+                    await asyncio.to_thread(self.queue.purge)
+                try:
+                    await asyncio.wait_for(stop.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.ensure_future(self._run_job(job, limits))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+        await asyncio.gather(*running)
+
+
+def build_job_queue(
+        config: Optional[Dict[str, Any]],
+) -> Optional[JobQueue]:
+    """
+    Builds the job queue from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The job configuration with the `enabled` flag,
+            the `path` of the database, the `spool_dir` of the uploaded files,
+            the `max_attempts` and the `retention_seconds` of finished jobs.
+    Returns:
+        Optional[JobQueue]: The job queue, or None if jobs are disabled.
+    """
+    if not config or not config.get('enabled', True):
+        return None
+
+    return JobQueue(
+        config['path'],
+        config['spool_dir'],
+        config.get('max_attempts', 3),
+        config.get('retention_seconds', 86400),
+    )
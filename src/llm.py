@@ -2,10 +2,64 @@
 """
 A module that combines web scraping with LLM analysis using the Tavily API and AWS Bedrock.
 """
-import copy
-from typing import Dict, Any
+import json
+import asyncio
+from functools import partial
+from typing import Dict, Any, Iterable, Iterator, Optional
 from src.aws import Bedrock
+from src.compress import ScrapeCompressor
+from src.ratios import RatioEngine
+from src.scoring import FastPathScorer
+from src.singleflight import SINGLE_FLIGHT
+from src.cache import (
+    TTLCache,
+    build_cache,
+)
 from src.scraper import TavilyScraper
+from src.template import PayloadTemplate
+from src.tracing import TRACER
+from src.utils import (
+    fingerprint,
+    normalize_name,
+)
+
+
+def _iter_deltas(
+        events: Iterable[Dict[str, Any]],
+        delta_type: str,
+) -> Iterator[Any]:
+    """
+    Iterates over the content deltas of one type in a ConverseStream event stream.
+    Args:
+        events (Iterable[Dict[str, Any]]): The stream of response events.
+        delta_type (str): The type of the delta, 'text' or 'toolUse'.
+    Yields:
+        Any: The content deltas.
+    """
+    for event in events:
+        delta = event.get('contentBlockDelta', {}).get('delta', {})
+        if delta_type in delta:
+            yield delta[delta_type]
+
+
+def _parse_partial_json(
+        buffer: str,
+) -> Optional[Dict[str, Any]]:
+    """
+    Parses an incomplete JSON object of string fields, as streamed for tool use input,
+    by closing its last string and the object.
+    Args:
+        buffer (str): The JSON received so far.
+    Returns:
+        Optional[Dict[str, Any]]: The fields parsed so far, or None if not parseable yet.
+    """
+    for suffix in ('', '}', '"}'):
+        try:
+            return json.loads(buffer + suffix)
+        except json.JSONDecodeError:
+            continue
+
+    return None
 
 
 class LLMScraper(
@@ -19,24 +73,107 @@ class LLMScraper(
     Attributes:
         config (Dict[str, Any]): Configuration settings for the Tavily API and AWS Bedrock.
         payload (Dict[str, Any]): The base payload structure for the LLM request.
+        template (PayloadTemplate): The payload compiled for rendering.
+        cache (Optional[TTLCache]): The cache of Tavily responses and LLM summaries,
+            or None if caching is disabled.
+        compressor (Optional[ScrapeCompressor]): The stage shrinking the scraped data
+            before it is injected into the prompt, or None if disabled.
 
     Methods:
         _format_payload(company_name, scrape_response): Formats the payload for the LLM request
             by injecting the company name and scraped data.
+        scrape(company_name): Scrapes data for a given company name,
+            served from the cache if available.
+        summarize(company_name, scrape_response): Invokes the LLM
+            to summarize already scraped data, served from the cache if available.
+        summarize_async(company_name, scrape_response): Asynchronous version of `summarize`.
         analyze(company_name): Scrapes data for a given company name and invokes the LLM
             to analyze the scraped data.
+        analyze_async(company_name): Asynchronous version of `analyze`.
+        summarize_stream(company_name, scrape_response): Streaming version of `summarize`.
+        analyze_stream(company_name): Streaming version of `analyze`.
     """
     def __init__(
             self,
             config: Dict[str, Any],
             payload: Dict[str, Any],
+            cache_config: Optional[Dict[str, Any]] = None,
     ):
         self.config = config
-        self.payload = payload
+        self.payload = self.with_cache_points(payload)
+        self.template = PayloadTemplate(
+            self.payload,
+            placeholders = ('company_name', 'scrape_data'),
+        )
 
         TavilyScraper.__init__(self, config)
         Bedrock.__init__(self)
 
+        compression = dict(config.get('compression') or {'enabled': False})
+        self.compressor = (
+            ScrapeCompressor(** compression)
+            if compression.pop('enabled', True) else None
+        )
+
+        backend = build_cache(cache_config)
+        self.cache = (
+            TTLCache(
+                backend,
+                cache_config.get('ttl_seconds', 7 * 24 * 3600),
+                cache_config.get('stale_seconds', 0),
+            )
+            if backend is not None else None
+        )
+
+    def _scrape_key(
+            self,
+            company_name: str,
+    ) -> str:
+        return "tavily_" + fingerprint(
+            normalize_name(company_name),
+            self.config['url'],
+            self.config['payload'],
+        )
+
+    def _summary_key(
+            self,
+            company_name: str,
+            scrape_response: Dict[str, Any],
+    ) -> str:
+        return "summary_" + fingerprint(
+            normalize_name(company_name),
+            self.payload,
+            self.config.get('compression'),
+            scrape_response,
+        )
+
+    def scrape(
+            self,
+            company_name: str,
+    ):
+        """
+        Scrapes data for a given company name using the Tavily API, serving
+        the response from the cache while it has not expired. Concurrent scrapes
+        of the same company share one Tavily request.
+        Args:
+            company_name (str): The name of the company to query.
+        Returns:
+            Any: The parsed JSON response from the Tavily API.
+        """
+        key = self._scrape_key(company_name)
+        compute = partial(
+            SINGLE_FLIGHT.do,
+            key,
+            partial(TavilyScraper.scrape, self, company_name),
+        )
+        if self.cache is None:
+            return compute()
+
+        return self.cache.get_or_compute(
+            key,
+            compute,
+        )
+
 
     def _format_payload(
             self,
@@ -44,41 +181,103 @@ class LLMScraper(
             scrape_response: Dict[str, Any],
     ) -> Dict[str, Any]:
         """
-        Formats the payload for the LLM request by injecting the company name and scraped data.
+        Formats the payload for the LLM request by injecting the company name and scraped data,
+        compressed to its relevant content if the compression stage is enabled.
         Args:
             company_name (str): The name of the company to be analyzed.
             scrape_response (Dict[str, Any]): The response from the scraping process,
         Returns:
             Dict[str, Any]: A dictionary representing the formatted payload for the LLM request.
         """
-        formmatted_payload = copy.deepcopy(self.payload)
+        if self.compressor is not None:
+            scrape_data, _ = self.compressor.compress(scrape_response)
+        else:
+            scrape_data = str(scrape_response)
 
-        (
-            formmatted_payload
-            ['messages']
-            [0]
+        return self.template.render(
+            company_name = company_name,
+            scrape_data = scrape_data,
+        )
+
+
+    def _summarize(
+            self,
+            company_name: str,
+            scrape_response: Dict[str, Any],
+    ) -> str:
+        """
+        Invokes the LLM to summarize already scraped data about a company.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+            scrape_response (Dict[str, Any]): The response from the scraping process.
+        Returns:
+            str: The summary generated by the LLM.
+        """
+
+        payload = self._format_payload(
+            company_name,
+            scrape_response,
+        )
+
+        llm_response = self.invoke(payload)
+
+        return (
+            llm_response
+            ['output']
+            ['message']
             ['content']
-            [-1]
-            ['text']
-        ) = (
-            formmatted_payload
-            ['messages']
             [0]
-            ['content']
-            [-1]
             ['text']
-            .replace(
-                "<<company_name>>",
-                company_name,
-            )
-            .replace(
-                "<<scrape_data>>",
-                str(scrape_response),
-            )
         )
 
-        return formmatted_payload
+    def summarize(
+            self,
+            company_name: str,
+            scrape_response: Dict[str, Any],
+    ) -> str:
+        """
+        Invokes the LLM to summarize already scraped data about a company,
+        serving the summary from the cache while it has not expired.
+        Concurrent summaries of the same data share one Bedrock call.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+            scrape_response (Dict[str, Any]): The response from the scraping process.
+        Returns:
+            str: The summary generated by the LLM.
+        """
+        key = self._summary_key(company_name, scrape_response)
+        compute = partial(
+            SINGLE_FLIGHT.do,
+            key,
+            partial(self._summarize, company_name, scrape_response),
+        )
+        if self.cache is None:
+            return compute()
+
+        return self.cache.get_or_compute(
+            key,
+            compute,
+        )
 
+    async def summarize_async(
+            self,
+            company_name: str,
+            scrape_response: Dict[str, Any],
+    ) -> str:
+        """
+        Asynchronous version of `summarize`, running the blocking Bedrock call
+        in the default executor of the event loop.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+            scrape_response (Dict[str, Any]): The response from the scraping process.
+        Returns:
+            str: The summary generated by the LLM.
+        """
+        return await asyncio.to_thread(
+            self.summarize,
+            company_name,
+            scrape_response,
+        )
 
     def analyze(
             self,
@@ -94,20 +293,91 @@ class LLMScraper(
 
         scrape_response = self.scrape(company_name)
 
+        return self.summarize(
+            company_name,
+            scrape_response,
+        )
+
+    async def analyze_async(
+            self,
+            company_name: str,
+    ) -> Dict[str, Any]:
+        """
+        Asynchronous version of `analyze`, awaiting the Tavily and Bedrock calls
+        without blocking the event loop.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+        Returns:
+            Dict[str, Any]: The response from the LLM after analyzing the scraped data.
+        """
+
+        scrape_response = await self.scrape_async(company_name)
+
+        return await self.summarize_async(
+            company_name,
+            scrape_response,
+        )
+
+    def summarize_stream(
+            self,
+            company_name: str,
+            scrape_response: Dict[str, Any],
+    ) -> Iterator[str]:
+        """
+        Invokes the LLM to summarize already scraped data about a company,
+        yielding the summary text as it is generated. A cached summary, or the summary
+        of the same data being generated by a concurrent call, is yielded at once.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+            scrape_response (Dict[str, Any]): The response from the scraping process.
+        Yields:
+            str: The text deltas of the summary.
+        """
+        key = self._summary_key(company_name, scrape_response)
+        if self.cache is not None:
+            summary = self.cache.get(
+                key,
+                lambda: self._summarize(company_name, scrape_response),
+            )
+            if summary is not None:
+                yield summary
+                return
+
         payload = self._format_payload(
             company_name,
             scrape_response,
         )
 
-        llm_response = self.invoke(payload)
+        deltas = []
+        for delta in SINGLE_FLIGHT.stream(
+                key,
+                lambda: _iter_deltas(self.invoke_stream(payload), 'text'),
+                ''.join,
+        ):
+            deltas.append(delta)
+            yield delta
 
-        return (
-            llm_response
-            ['output']
-            ['message']
-            ['content']
-            [0]
-            ['text']
+        if self.cache is not None:
+            self.cache.set(key, ''.join(deltas))
+
+    def analyze_stream(
+            self,
+            company_name: str,
+    ) -> Iterator[str]:
+        """
+        Scrapes data for a given company name and invokes the LLM to analyze the scraped data,
+        yielding the summary text as it is generated.
+        Args:
+            company_name (str): The name of the company to be analyzed.
+        Yields:
+            str: The text deltas of the summary.
+        """
+
+        scrape_response = self.scrape(company_name)
+
+        yield from self.summarize_stream(
+            company_name,
+            scrape_response,
         )
 
 
@@ -118,19 +388,37 @@ class LLMFinAnalyzer(Bedrock):
         processing OCR results and LLM scrape results.
     Attributes:
         payload (Dict[str, Any]): The base payload structure for the LLM request.
+        template (PayloadTemplate): The payload compiled for rendering.
+        ratio_engine (Optional[RatioEngine]): The engine turning the OCR results into
+            parsed amounts and financial ratios for the prompt, or None to pass
+            the raw OCR results.
+        scorer (Optional[FastPathScorer]): The deterministic rules deciding clear-cut
+            companies without the LLM, or None to analyze every company with the LLM.
     Methods:
         _format_payload(ocr_results, llm_scrape_results): Formats the payload for the LLM request
             by injecting OCR results and LLM scrape results.
+        _fast_path(ocr_results): Decides a clear-cut company with the deterministic rules.
         analyze(ocr_results, llm_scrape_results): Analyzes financial data using OCR results and
-            LLM scrape results, returning the response from the LLM.
+            LLM scrape results, returning the response from the LLM (or from the
+            deterministic rules for clear-cut companies).
+        analyze_async(ocr_results, llm_scrape_results): Asynchronous version of `analyze`.
+        analyze_stream(ocr_results, llm_scrape_results): Streaming version of `analyze`.
     """
 
     def __init__(
             self,
             payload: Dict[str, Any],
+            ratio_engine: Optional[RatioEngine] = None,
+            scorer: Optional[FastPathScorer] = None,
     ):
 
-        self.payload = payload
+        self.payload = self.with_cache_points(payload)
+        self.template = PayloadTemplate(
+            self.payload,
+            placeholders = ('ocr_results', 'llm_scrape_results'),
+        )
+        self.ratio_engine = ratio_engine
+        self.scorer = scorer
         super().__init__()
 
 
@@ -141,43 +429,100 @@ class LLMFinAnalyzer(Bedrock):
     ) -> Dict[str, Any]:
         """
         Formats the payload for the LLM request by injecting OCR results and LLM scrape results.
+        If the ratio engine is enabled, the OCR results are replaced by the parsed amounts
+        and the financial ratios computed from them.
         Args:
             ocr_results (Dict[str, Any]): The results from OCR processing.
             llm_scrape_results (Dict[str, Any]): The results from LLM scraping.
         Returns:
             Dict[str, Any]: A dictionary representing the formatted payload for the LLM request.
         """
+        if self.ratio_engine is not None:
+            ocr_results = self.ratio_engine.render(ocr_results)
 
-        formmatted_payload = copy.deepcopy(self.payload)
+        return self.template.render(
+            ocr_results = ocr_results,
+            llm_scrape_results = llm_scrape_results,
+        )
 
-        for i, (placeholder, val) in enumerate(
-            {
-                '<<ocr_results>>': ocr_results,
-                '<<llm_scrape_results>>': llm_scrape_results,
-            }.items()
-        ):
-            (
-                formmatted_payload
-                ['messages']
-                [0]
+
+    def _fast_path(
+            self,
+            ocr_results: Any,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Decides a clear-cut company with the deterministic rules, if enabled, and counts
+        the decided and the borderline companies on the current span, so that the fraction
+        of financial analysis LLM calls avoided is exported by every entry point.
+        Args:
+            ocr_results (Any): The results from OCR processing.
+        Returns:
+            Optional[Dict[str, Any]]: The analysis in the format of the FinancialAnalyzer
+                tool, or None if the company has to be analyzed by the LLM.
+        """
+        if self.scorer is None:
+            return None
+
+        fast_results = self.scorer.analyze(ocr_results)
+        # The fraction of LLM calls avoided is decided / (decided + borderline)
+        if fast_results is not None:
+            TRACER.add(fast_path_decided = 1)
+        else:
+            TRACER.add(fast_path_borderline = 1)
+
+        return fast_results
+
+    def _analyze(
+            self,
+            payload: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Invokes the LLM with a formatted payload; concurrent calls with the same payload
+        share one Bedrock call.
+        Args:
+            payload (Dict[str, Any]): The formatted payload for the LLM request.
+        Returns:
+            Dict[str, Any]: The FinancialAnalyzer tool input generated by the LLM.
+        """
+
+        def _invoke():
+            llm_response = self.invoke(payload)
+
+            return (
+                llm_response
+                ['output']
+                ['message']
                 ['content']
-                [i]
-                ['text']
-            ) = (
-                formmatted_payload
-                ['messages']
                 [0]
-                ['content']
-                [i]
-                ['text']
-                .replace(
-                    placeholder,
-                    val if isinstance(val, str) else str(val),
-                )
+                ['toolUse']
+                ['input']
             )
 
-        return formmatted_payload
+        return SINGLE_FLIGHT.do(
+            "analysis_" + fingerprint(payload),
+            _invoke,
+        )
 
+    def _analyze_stream(
+            self,
+            payload: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Invokes the LLM with a formatted payload, assembling the FinancialAnalyzer
+        tool input incrementally as it is generated.
+        Args:
+            payload (Dict[str, Any]): The formatted payload for the LLM request.
+        Yields:
+            Dict[str, Any]: The tool input fields received so far; the last one is complete.
+        """
+        buffer = ''
+        for delta in _iter_deltas(self.invoke_stream(payload), 'toolUse'):
+            buffer += delta['input']
+            tool_input = _parse_partial_json(buffer)
+            if tool_input:
+                yield tool_input
+
+        yield json.loads(buffer)
 
     def analyze(
             self,
@@ -194,19 +539,74 @@ class LLMFinAnalyzer(Bedrock):
             Dict[str, Any]: The response from the LLM after analyzing the financial data.
         """
 
+        fast_results = self._fast_path(ocr_results)
+        if fast_results is not None:
+            return fast_results
+
         payload = self._format_payload(
             ocr_results,
             llm_scrape_results,
         )
 
-        llm_response = self.invoke(payload)
+        return self._analyze(payload)
 
-        return (
-            llm_response
-            ['output']
-            ['message']
-            ['content']
-            [0]
-            ['toolUse']
-            ['input']
+
+    async def analyze_async(
+            self,
+            ocr_results: Dict[str, Any],
+            llm_scrape_results: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Asynchronous version of `analyze`, awaiting the Bedrock call
+        without blocking the event loop.
+        Args:
+            ocr_results (Dict[str, Any]): The results from OCR processing.
+            llm_scrape_results (Dict[str, Any]): The results from LLM scraping.
+        Returns:
+            Dict[str, Any]: The response from the LLM after analyzing the financial data.
+        """
+
+        fast_results = self._fast_path(ocr_results)
+        if fast_results is not None:
+            return fast_results
+
+        payload = self._format_payload(
+            ocr_results,
+            llm_scrape_results,
+        )
+
+        return await asyncio.to_thread(
+            self._analyze,
+            payload,
+        )
+
+    def analyze_stream(
+            self,
+            ocr_results: Dict[str, Any],
+            llm_scrape_results: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Analyzes financial data using OCR results and LLM scrape results, assembling
+        the FinancialAnalyzer tool input incrementally as it is generated.
+        Args:
+            ocr_results (Dict[str, Any]): The results from OCR processing.
+            llm_scrape_results (Dict[str, Any]): The results from LLM scraping.
+        Yields:
+            Dict[str, Any]: The tool input fields received so far; the last one is complete.
+        """
+
+        fast_results = self._fast_path(ocr_results)
+        if fast_results is not None:
+            yield fast_results
+            return
+
+        payload = self._format_payload(
+            ocr_results,
+            llm_scrape_results,
+        )
+
+        yield from SINGLE_FLIGHT.stream(
+            "analysis_" + fingerprint(payload),
+            partial(self._analyze_stream, payload),
+            lambda tool_inputs: tool_inputs[-1],
         )
@@ -0,0 +1,159 @@
+# pylint: disable=too-few-public-methods
+"""
+A module that locates the pages of a PDF holding the rows asked for by Textract queries,
+so that Textract only processes those pages, either by restricting the queries and
+the adapter to them or by uploading a sub-document of just those pages.
+"""
+import io
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from pypdf import PdfReader, PdfWriter
+
+from src.utils import normalize_name
+from src.classify import page_ranges
+
+
+class PageLocator:
+    """
+    Finds the pages containing the row labels of query aliases in the PDF text layer.
+    Attributes:
+        labels (Dict[str, List[str]]): The normalized row labels per query alias.
+        split (bool): If True, `target` returns a sub-document of the located pages
+            instead of restricting the queries and the adapter to them.
+    Methods:
+        locate: Returns the pages of every query alias.
+        target: Returns the file to analyze, its queries and the adapter pages.
+    """
+
+    def __init__(
+            self,
+            labels: Dict[str, Iterable[str]],
+            split: bool = True,
+    ):
+        self.labels = {
+            alias: [normalize_name(label) for label in alias_labels]
+            for alias, alias_labels in labels.items()
+        }
+        self.split = split
+
+    def locate(
+            self,
+            texts: List[str],
+            pages: List[int],
+            aliases: Iterable[str],
+    ) -> Dict[str, List[int]]:
+        """
+        Returns the pages of the document containing a row label of every query alias.
+        Aliases without labels or without any matching page get all pages of the document.
+        Args:
+            texts (List[str]): The text layer of every page of the PDF.
+            pages (List[int]): The page numbers (1-based) of the document; empty for all.
+            aliases (Iterable[str]): The query aliases.
+        Returns:
+            Dict[str, List[int]]: The page numbers by alias, or an empty dictionary
+                if the PDF has no text layer.
+        """
+        if not any(text.strip() for text in texts):
+            return {}
+
+        candidates = pages or list(range(1, len(texts) + 1))
+        normalized = {
+            page: f" {normalize_name(texts[page - 1])} "
+            for page in candidates
+        }
+
+        return {
+            alias: [
+                page for page in candidates
+                if any(f" {label} " in normalized[page] for label in self.labels.get(alias, []))
+            ] or candidates
+            for alias in aliases
+        }
+
+    def target(
+            self,
+            file: Any,
+            texts: List[str],
+            pages: List[int],
+            queries: List[Dict[str, Any]],
+    ) -> Tuple[Any, List[Dict[str, Any]], List[int]]:
+        """
+        Targets the queries of a document at the pages holding their rows.
+        Args:
+            file: The PDF file object.
+            texts (List[str]): The text layer of every page of the PDF.
+            pages (List[int]): The page numbers (1-based) of the document; empty for all.
+            queries (List[Dict[str, Any]]): The Textract queries of the document.
+        Returns:
+            Tuple[Any, List[Dict[str, Any]], List[int]]: The file to analyze (the PDF
+                or a sub-document of the located pages), the queries with their pages
+                in that file and the pages of the adapter (empty for all pages).
+        """
+        located = self.locate(texts, pages, [query['Alias'] for query in queries])
+        if not located:
+            return file, queries, pages
+
+        selected = sorted(set().union(* located.values()))
+        number: Dict[int, int] = {page: page for page in selected}
+        target_file = file
+        if self.split and len(selected) < len(texts):
+            number = {page: new for new, page in enumerate(selected, start = 1)}
+            target_file = self._sub_document(file, selected)
+            selected = []
+
+        return (
+            target_file,
+            [
+                {** query, 'Pages': page_ranges([number[page] for page in located[query['Alias']]])}
+                for query in queries
+            ],
+            selected,
+        )
+
+    @staticmethod
+    def _sub_document(
+            file: Any,
+            pages: List[int],
+    ) -> io.BytesIO:
+        """
+        Builds a PDF of the given pages of a PDF and rewinds the source file.
+        Args:
+            file: The PDF file object.
+            pages (List[int]): The page numbers (1-based) to keep.
+        Returns:
+            io.BytesIO: The sub-document, named like the source file.
+        """
+        position = file.tell()
+        reader = PdfReader(file)
+        writer = PdfWriter()
+        for page in pages:
+            writer.add_page(reader.pages[page - 1])
+
+        sub_document = io.BytesIO()
+        writer.write(sub_document)
+        file.seek(position)
+
+        sub_document.seek(0)
+        sub_document.name = file.name
+
+        return sub_document
+
+
+def build_locator(
+        config: Optional[Dict[str, Any]],
+) -> Optional[PageLocator]:
+    """
+    Builds the page locator from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The page targeting configuration with
+            the `enabled` and `split` flags and the row `labels` per query alias.
+    Returns:
+        Optional[PageLocator]: The page locator, or None if it is disabled.
+    """
+    config = dict(config or {'enabled': False})
+    if not config.pop('enabled', True) or not config.get('labels'):
+        return None
+
+    return PageLocator(
+        ** config,
+    )
@@ -1,4 +1,4 @@
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
 """
 This module provides functionality to perform OCR on financial documents
 using AWS Textract and S3 for storage. It extracts relevant information from
@@ -6,15 +6,36 @@ PDF files, such as balance sheets and profit and loss statements, and
 uploads them to an S3 bucket for further processing.
 """
 import os
+import re
 import uuid
 import json
+from functools import partial
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 from src.aws import (
     S3,
     Textract,
 )
+from src.cache import build_cache
+from src.locate import build_locator
+from src.textlayer import build_text_layer
+from src.singleflight import SINGLE_FLIGHT
+from src.classify import (
+    DocumentClassifier,
+    page_ranges,
+)
+from src.store import build_store
+from src.tracing import TRACER, traced
+from src.utils import (
+    file_digest,
+    fingerprint,
+)
+
+ADAPTER_ID_VARIABLES = {
+    'balance_sheet': 'TEXTRACT_ADAPTER_BALANCE_SHEET_ID',
+    'profit_loss': 'TEXTRACT_ADAPTER_PROFIT_LOSS_ID',
+}
 
 class OCR:
     """
@@ -25,21 +46,91 @@ class OCR:
         config (Dict[str, Any]): Configuration settings for the OCR process.
         s3 (S3): An instance of the S3 class for uploading files.
         textract (Textract): An instance of the Textract class for document analysis.
+        cache: A content-addressed cache of OCR results, or None if caching is disabled.
+        store (FinStore): The multi-year store of extracted metrics, or None if disabled.
+        reuse_stored (bool): If True, documents already in the store are not processed again.
+        classifier (DocumentClassifier): The local classifier of document types.
+        locator (PageLocator): The locator targeting the queries at the pages holding
+            their rows, or None if page targeting is disabled.
+        text_layer (TextLayerExtractor): The extractor answering the queries from the text
+            layer of digitally generated PDFs, or None if it is disabled.
 
     Methods:
+        get_company_name: Derives the company name from the PDF file name.
+        get_fiscal_year: Derives the fiscal year from the PDF file name.
         _get_pdf_attrs: Extracts attributes from the uploaded PDF file.
+        classify: Determines the document types of the PDF file and their pages locally.
+        _get_adapter_id: Returns the ID of the Textract adapter of a document type.
+        _get_queries: Returns the Textract queries of a document type for its pages.
+        _cache_key: Builds the cache key of the OCR results for a file.
+        _run_textract: Uploads the PDF file to S3 and extracts its text using AWS Textract.
+        _run_textract_cached: Serves the OCR results of a file from the cache or Textract.
         extract: Processes the uploaded PDF file, uploads it to S3, and extracts
                  text using AWS Textract based on the document type.
+        extract_all: Extracts every document (document type) of the uploaded PDF file.
     """
 
+    adapter_version = '1'
+
     def __init__(
             self,
             config: Dict[str, Any],
+            cache_config: Optional[Dict[str, Any]] = None,
+            textract_config: Optional[Dict[str, Any]] = None,
+            store_config: Optional[Dict[str, Any]] = None,
+            classifier_config: Optional[Dict[str, Any]] = None,
+            locator_config: Optional[Dict[str, Any]] = None,
+            text_layer_config: Optional[Dict[str, Any]] = None,
+            s3_config: Optional[Dict[str, Any]] = None,
     ):
         self.config = config
 
-        self.s3 = S3()
-        self.textract = Textract()
+        self.s3 = S3(s3_config)
+        self.textract = Textract(textract_config)
+        self.cache = build_cache(
+            cache_config,
+            self.s3.s3_client,
+        )
+        self.store = build_store(
+            store_config,
+            config,
+        )
+        self.reuse_stored = bool((store_config or {}).get('reuse_stored', True))
+        self.classifier = DocumentClassifier(
+            ** (classifier_config or {}),
+        )
+        self.locator = build_locator(locator_config)
+        self.text_layer = build_text_layer(text_layer_config)
+
+    @staticmethod
+    def get_company_name(
+            file_name: str,
+    ) -> str:
+        """
+        Derives the company name from the PDF file name, which is expected
+        to start with the company name followed by an underscore.
+        Args:
+            file_name (str): The name of the uploaded PDF file.
+        Returns:
+            str: The company name.
+        """
+        return file_name.split('_')[0]
+
+    @staticmethod
+    def get_fiscal_year(
+            file_name: str,
+    ) -> Optional[int]:
+        """
+        Derives the fiscal year from the PDF file name, i.e. the first four-digit
+        year (19xx or 20xx) found in it.
+        Args:
+            file_name (str): The name of the uploaded PDF file.
+        Returns:
+            Optional[int]: The fiscal year, or None if the file name contains no year.
+        """
+        match = re.search(r'(?<!\d)(?:19|20)\d{2}(?!\d)', file_name)
+
+        return int(match.group()) if match else None
 
     def _get_pdf_attrs(
             self,
@@ -57,7 +148,7 @@ class OCR:
         """
         file_id = str(uuid.uuid4())
         file_name = file.name
-        company_name = file_name.split('_')[0]
+        company_name = self.get_company_name(file_name)
         filename_id = f"inputs/{file_id}_{file_name}"
 
         return {
@@ -67,74 +158,137 @@ class OCR:
             'filename_id': filename_id,
         }
 
-    def extract(
+    def classify(
             self,
             file: Any,
-            export_results: bool = True,
-    ) -> Dict[str, Any]:
+    ) -> Dict[str, List[int]]:
         """
-        Processes the uploaded PDF file, uploads it to S3, and extracts text
-        using AWS Textract based on the document type (balance sheet or profit and loss statement).
+        Determines the document types of the uploaded PDF file and their pages locally,
+        from the text layer of the PDF or from its file name.
         Args:
             file: The uploaded PDF file object.
+        Returns:
+            Dict[str, List[int]]: The page numbers (1-based) by document type;
+                an empty list stands for all pages.
+        Raises:
+            TypeError: If the document type cannot be determined.
+        """
+        return self.classifier.classify(
+            file.name,
+            self.classifier.read_pages(file),
+        )
+
+    @staticmethod
+    def _get_adapter_id(
+            doc_type: str,
+    ) -> str:
+        """
+        Returns the ID of the Textract adapter of a document type.
+        Args:
+            doc_type (str): The document type.
+        Returns:
+            str: The ID of the Textract adapter.
+        """
+        return os.environ[ADAPTER_ID_VARIABLES[doc_type]]
+
+    def _get_queries(
+            self,
+            doc_type: str,
+            pages: List[int],
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the Textract queries of a document type, restricted to the given pages.
+        Args:
+            doc_type (str): The document type.
+            pages (List[int]): The page numbers of the document; empty for all pages.
+        Returns:
+            List[Dict[str, Any]]: The Textract queries.
+        """
+        if not pages:
+            return self.config[doc_type]
+
+        return [
+            {** query, 'Pages': page_ranges(pages)}
+            for query in self.config[doc_type]
+        ]
+
+    def _cache_key(
+            self,
+            digest: str,
+            adapter_id: str,
+            queries: List[Dict[str, Any]],
+    ) -> str:
+        """
+        Builds the cache key of the OCR results for a file from the hash of its content,
+        the Textract adapter and the queries (including their pages).
+        Args:
+            digest (str): The SHA-256 digest of the file content.
+            adapter_id (str): The ID of the Textract adapter.
+            queries (List[Dict[str, Any]]): The Textract queries.
+        Returns:
+            str: The cache key.
+        """
+        return fingerprint(
+            digest,
+            adapter_id,
+            self.adapter_version,
+            queries,
+        )
+
+    def _run_textract(
+            self,
+            file: Any,
+            attrs: Dict[str, str],
+            queries: List[Dict[str, Any]],
+            adapter_id: str,
+            pages: List[int],
+            texts: List[str],
+            export_results: bool,
+            digest: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """
+        Uploads the PDF file to S3, extracts its text using AWS Textract
+        and optionally exports the OCR results to S3. With page targeting enabled,
+        the queries are targeted at the pages holding their rows first.
+        Args:
+            file: The uploaded PDF file object.
+            attrs (Dict[str, str]): The attributes of the PDF file.
+            queries (List[Dict[str, Any]]): The Textract queries for the document type.
+            adapter_id (str): The ID of the Textract adapter.
+            pages (List[int]): The page numbers of the document; empty for all pages.
+            texts (List[str]): The text layer of every page of the PDF.
             export_results (bool): If True, exports the OCR results to S3.
+            digest (Optional[str]): The SHA-256 digest of the file content, if already known.
         Returns:
-            Dict[str, Any]: A dictionary containing the document type, company name,
-                            file ID, and OCR results.
+            Dict[str, str]: A dictionary mapping query texts to their corresponding results.
         """
-        attrs = self._get_pdf_attrs(file)
+        if self.locator is not None:
+            target_file, queries, pages = self.locator.target(file, texts, pages, queries)
+            if target_file is not file:
+                file, digest = target_file, None
 
-        self.s3.upload(
+        file_name = self.s3.upload(
             file,
             os.environ["S3_BUCKET_NAME"],
             attrs['filename_id'],
+            digest,
         )
 
-        # rozvaha (CZ) = balance sheet (EN)
-        if any(
-            keyword in attrs['file_name'].lower() for keyword in
-            [
-                'rozvaha',
-                'balancesheet',
-                'bsheet',
-                'balance_sheet',
-            ]
-        ):
-            adapter_id = os.environ["TEXTRACT_ADAPTER_BALANCE_SHEET_ID"]
-            doc_type = "balance_sheet"
-            queries = self.config[doc_type]
-
-        # vysledovka (CZ) = profit and loss statement (EN)
-        elif any(
-            keyword in attrs['file_name'].lower() for keyword in
-            [
-                'vysledovka',
-                'income_statement',
-                'incomestatement',
-                'profit_loss',
-                'profitandloss',
-                'profit_and_loss'
-                '_pnl_',
-                '_pl_',
-            ]
-        ):
-            adapter_id = os.environ["TEXTRACT_ADAPTER_PROFIT_LOSS_ID"]
-            doc_type = "profit_loss"
-            queries = self.config[doc_type]
-
-        else:
-            raise TypeError(f"Unsupported file type: {attrs['file_name']}")
-
         ocr_results = self.textract.extract(
-            file_name = attrs['filename_id'],
+            file_name = file_name,
             queries = queries,
             adapter_id = adapter_id,
+            version = self.adapter_version,
+            pages = page_ranges(pages),
         )
 
         if export_results:
             self.s3.s3_client.put_object(
                 Bucket = os.environ["S3_BUCKET_NAME"],
-                Key = f"raw_analysis/analysis_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
+                Key = (
+                    f"raw_analysis/analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                    f"_{attrs['file_id']}.json"
+                ),
                 Body = json.dumps(
                     ocr_results,
                     ensure_ascii = False,
@@ -142,9 +296,168 @@ class OCR:
                 ContentType = "application/json",
             )
 
+        return ocr_results
+
+    def _run_textract_cached(
+            self,
+            cache_key: str,
+            *args: Any,
+    ) -> Dict[str, str]:
+        """
+        Serves the OCR results of a file from the cache, running `_run_textract`
+        and caching its results if they are not cached.
+        Args:
+            cache_key (str): The cache key of the OCR results.
+            *args: The arguments of `_run_textract`.
+        Returns:
+            Dict[str, str]: A dictionary mapping query texts to their corresponding results.
+        """
+        if self.cache is None:
+            return self._run_textract(*args)
+
+        ocr_results = self.cache.get(cache_key)
+        if ocr_results is None:
+            ocr_results = self._run_textract(*args)
+            self.cache.set(cache_key, ocr_results)
+
+        return ocr_results
+
+    @traced(
+        'ocr.extract',
+        lambda self, file, *args, **kwargs: {'file_name': file.name},
+    )
+    def extract(
+            self,
+            file: Any,
+            export_results: bool = True,
+            doc_type: Optional[str] = None,
+            pages: Optional[List[int]] = None,
+            texts: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Processes the uploaded PDF file, uploads it to S3, and extracts text
+        using AWS Textract based on the document type (balance sheet or profit and loss statement).
+        The document type is determined locally before anything is uploaded, so
+        unsupported files are rejected without any AWS call. With page targeting enabled,
+        Textract only processes the pages holding the rows of the queries.
+        Results of documents already in the store (same company, fiscal year, document
+        type and file content, with all queries answered) and of previously processed
+        files are served from the store and the cache without uploading the file or
+        starting a Textract job, and so are the answers found in the text layer of
+        digitally generated PDFs. Concurrent extractions of the same content share one
+        upload and Textract job. New results are added to the store.
+        Args:
+            file: The uploaded PDF file object.
+            export_results (bool): If True, exports the OCR results to S3.
+            doc_type (Optional[str]): The document type, classified if None.
+            pages (Optional[List[int]]): The page numbers of the document (1-based),
+                all pages if None or empty.
+            texts (Optional[List[str]]): The text layer of every page, read if None.
+        Returns:
+            Dict[str, Any]: A dictionary containing the document type, company name,
+                            fiscal year (None if unknown), file ID, and OCR results.
+        Raises:
+            TypeError: If the document type cannot be determined.
+            ValueError: If the file contains several documents; use `extract_all`.
+        """
+        if texts is None:
+            texts = self.classifier.read_pages(file)
+
+        if doc_type is None:
+            documents = self.classifier.classify(file.name, texts)
+            if len(documents) > 1:
+                raise ValueError(
+                    f"{file.name} contains several documents ({', '.join(documents)}), "
+                    "use extract_all."
+                )
+            (doc_type, pages), = documents.items()
+
+        pages = pages or []
+        attrs = self._get_pdf_attrs(file)
+        TRACER.correlate(
+            company = attrs['company_name'],
+            file_id = attrs['file_id'],
+            doc_type = doc_type,
+        )
+        adapter_id = self._get_adapter_id(doc_type)
+        queries = self._get_queries(doc_type, pages)
+        fiscal_year = self.get_fiscal_year(attrs['file_name'])
+
+        digest = file_digest(file)
+
+        ocr_results = None
+        if self.store is not None and self.reuse_stored and fiscal_year is not None:
+            ocr_results = self.store.get(attrs['company_name'], fiscal_year, doc_type, digest)
+            # Partial results (e.g. from the text layer) are extracted again
+            if ocr_results is not None and any(q['Text'] not in ocr_results for q in queries):
+                ocr_results = None
+        from_store = ocr_results is not None
+
+        if ocr_results is None and self.text_layer is not None:
+            ocr_results = self.text_layer.extract(texts, pages, queries)
+
+        if ocr_results is None:
+            cache_key = self._cache_key(digest, adapter_id, queries)
+            ocr_results = SINGLE_FLIGHT.do(
+                "ocr_" + cache_key,
+                partial(
+                    self._run_textract_cached,
+                    cache_key,
+                    file,
+                    attrs,
+                    queries,
+                    adapter_id,
+                    pages,
+                    texts,
+                    export_results,
+                    digest,
+                ),
+            )
+
+        if self.store is not None and not from_store and fiscal_year is not None:
+            self.store.put(
+                attrs['company_name'],
+                fiscal_year,
+                doc_type,
+                attrs['file_id'],
+                ocr_results,
+                digest,
+            )
+
         return {
             'doc_type': doc_type,
             'company_name': attrs['company_name'],
+            'fiscal_year': fiscal_year,
             'file_id': attrs['file_id'],
             'ocr_results': ocr_results,
         }
+
+    def extract_all(
+            self,
+            file: Any,
+            export_results: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """
+        Classifies the uploaded PDF file and extracts every document it contains,
+        e.g. both the balance sheet and the profit and loss statement of a combined PDF,
+        each with its own Textract adapter and pages.
+        Args:
+            file: The uploaded PDF file object.
+            export_results (bool): If True, exports the OCR results to S3.
+        Returns:
+            List[Dict[str, Any]]: The results of `extract` for every document.
+        Raises:
+            TypeError: If the document type cannot be determined.
+        """
+        texts = self.classifier.read_pages(file)
+
+        return [
+            self.extract(
+                file,
+                export_results,
+                doc_type,
+                pages,
+                texts,
+            )
+            for doc_type, pages in self.classifier.classify(file.name, texts).items()
+        ]
@@ -0,0 +1,385 @@
+# pylint: disable=too-few-public-methods,too-many-arguments,too-many-positional-arguments
+"""
+A module that runs the OCR -> web scraping -> financial analysis flow as an asyncio DAG,
+so that every stage starts as soon as its own inputs are ready.
+"""
+import asyncio
+import logging
+import itertools
+from contextlib import nullcontext
+from typing import Dict, Any, List, Callable, Awaitable, Iterator, Optional
+
+from src.ocr import OCR
+from src.clients import CLIENTS
+from src.ratelimit import RATE_LIMITER
+from src.tracing import TRACER
+from src.singleflight import SINGLE_FLIGHT
+from src.ratios import build_ratio_engine
+from src.scoring import build_scorer
+from src.llm import (
+    LLMScraper,
+    LLMFinAnalyzer,
+)
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('ocr_results', 'scrape_results', 'fin_results')
+
+
+class Dag:
+    """
+    A directed acyclic graph of asynchronous tasks, where each node is started
+    as soon as all of the nodes it depends on have finished.
+    Attributes:
+        nodes (Dict[str, Any]): The nodes of the graph, mapping a node name
+            to its coroutine function and the names of its dependencies.
+    Methods:
+        add: Adds a node to the graph.
+        run: Runs all nodes of the graph and returns their results.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.nodes = {}
+
+    def add(
+            self,
+            name: str,
+            func: Callable[..., Awaitable[Any]],
+            *deps: str,
+    ) -> 'Dag':
+        """
+        Adds a node to the graph.
+        Args:
+            name (str): The name of the node.
+            func (Callable[..., Awaitable[Any]]): The coroutine function of the node,
+                called with the results of its dependencies in the given order.
+            *deps (str): The names of the nodes or inputs the node depends on.
+        Returns:
+            Dag: The graph itself, for chaining.
+        """
+        self.nodes[name] = (func, deps)
+
+        return self
+
+    async def run(
+            self,
+            on_done: Optional[Callable[[str, Any], None]] = None,
+            **inputs: Any,
+    ) -> Dict[str, Any]:
+        """
+        Runs all nodes of the graph and returns their results. If a node fails,
+        the nodes still running are cancelled and its exception is raised.
+        Args:
+            on_done (Optional[Callable[[str, Any], None]]): A callback invoked on the
+                event loop with the name and the result of every node once it finishes.
+            **inputs (Any): The values of the graph inputs, referenced by name in
+                the node dependencies.
+        Returns:
+            Dict[str, Any]: The inputs and the results of all nodes, by name.
+        """
+        loop = asyncio.get_running_loop()
+        tasks: Dict[str, asyncio.Future] = {}
+
+        for name, value in inputs.items():
+            tasks[name] = loop.create_future()
+            tasks[name].set_result(value)
+
+        async def _run(name):
+            func, deps = self.nodes[name]
+            args = [await tasks[dep] for dep in deps]
+            result = await func(*args)
+            if on_done is not None:
+                on_done(name, result)
+            return result
+
+        for name in self.nodes:
+            tasks[name] = asyncio.ensure_future(_run(name))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            # The other nodes of a failed or cancelled graph are not left running
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions = True)
+            raise
+
+        return {
+            name: task.result()
+            for name, task in tasks.items()
+        }
+
+
+class Pipeline:
+    """
+    Runs OCR of the uploaded files, web scraping of the companies and the financial
+    analyses concurrently. Files are grouped by the company name derived from their
+    file names, and every company runs through its own graph of stages: web scraping
+    starts right away, and the financial analysis starts once both the OCR and
+    the web scraping results of the company are ready. The number of companies
+    in the LLM stages at the same time is bounded.
+    Attributes:
+        ocr (OCR): An instance of the OCR class for text extraction from PDFs.
+        scraper (LLMScraper): An instance of the LLMScraper class for web scraping.
+        fin_analyzer (LLMFinAnalyzer): An instance of
+            the LLMFinAnalyzer class for financial analysis.
+        max_concurrent_companies (int): The maximum number of companies
+            in the LLM stages at the same time.
+        dag (Dag): The graph of the pipeline stages of one company.
+    Methods:
+        from_config: Builds the pipeline and its components from the app configuration.
+        group_files: Groups the uploaded files by company name.
+        run: Runs the pipeline for the uploaded files.
+    """
+
+    def __init__(
+            self,
+            ocr: OCR,
+            scraper: LLMScraper,
+            fin_analyzer: LLMFinAnalyzer,
+            max_concurrent_companies: int = 8,
+    ):
+        self.ocr = ocr
+        self.scraper = scraper
+        self.fin_analyzer = fin_analyzer
+        self.max_concurrent_companies = max_concurrent_companies
+
+        self.dag = (
+            Dag()
+            .add('ocr_results', self._ocr, 'files', 'limits')
+            .add('scrape_results', self._scrape, 'company_name', 'limits', 'on_delta')
+            .add(
+                'fin_results', self._fin_analyze,
+                'ocr_results', 'scrape_results', 'limits', 'on_delta',
+            )
+        )
+
+    @classmethod
+    def from_config(
+            cls,
+            config: Dict[str, Any],
+    ) -> 'Pipeline':
+        """
+        Builds the pipeline and its components from the app configuration
+        and applies the process-wide client settings and rate limits.
+        Args:
+            config (Dict[str, Any]): Configuration dictionary containing OCR, LLM, scraper,
+                classifier, page targeting, text layer, row label, ratio, scoring, cache,
+                store, AWS, rate limit, tracing and pipeline settings.
+        Returns:
+            Pipeline: The pipeline with new OCR, LLMScraper and LLMFinAnalyzer instances.
+        """
+        CLIENTS.configure(config.get('aws', {}).get('clients'))
+        RATE_LIMITER.configure(config.get('rate_limits'))
+        TRACER.configure(config.get('tracing'))
+        SINGLE_FLIGHT.configure(config.get('singleflight'))
+
+        ratio_engine = build_ratio_engine(
+            config.get('ratios'),
+            config['ocr'],
+        )
+
+        return cls(
+            OCR(
+                config['ocr'],
+                config.get('cache', {}).get('ocr'),
+                config.get('aws', {}).get('textract'),
+                config.get('store'),
+                config.get('classifier'),
+                {
+                    ** (config.get('pages') or {'enabled': False}),
+                    'labels': config.get('labels'),
+                },
+                {
+                    ** (config.get('textlayer') or {'enabled': False}),
+                    'labels': config.get('labels'),
+                },
+                config.get('aws', {}).get('s3', {}).get('upload'),
+            ),
+            LLMScraper(
+                config['scraper'],
+                config['llm']['web_scraping'],
+                config.get('cache', {}).get('scraper'),
+            ),
+            LLMFinAnalyzer(
+                config['llm']['fin_analyzer'],
+                ratio_engine,
+                build_scorer(
+                    config.get('scoring'),
+                    ratio_engine,
+                ),
+            ),
+            ** config.get('pipeline', {}),
+        )
+
+    def group_files(
+            self,
+            files: List[Any],
+    ) -> Dict[str, List[Any]]:
+        """
+        Groups the uploaded files by the company name derived from their file names.
+        Args:
+            files (List[Any]): The uploaded PDF file objects.
+        Returns:
+            Dict[str, List[Any]]: The files by company name, in order of first appearance.
+        """
+        groups = {}
+        for file in files:
+            groups.setdefault(self.ocr.get_company_name(file.name), []).append(file)
+
+        return groups
+
+    async def _ocr(
+            self,
+            files: List[Any],
+            limits: Dict[str, asyncio.Semaphore],
+    ) -> List[Dict[str, Any]]:
+
+        async def _extract(file):
+            async with limits.get('ocr_results', nullcontext()):
+                return await asyncio.to_thread(self.ocr.extract_all, file)
+
+        documents = await asyncio.gather(*(
+            _extract(file)
+            for file in files
+        ))
+
+        return list(itertools.chain.from_iterable(documents))
+
+    @staticmethod
+    async def _stream(
+            stream: Callable[[], Iterator[Any]],
+            on_delta: Callable[[Any], None],
+    ) -> Any:
+        """
+        Consumes a blocking stream in a worker thread and passes every item
+        to a callback on the event loop.
+        Args:
+            stream (Callable[[], Iterator[Any]]): A function returning the stream.
+            on_delta (Callable[[Any], None]): A callback invoked with every item of the stream.
+        Returns:
+            Any: The last item of the stream.
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        done = object()
+
+        def _produce():
+            try:
+                for item in stream():
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            finally:
+                loop.call_soon_threadsafe(items.put_nowait, done)
+
+        producer = asyncio.ensure_future(asyncio.to_thread(_produce))
+
+        last = None
+        while (item := await items.get()) is not done:
+            on_delta(item)
+            last = item
+
+        await producer
+
+        return last
+
+    async def _scrape(
+            self,
+            company_name: str,
+            limits: Dict[str, asyncio.Semaphore],
+            on_delta: Optional[Callable[[str, Any], None]],
+    ) -> str:
+        async with limits.get('scrape_results', nullcontext()):
+            if on_delta is None:
+                return await self.scraper.analyze_async(company_name)
+
+            return await self._stream(
+                lambda: itertools.accumulate(self.scraper.analyze_stream(company_name)),
+                lambda partial: on_delta('scrape_results', partial),
+            )
+
+    async def _fin_analyze(
+            self,
+            ocr_results: List[Dict[str, Any]],
+            scrape_results: str,
+            limits: Dict[str, asyncio.Semaphore],
+            on_delta: Optional[Callable[[str, Any], None]],
+    ) -> Dict[str, Any]:
+        async with limits.get('fin_results', nullcontext()):
+            if on_delta is None:
+                return await self.fin_analyzer.analyze_async(ocr_results, scrape_results)
+
+            return await self._stream(
+                lambda: self.fin_analyzer.analyze_stream(ocr_results, scrape_results),
+                lambda partial: on_delta('fin_results', partial),
+            )
+
+    async def run(
+            self,
+            files: List[Any],
+            on_done: Optional[Callable[[str, str, Any], None]] = None,
+            on_delta: Optional[Callable[[str, str, Any], None]] = None,
+            limits: Optional[Dict[str, asyncio.Semaphore]] = None,
+            company_name: Optional[str] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Runs the pipeline for the uploaded files of one or more companies.
+        Args:
+            files (List[Any]): The uploaded PDF file objects.
+            on_done (Optional[Callable[[str, str, Any], None]]): A callback invoked with
+                the company name, the name and the result of every stage (ocr_results,
+                scrape_results, fin_results) once it finishes, or with 'error' and
+                the exception if the analysis of the company fails.
+            on_delta (Optional[Callable[[str, str, Any], None]]): If given, the LLM stages
+                stream their responses and this callback is invoked with the company name,
+                the name of the stage and its partial result (the summary text or
+                the analysis fields so far) whenever it grows.
+            limits (Optional[Dict[str, asyncio.Semaphore]]): The semaphores bounding
+                the files in OCR and the companies in the LLM stages at the same time,
+                by stage name (ocr_results, scrape_results, fin_results), shared by
+                concurrent runs; by default, the LLM stages share one semaphore of
+                `max_concurrent_companies` and OCR is not bounded.
+            company_name (Optional[str]): The name of the company all files belong to
+                (e.g. from a manifest); by default, the files are grouped by the company
+                names derived from their file names.
+        Returns:
+            Dict[str, Dict[str, Any]]: The results of all stages by name (or the 'error'
+                of a failed analysis), by company name.
+        """
+        if limits is None:
+            limit = asyncio.Semaphore(self.max_concurrent_companies)
+            limits = {
+                'scrape_results': limit,
+                'fin_results': limit,
+            }
+
+        def _bind(callback, company_name):
+            if callback is None:
+                return None
+            return lambda *args: callback(company_name, *args)
+
+        async def _run_company(company_name, company_files):
+            try:
+                with TRACER.span('pipeline.company', files = len(company_files)):
+                    TRACER.correlate(company = company_name)
+                    return await self.dag.run(
+                        on_done = _bind(on_done, company_name),
+                        files = company_files,
+                        company_name = company_name,
+                        limits = limits,
+                        on_delta = _bind(on_delta, company_name),
+                    )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.exception("Analysis of %s failed.", company_name)
+                if on_done is not None:
+                    on_done(company_name, 'error', e)
+                return {'error': e}
+
+        groups = self.group_files(files) if company_name is None else {company_name: files}
+        results = await asyncio.gather(*(
+            _run_company(company_name, company_files)
+            for company_name, company_files in groups.items()
+        ))
+
+        return dict(zip(groups, results))
@@ -0,0 +1,342 @@
+# pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+"""
+A module providing a process-wide rate limiter shared by all callers of Bedrock,
+Textract and Tavily. It enforces per-service requests-per-second and tokens-per-minute
+budgets, serves callers in FIFO order and adapts its rates to throttling (AIMD).
+"""
+import time
+import logging
+import threading
+from functools import wraps
+from urllib.error import HTTPError
+from typing import Dict, Any, Callable, Optional
+
+from botocore.exceptions import ClientError
+
+from src.tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = (
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'ServiceQuotaExceededException',
+)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at a constant rate up to its capacity.
+    Attributes:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens in the bucket.
+        tokens (float): The number of tokens currently in the bucket.
+    Methods:
+        wait_time: Returns the time in seconds until an amount of tokens is available.
+        consume: Removes an amount of tokens from the bucket.
+        refund: Returns an amount of tokens to the bucket.
+    """
+
+    def __init__(
+            self,
+            rate: float,
+            capacity: float,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(
+            self,
+    ):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(
+            self,
+            amount: float,
+    ) -> float:
+        """
+        Returns the time in seconds until an amount of tokens is available.
+        Args:
+            amount (float): The amount of tokens, capped at the bucket capacity.
+        Returns:
+            float: The time in seconds to wait, zero if the tokens are available now.
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+
+        return max(0, missing / self.rate)
+
+    def consume(
+            self,
+            amount: float,
+    ):
+        """
+        Removes an amount of tokens from the bucket.
+        Args:
+            amount (float): The amount of tokens, capped at the bucket capacity.
+        """
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(
+            self,
+            amount: float,
+    ):
+        """
+        Returns an amount of tokens to the bucket, e.g. when a call used
+        fewer tokens than estimated. A negative amount charges the difference.
+        Args:
+            amount (float): The amount of tokens.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ServiceLimiter:
+    """
+    A FIFO scheduler admitting calls to one service within its requests-per-second
+    and optional tokens-per-minute budgets. Both rates are scaled down
+    multiplicatively on throttling and recover additively on success (AIMD).
+    Attributes:
+        name (str): The name of the service.
+        requests (TokenBucket): The bucket of requests.
+        tokens (Optional[TokenBucket]): The bucket of tokens, or None if not limited.
+        scale (float): The current fraction of the configured rates in effect.
+    Methods:
+        acquire: Blocks until the caller is first in line and within the budgets.
+        on_success: Reports a successful call and its actual token usage.
+        on_throttle: Reports a throttled call.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            requests_per_second: float,
+            burst: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            min_scale: float = 0.1,
+            increase: float = 0.05,
+            decrease: float = 0.5,
+    ):
+        self.name = name
+        self.requests = TokenBucket(
+            requests_per_second,
+            burst or max(1, requests_per_second),
+        )
+        self.tokens = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+            if tokens_per_minute else None
+        )
+        self.scale = 1.0
+        self.min_scale = min_scale
+        self.increase = increase
+        self.decrease = decrease
+
+        self._rates = (
+            requests_per_second,
+            tokens_per_minute / 60 if tokens_per_minute else None,
+        )
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def _wait_time(
+            self,
+            tokens: float,
+    ) -> float:
+        wait = self.requests.wait_time(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+
+        return wait
+
+    def acquire(
+            self,
+            tokens: float = 0,
+    ):
+        """
+        Blocks until the caller is first in line and the request (and its estimated
+        tokens) fit into the budgets, then consumes them.
+        Args:
+            tokens (float): The estimated number of tokens of the call.
+        """
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+
+            while True:
+                if ticket == self._serving:
+                    wait = self._wait_time(tokens)
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+            self.requests.consume(1)
+            if self.tokens is not None and tokens:
+                self.tokens.consume(tokens)
+
+            self._serving += 1
+            self._cond.notify_all()
+
+    def _rescale(
+            self,
+            scale: float,
+    ):
+        self.scale = scale
+        self.requests.rate = self._rates[0] * scale
+        if self.tokens is not None:
+            self.tokens.rate = self._rates[1] * scale
+
+    def on_success(
+            self,
+            estimated_tokens: float = 0,
+            used_tokens: Optional[float] = None,
+    ):
+        """
+        Reports a successful call, increasing the rates additively and reconciling
+        the estimated token count with the actual usage.
+        Args:
+            estimated_tokens (float): The number of tokens consumed on acquire.
+            used_tokens (Optional[float]): The actual number of tokens, if known.
+        """
+        with self._cond:
+            if self.scale < 1:
+                self._rescale(min(1.0, self.scale + self.increase))
+            if self.tokens is not None and used_tokens is not None:
+                self.tokens.refund(estimated_tokens - used_tokens)
+            self._cond.notify_all()
+
+    def on_throttle(
+            self,
+    ):
+        """
+        Reports a throttled call, decreasing the rates multiplicatively.
+        """
+        with self._cond:
+            self._rescale(max(self.min_scale, self.scale * self.decrease))
+            logger.warning(
+                "%s throttled, reducing its rate to %.0f%% of the limit.",
+                self.name, 100 * self.scale,
+            )
+
+
+class RateLimiter:
+    """
+    A registry of per-service limiters shared by the whole process.
+    Attributes:
+        services (Dict[str, ServiceLimiter]): The limiters by service name.
+    Methods:
+        configure: Replaces the limiters with new ones built from a configuration.
+        get: Returns the limiter of a service, or None if the service is not limited.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.services: Dict[str, ServiceLimiter] = {}
+        self._config = None
+        self._lock = threading.Lock()
+
+    def configure(
+            self,
+            config: Optional[Dict[str, Any]],
+    ):
+        """
+        Replaces the limiters with new ones built from a configuration.
+        Reconfiguring with an unchanged configuration keeps the current limiters
+        and their adapted rates.
+        Args:
+            config (Optional[Dict[str, Any]]): The limiter settings by service name.
+        """
+        with self._lock:
+            if config == self._config:
+                return
+            self._config = config
+            self.services = {
+                name: ServiceLimiter(name, ** settings)
+                for name, settings in (config or {}).items()
+            }
+
+    def get(
+            self,
+            service: str,
+    ) -> Optional[ServiceLimiter]:
+        """
+        Returns the limiter of a service.
+        Args:
+            service (str): The name of the service.
+        Returns:
+            Optional[ServiceLimiter]: The limiter, or None if the service is not limited.
+        """
+        with self._lock:
+            return self.services.get(service)
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def _is_throttling(
+        error: Exception,
+) -> bool:
+    if isinstance(error, ClientError):
+        return error.response['Error']['Code'] in THROTTLING_ERROR_CODES
+    if isinstance(error, HTTPError):
+        return error.code == 429
+
+    return False
+
+
+def rate_limited(
+        service: str,
+        estimate_tokens: Optional[Callable[..., float]] = None,
+        used_tokens: Optional[Callable[[Any], float]] = None,
+):
+    """
+    Decorator to admit every call of a function through the process-wide limiter
+    of a service and to report throttling errors back to it. Retries, e.g. by
+    `exponential_backoff` wrapped around this decorator, are admitted again.
+    Args:
+        service (str): The name of the service.
+        estimate_tokens (Optional[Callable[..., float]]): A function estimating
+            the tokens of a call from the arguments of the decorated function.
+        used_tokens (Optional[Callable[[Any], float]]): A function returning
+            the actual tokens of a call from the result of the decorated function.
+    Returns:
+        function: Decorated function that is rate limited.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limiter = RATE_LIMITER.get(service)
+            if limiter is None:
+                return func(*args, **kwargs)
+
+            tokens = estimate_tokens(*args, **kwargs) if estimate_tokens else 0
+            started = time.perf_counter()
+            limiter.acquire(tokens)
+            TRACER.add(rate_limit_wait_seconds = time.perf_counter() - started)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if _is_throttling(e):
+                    limiter.on_throttle()
+                    TRACER.add(throttled = 1)
+                raise
+
+            limiter.on_success(
+                tokens,
+                used_tokens(result) if used_tokens else None,
+            )
+
+            return result
+        return wrapper
+    return decorator
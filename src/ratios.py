@@ -0,0 +1,294 @@
+# pylint: disable=too-few-public-methods,too-many-arguments,too-many-positional-arguments
+"""
+A module that parses the amounts extracted by OCR from Czech financial statements and
+computes financial ratios and year-over-year growth for many companies and fiscal years
+at once, as column operations on a pandas DataFrame.
+"""
+import json
+from typing import Dict, Any, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ['company_name', 'fiscal_year']
+
+# Unit words of an amount and their multipliers, checked in order
+_UNITS = [
+    (r'\b(?:mld|miliard)', 1e9),
+    (r'\bmil', 1e6),
+    (r'\btis', 1e3),
+]
+
+
+def parse_amounts(
+        values: pd.Series,
+) -> pd.Series:
+    """
+    Parses amounts as written in Czech financial statements, e.g. '1 234 567',
+    '1.234.567', '-1 234,5', '(1 234)', '−12' or '12,5 tis. Kč'. Spaces (including
+    non-breaking ones) and dots between groups of three digits are thousands separators,
+    a comma is the decimal separator, parentheses and leading minus signs mark negative
+    amounts, and 'tis.', 'mil.' and 'mld.' scale the amount.
+    Args:
+        values (pd.Series): The extracted texts.
+    Returns:
+        pd.Series: The amounts as floats, NaN where no amount can be parsed.
+    """
+    text = values.astype('string').str.lower().str.strip()
+
+    scale = np.select(
+        [text.str.contains(pattern, regex = True).fillna(False).to_numpy(bool)
+         for pattern, _ in _UNITS],
+        [multiplier for _, multiplier in _UNITS],
+        1.0,
+    )
+    negative = text.str.contains(r'^[-−–]|\(\s*[\d.,\s]+\)', regex = True).fillna(False)
+
+    digits = text.str.replace(r'[^\d,.]', '', regex = True)
+    # Dots or commas between groups of three digits only are thousands separators
+    thousands = digits.str.fullmatch(r'\d{1,3}(?:\.\d{3})+|\d{1,3}(?:,\d{3}){2,}').fillna(False)
+    digits = digits.mask(thousands, digits.str.replace(r'[.,]', '', regex = True))
+    # Otherwise a comma is the decimal separator
+    digits = digits.str.replace('.', '', regex = False).where(
+        digits.str.contains(',', regex = False).fillna(False),
+        digits,
+    ).str.replace(',', '.', regex = False)
+
+    amounts = pd.to_numeric(digits, errors = 'coerce').astype(float)
+
+    return amounts * scale * np.where(negative, -1.0, 1.0)
+
+
+class RatioEngine:
+    """
+    Computes financial ratios from the OCR results of financial statements.
+    The OCR results of all documents are collected into one DataFrame with a row per
+    company and fiscal year and a column per metric alias, and all amounts, ratios and
+    growth rates are computed column-wise for all rows at once.
+    Attributes:
+        aliases (Dict[str, str]): The metric alias of every query text.
+        ratios (Dict[str, Dict[str, List[str]]]): The numerator and denominator
+            metrics of every ratio.
+        growth (List[str]): The metrics with a year-over-year growth.
+        scale (float): The multiplier of all amounts.
+        decimals (int): The number of decimal places of the ratios in the prompt.
+    Methods:
+        frame: Collects the OCR results of documents into a DataFrame of amounts.
+        parse_frame: Parses a DataFrame of extracted texts (e.g. from the FinStore).
+        compute: Adds the ratio and growth columns to a DataFrame of amounts.
+        summarize: Returns the amounts and ratios of documents by company and fiscal year.
+        render: Returns the amounts and ratios of documents as compact JSON for a prompt.
+    """
+
+    def __init__(
+            self,
+            ocr_config: Dict[str, Any],
+            ratios: Optional[Dict[str, Dict[str, Sequence[str]]]] = None,
+            growth: Sequence[str] = (),
+            scale: float = 1,
+            decimals: int = 4,
+    ):
+        self.aliases = {
+            query['Text']: query['Alias']
+            for queries in ocr_config.values()
+            for query in queries
+        }
+        self.metrics = list(dict.fromkeys(self.aliases.values()))
+        self.ratios = {
+            name: {
+                'numerator': list(ratio['numerator']),
+                'denominator': list(ratio['denominator']),
+            }
+            for name, ratio in (ratios or {}).items()
+        }
+        self.growth = list(growth)
+        self.scale = scale
+        self.decimals = decimals
+
+    def frame(
+            self,
+            documents: Iterable[Dict[str, Any]],
+    ) -> pd.DataFrame:
+        """
+        Collects the OCR results of documents into a DataFrame of amounts.
+        Args:
+            documents (Iterable[Dict[str, Any]]): The results of `OCR.extract`.
+        Returns:
+            pd.DataFrame: The amounts, one row per company and fiscal year
+                and one column per metric alias.
+        """
+        records = [
+            (
+                document['company_name'],
+                document.get('fiscal_year'),
+                self.aliases[text],
+                value,
+            )
+            for document in documents
+            for text, value in document['ocr_results'].items()
+            if text in self.aliases
+        ]
+        long = pd.DataFrame(
+            records,
+            columns = KEY_COLUMNS + ['metric', 'value'],
+        )
+        long['fiscal_year'] = long['fiscal_year'].astype('Int64')
+        long['value'] = parse_amounts(long['value'])
+
+        wide = (
+            long
+            .dropna(subset = ['value'])
+            .drop_duplicates(KEY_COLUMNS + ['metric'], keep = 'last')
+            .pivot(index = KEY_COLUMNS, columns = 'metric', values = 'value')
+            .reindex(columns = self.metrics)
+            .reset_index()
+        )
+        wide.columns.name = None
+
+        return self._scaled(wide)
+
+    def parse_frame(
+            self,
+            frame: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """
+        Parses a DataFrame of extracted texts with a column per metric alias,
+        e.g. the result of `FinStore.query`.
+        Args:
+            frame (pd.DataFrame): The company names, fiscal years and extracted texts.
+        Returns:
+            pd.DataFrame: The amounts, one column per metric alias.
+        """
+        parsed = frame[KEY_COLUMNS].copy()
+        for metric in self.metrics:
+            parsed[metric] = (
+                parse_amounts(frame[metric]) if metric in frame else np.nan
+            )
+
+        return self._scaled(parsed)
+
+    def _scaled(
+            self,
+            frame: pd.DataFrame,
+    ) -> pd.DataFrame:
+        if self.scale != 1:
+            frame[self.metrics] = frame[self.metrics] * self.scale
+
+        return frame
+
+    @staticmethod
+    def _first_available(
+            frame: pd.DataFrame,
+            metrics: List[str],
+    ) -> pd.Series:
+        values = frame[metrics[0]]
+        for metric in metrics[1:]:
+            values = values.fillna(frame[metric])
+
+        return values
+
+    def compute(
+            self,
+            frame: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """
+        Adds a column for every ratio and a <METRIC>_YOY column for every growth
+        metric to a DataFrame of amounts. Ratios with a zero or missing denominator
+        and growth rates without the amount of the previous fiscal year are NaN.
+        Args:
+            frame (pd.DataFrame): The amounts, e.g. from `frame` or `parse_frame`.
+        Returns:
+            pd.DataFrame: The amounts, ratios and growth rates, sorted by company and year.
+        """
+        frame = frame.sort_values(KEY_COLUMNS).reset_index(drop = True)
+
+        columns = {}
+        for name, ratio in self.ratios.items():
+            denominator = self._first_available(frame, ratio['denominator'])
+            columns[name] = (
+                self._first_available(frame, ratio['numerator'])
+                / denominator.where(denominator != 0)
+            )
+
+        by_company = frame.groupby('company_name', sort = False)
+        consecutive = (frame['fiscal_year'] - by_company['fiscal_year'].shift()) == 1
+        previous = by_company[self.growth].shift().where(consecutive.fillna(False), axis = 0)
+        for metric in self.growth:
+            base = previous[metric].abs()
+            columns[f"{metric}_YOY"] = (frame[metric] - previous[metric]) / base.where(base != 0)
+
+        return pd.concat(
+            [frame, pd.DataFrame(columns, index = frame.index)],
+            axis = 1,
+        )
+
+    def summarize(
+            self,
+            documents: Iterable[Dict[str, Any]],
+    ) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Returns the amounts and ratios of documents by company and fiscal year,
+        without missing values.
+        Args:
+            documents (Iterable[Dict[str, Any]]): The results of `OCR.extract`.
+        Returns:
+            Dict[str, Dict[str, Dict[str, float]]]: The amounts and ratios by fiscal year
+                (or 'unknown'), by company name.
+        """
+        frame = self.compute(self.frame(documents))
+        values = frame.drop(columns = KEY_COLUMNS)
+        ratio_columns = values.columns.difference(self.metrics)
+        values[ratio_columns] = values[ratio_columns].round(self.decimals)
+
+        summary = {}
+        for (company_name, fiscal_year), row in zip(
+                frame[KEY_COLUMNS].itertuples(index = False),
+                values.to_dict('records'),
+        ):
+            year = 'unknown' if pd.isna(fiscal_year) else str(fiscal_year)
+            summary.setdefault(company_name, {})[year] = {
+                name: float(value)
+                for name, value in row.items()
+                if pd.notna(value)
+            }
+
+        return summary
+
+    def render(
+            self,
+            documents: Iterable[Dict[str, Any]],
+    ) -> str:
+        """
+        Returns the amounts and ratios of documents as compact JSON for an LLM prompt.
+        Args:
+            documents (Iterable[Dict[str, Any]]): The results of `OCR.extract`.
+        Returns:
+            str: The amounts and ratios by company name and fiscal year.
+        """
+        return json.dumps(
+            self.summarize(documents),
+            ensure_ascii = False,
+            separators = (',', ':'),
+        )
+
+
+def build_ratio_engine(
+        config: Optional[Dict[str, Any]],
+        ocr_config: Dict[str, Any],
+) -> Optional[RatioEngine]:
+    """
+    Builds the ratio engine from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The ratio configuration with the `enabled` flag.
+        ocr_config (Dict[str, Any]): The Textract queries per document type.
+    Returns:
+        Optional[RatioEngine]: The ratio engine, or None if it is disabled.
+    """
+    config = dict(config or {'enabled': False})
+    if not config.pop('enabled', True):
+        return None
+
+    return RatioEngine(
+        ocr_config,
+        ** config,
+    )
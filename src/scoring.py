@@ -0,0 +1,229 @@
+# pylint: disable=too-few-public-methods
+"""
+A module that settles clear-cut companies with deterministic rules on their financial
+ratios, so that only borderline companies need the LLM financial analysis.
+"""
+import logging
+import threading
+from typing import Dict, Any, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.ratios import RatioEngine
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDED = 'recommended'
+NOT_RECOMMENDED = 'not_recommended'
+
+
+class FastPathScorer:
+    """
+    Evaluates reject and accept rules on the amounts and ratios of the latest fiscal
+    year of companies. A rule maps metric or ratio names to `above` and/or `below`
+    thresholds (exclusive) and matches if all of them hold. Reject rules take precedence
+    over accept rules; companies matching neither are borderline.
+    Attributes:
+        ratio_engine (RatioEngine): The engine computing the amounts and ratios.
+        reject (List[Dict[str, Any]]): The rules of companies not recommended.
+        accept (List[Dict[str, Any]]): The rules of recommended companies.
+        metrics (Dict[str, int]): The numbers of companies decided by the rules
+            and of borderline companies passed to the LLM.
+    Methods:
+        decide: Decides the rows of a DataFrame of amounts and ratios at once.
+        analyze: Returns the financial analysis of a company if its case is clear-cut.
+        avoided_fraction: Returns the fraction of financial analysis LLM calls avoided.
+    """
+
+    def __init__(
+            self,
+            ratio_engine: RatioEngine,
+            reject: Optional[List[Dict[str, Any]]] = None,
+            accept: Optional[List[Dict[str, Any]]] = None,
+    ):
+        self.ratio_engine = ratio_engine
+        self.reject = list(reject or [])
+        self.accept = list(accept or [])
+        self.metrics = {
+            'decided': 0,
+            'borderline': 0,
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _matches(
+            frame: pd.DataFrame,
+            rule: Dict[str, Any],
+    ) -> np.ndarray:
+        """
+        Evaluates a rule on all rows of a DataFrame.
+        Args:
+            frame (pd.DataFrame): The amounts and ratios.
+            rule (Dict[str, Any]): The rule with its `when` conditions.
+        Returns:
+            np.ndarray: Whether the rule matches, per row.
+        """
+        matched = np.ones(len(frame), dtype = bool)
+        for column, condition in rule['when'].items():
+            if column not in frame:
+                return np.zeros(len(frame), dtype = bool)
+            values = frame[column].to_numpy(dtype = float)
+            if 'above' in condition:
+                matched &= values > condition['above']
+            if 'below' in condition:
+                matched &= values < condition['below']
+
+        return matched
+
+    def _first_match(
+            self,
+            frame: pd.DataFrame,
+            rules: List[Dict[str, Any]],
+    ) -> pd.Series:
+        names = pd.Series(None, index = frame.index, dtype = object)
+        for rule in reversed(rules):
+            names = names.mask(self._matches(frame, rule), rule['name'])
+
+        return names
+
+    def decide(
+            self,
+            frame: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """
+        Decides the rows of a DataFrame of amounts and ratios at once.
+        Args:
+            frame (pd.DataFrame): The amounts and ratios, e.g. from `RatioEngine.compute`.
+        Returns:
+            pd.DataFrame: The `decision` (recommended, not_recommended or None if
+                borderline) and the name of the matched `rule` of every row.
+        """
+        rejected = self._first_match(frame, self.reject)
+        accepted = self._first_match(frame, self.accept)
+
+        return pd.DataFrame(
+            {
+                'decision': np.select(
+                    [rejected.notna(), accepted.notna()],
+                    [NOT_RECOMMENDED, RECOMMENDED],
+                    None,
+                ),
+                'rule': rejected.fillna(accepted),
+            },
+            index = frame.index,
+        )
+
+    def _count(
+            self,
+            key: str,
+    ):
+        with self._lock:
+            self.metrics[key] += 1
+
+    def analyze(
+            self,
+            ocr_results: Iterable[Dict[str, Any]],
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the financial analysis of a company if the rules decide its latest
+        fiscal year, in the format of the FinancialAnalyzer tool.
+        Args:
+            ocr_results (Iterable[Dict[str, Any]]): The results of `OCR.extract`
+                for the documents of one company.
+        Returns:
+            Optional[Dict[str, str]]: The `financial_analysis` and `recommendations`,
+                or None if the company is borderline.
+        """
+        frame = self.ratio_engine.compute(self.ratio_engine.frame(ocr_results))
+        known = frame[frame['fiscal_year'].notna()]
+        latest = (known if not known.empty else frame).tail(1)
+
+        if latest.empty:
+            self._count('borderline')
+            return None
+
+        decision = self.decide(latest).iloc[0]
+        if decision['decision'] is None:
+            self._count('borderline')
+            return None
+
+        self._count('decided')
+        row = latest.iloc[0]
+        logger.info(
+            "%s decided without the LLM: %s (%s).",
+            row['company_name'], decision['decision'], decision['rule'],
+        )
+
+        return self._format(row, decision['decision'], decision['rule'])
+
+    def _format(
+            self,
+            row: pd.Series,
+            decision: str,
+            rule: str,
+    ) -> Dict[str, str]:
+        year = 'an unknown year' if pd.isna(row['fiscal_year']) else row['fiscal_year']
+        ratios = [
+            f"- {name}: {row[name]:.{self.ratio_engine.decimals}f}"
+            for name in row.index.difference(
+                ['company_name', 'fiscal_year'] + self.ratio_engine.metrics,
+                sort = False,
+            )
+            if pd.notna(row[name])
+        ]
+        recommended = decision == RECOMMENDED
+
+        return {
+            'financial_analysis': '\n'.join([
+                f"Financial ratios of fiscal year {year}:",
+                * ratios,
+                f"The company meets the rule **{rule.upper()}**, so it is "
+                + ("likely" if recommended else "**UNLIKELY**")
+                + " to pay invoices on time.",
+            ]),
+            'recommendations': (
+                "Business with this company is "
+                + ("**RECOMMENDED**." if recommended else "**NOT RECOMMENDED**.")
+            ),
+        }
+
+    def avoided_fraction(
+            self,
+    ) -> float:
+        """
+        Returns the fraction of financial analysis LLM calls avoided so far.
+        Returns:
+            float: The fraction of companies decided by the rules, 0 if none was scored.
+        """
+        with self._lock:
+            total = self.metrics['decided'] + self.metrics['borderline']
+            return self.metrics['decided'] / total if total else 0.0
+
+
+def build_scorer(
+        config: Optional[Dict[str, Any]],
+        ratio_engine: Optional[RatioEngine],
+) -> Optional[FastPathScorer]:
+    """
+    Builds the fast-path scorer from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The scoring configuration with the `enabled`
+            flag and the `reject` and `accept` rules.
+        ratio_engine (Optional[RatioEngine]): The engine computing the ratios.
+    Returns:
+        Optional[FastPathScorer]: The scorer, or None if it is disabled.
+    Raises:
+        ValueError: If the scorer is enabled without the ratio engine.
+    """
+    config = dict(config or {'enabled': False})
+    if not config.pop('enabled', True):
+        return None
+
+    if ratio_engine is None:
+        raise ValueError("Fast-path scoring requires the ratio engine to be enabled.")
+
+    return FastPathScorer(
+        ratio_engine,
+        ** config,
+    )
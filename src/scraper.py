@@ -7,13 +7,16 @@ and sends a request to the Tavily API, returning the parsed JSON response.
 
 import os
 import json
+import asyncio
 from urllib.request import (
     Request,
     urlopen,
 )
-import copy
 from typing import Dict, Any
 
+from src.ratelimit import rate_limited
+from src.tracing import TRACER, traced
+
 class TavilyScraper:
     """
     A scraper class for querying the Tavily API using a provided configuration.
@@ -42,7 +45,7 @@ class TavilyScraper:
     ) -> Dict[str, Any]:
         """
         Constructs the payload for the Tavily API request by injecting the company name
-        and API key into a copy of the base payload.
+        and API key into a shallow copy of the base payload.
 
         Args:
             company_name (str): The name of the company to query, which will be
@@ -51,9 +54,11 @@ class TavilyScraper:
         Returns:
             Dict[str, Any]: A dictionary representing the completed payload.
         """
-        payload = copy.deepcopy(self.config['payload'])
-        payload['query'] = f"{company_name} czech republic"
-        payload['api_key'] = os.environ['TAVILY_API_KEY']
+        payload = {
+            ** self.config['payload'],
+            'query': f"{company_name} czech republic",
+            'api_key': os.environ['TAVILY_API_KEY'],
+        }
 
         return (
             json.dumps(
@@ -63,6 +68,8 @@ class TavilyScraper:
             .encode('utf-8')
         )
 
+    @traced('tavily.scrape')
+    @rate_limited('tavily')
     def scrape(
             self,
             company_name: str,
@@ -86,9 +93,33 @@ class TavilyScraper:
         )
 
         with urlopen(request) as response:
-            output = json.loads(
-                response.read()
-                .decode('utf-8')
-            )
+            body = response.read()
+        TRACER.set(
+            request_bytes = len(data),
+            response_bytes = len(body),
+        )
+
+        output = json.loads(
+            body.decode('utf-8')
+        )
 
         return output
+
+    async def scrape_async(
+            self,
+            company_name: str,
+    ):
+        """
+        Asynchronous version of `scrape`, running the blocking HTTP request
+        in the default executor of the event loop.
+
+        Args:
+            company_name (str): The name of the company to query.
+
+        Returns:
+            Any: The parsed JSON response from the Tavily API.
+        """
+        return await asyncio.to_thread(
+            self.scrape,
+            company_name,
+        )
@@ -0,0 +1,356 @@
+# pylint: disable=too-few-public-methods
+"""
+A module providing process-wide request coalescing (single-flight): concurrent calls
+with the same key (e.g. the content hash of a PDF or the name of a company) share one
+in-flight call and its result, so that identical analyses started at the same moment
+fire one Textract job or Bedrock call instead of one each. Optionally, a lock file per
+key extends this to several processes on one host, which hand the result over through
+a short-lived file next to the lock.
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+from src.tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class _Call:
+    """
+    An in-flight call shared by its leader and its followers.
+    Attributes:
+        done (threading.Event): Set once the leader finished.
+        result (Any): The result of the call.
+        error (Optional[BaseException]): The exception the call failed with.
+        abandoned (bool): True if the leader stopped consuming a stream before its end.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call. The first caller of
+    a key (the leader) runs the call, callers arriving while it runs (followers) wait
+    for it and receive its result or its exception. Nothing is kept once the call
+    finished, so it is no cache. With a lock directory, leaders of different processes
+    take an exclusive lock per key, and a process waiting for the lock reuses the result
+    the previous holder wrote within the handoff window instead of calling again.
+    Attributes:
+        enabled (bool): If False, every call runs on its own.
+        lock_dir (Optional[str]): The directory of the cross-process lock and result
+            files, or None to coalesce within the process only.
+        handoff_seconds (float): The time in seconds during which a result written by
+            another process is reused.
+        metrics (Dict[str, int]): The numbers of calls run, of calls served by
+            an in-flight call of the process and of results handed over by another process.
+    Methods:
+        configure: Applies new settings.
+        do: Runs a call, or waits for the identical call in flight.
+        stream: Streams a call, or waits for the identical call in flight.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.enabled = False
+        self.lock_dir = None
+        self.handoff_seconds = 10.0
+        self.metrics = {
+            'calls': 0,
+            'coalesced': 0,
+            'handed_off': 0,
+        }
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self._swept = 0.0
+
+    def configure(
+            self,
+            config: Optional[Dict[str, Any]],
+    ):
+        """
+        Applies new settings; calls in flight are not affected.
+        Args:
+            config (Optional[Dict[str, Any]]): The settings with the `enabled` flag,
+                the `lock_dir` and the `handoff_seconds`.
+        """
+        config = dict(config or {'enabled': False})
+        with self._lock:
+            self.enabled = bool(config.get('enabled', True))
+            self.lock_dir = config.get('lock_dir')
+            self.handoff_seconds = float(config.get('handoff_seconds', 10))
+
+        if self.enabled and self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok = True)
+
+    def _count(
+            self,
+            metric: str,
+    ):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def _join(
+            self,
+            key: str,
+    ) -> Tuple[_Call, bool]:
+        """
+        Returns the call in flight for a key, registering a new one if there is none.
+        Returns:
+            Tuple[_Call, bool]: The call, and True if the caller leads it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _leave(
+            self,
+            key: str,
+            call: _Call,
+    ):
+        with self._lock:
+            self._calls.pop(key, None)
+        call.done.set()
+
+    def _wait(
+            self,
+            call: _Call,
+    ) -> Any:
+        call.done.wait()
+        self._count('coalesced')
+        TRACER.add(coalesced = 1)
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def _path(
+            self,
+            key: str,
+            suffix: str,
+    ) -> str:
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.lock_dir, f"{name}{suffix}")
+
+    @contextmanager
+    def _exclusive(
+            self,
+            key: str,
+    ) -> Iterator[Any]:
+        """
+        Holds the cross-process lock of a key, if a lock directory is configured.
+        Yields:
+            Any: The result handed over by another process within the handoff window,
+                or _MISSING.
+        """
+        if not self.lock_dir:
+            yield _MISSING
+            return
+
+        path = self._path(key, '.lock')
+        while True:
+            with open(path, 'a', encoding = 'utf-8') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # A lock file removed by a sweep while waiting for it locks nobody out
+                    if not self._is_current(lock_file, path):
+                        continue
+                    yield self._read(key)
+                    return
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _is_current(
+            lock_file: Any,
+            path: str,
+    ) -> bool:
+        try:
+            return os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+        except OSError:
+            return False
+
+    def _sweep(
+            self,
+            entry: os.DirEntry,
+    ):
+        """
+        Removes an expired result file, or an expired lock file no process holds.
+        """
+        if entry.name.endswith('.json'):
+            os.remove(entry.path)
+        elif entry.name.endswith('.lock'):
+            with open(entry.path, 'a', encoding = 'utf-8') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    os.remove(entry.path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(
+            self,
+            key: str,
+    ) -> Any:
+        path = self._path(key, '.json')
+        try:
+            if time.time() - os.path.getmtime(path) > self.handoff_seconds:
+                return _MISSING
+            with open(path, encoding = 'utf-8') as file:
+                result = json.load(file)
+        except (OSError, ValueError):
+            return _MISSING
+
+        self._count('handed_off')
+        TRACER.add(coalesced = 1)
+
+        return result
+
+    def _write(
+            self,
+            key: str,
+            result: Any,
+    ):
+        """
+        Writes the result of a call for the processes waiting for the lock of its key
+        and removes the results and the unheld locks of other keys past the handoff window.
+        """
+        if not self.lock_dir:
+            return
+
+        path = self._path(key, '.json')
+        try:
+            with open(f"{path}.tmp", 'w', encoding = 'utf-8') as file:
+                json.dump(result, file, ensure_ascii = False)
+            os.replace(f"{path}.tmp", path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Cannot hand over the result of %s: %s", key, e)
+
+        now = time.time()
+        if now - self._swept < self.handoff_seconds:
+            return
+        self._swept = now
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if now - entry.stat().st_mtime > self.handoff_seconds:
+                    self._sweep(entry)
+            except OSError:
+                continue
+
+    def do(
+            self,
+            key: str,
+            compute: Callable[[], Any],
+    ) -> Any:
+        """
+        Runs a call, or waits for the call with the same key in flight and returns
+        its result. The result must be JSON-serializable to be handed over to other
+        processes.
+        Args:
+            key (str): The key identifying identical calls.
+            compute (Callable[[], Any]): A function running the call.
+        Returns:
+            Any: The result of the call.
+        Raises:
+            Exception: The exception the shared call failed with.
+        """
+        if not self.enabled:
+            return compute()
+
+        call, leader = self._join(key)
+        if not leader:
+            return self._wait(call)
+
+        try:
+            with self._exclusive(key) as result:
+                if result is _MISSING:
+                    self._count('calls')
+                    result = compute()
+                    self._write(key, result)
+            call.result = result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._leave(key, call)
+
+        return result
+
+    def stream(
+            self,
+            key: str,
+            stream: Callable[[], Iterator[Any]],
+            combine: Callable[[List[Any]], Any],
+    ) -> Iterator[Any]:
+        """
+        Streams a call, or waits for the call with the same key in flight and yields
+        its result at once, combined from the items of its stream.
+        Args:
+            key (str): The key identifying identical calls.
+            stream (Callable[[], Iterator[Any]]): A function returning the stream of the call.
+            combine (Callable[[List[Any]], Any]): A function combining the items of
+                the stream into the result yielded to the followers.
+        Yields:
+            Any: The items of the stream, or the result of the call in flight.
+        Raises:
+            Exception: The exception the shared call failed with.
+        """
+        if not self.enabled:
+            yield from stream()
+            return
+
+        call, leader = self._join(key)
+        if not leader:
+            call.done.wait()
+            if call.abandoned:
+                yield from self.stream(key, stream, combine)
+                return
+            yield self._wait(call)
+            return
+
+        try:
+            with self._exclusive(key) as result:
+                if result is _MISSING:
+                    self._count('calls')
+                    items = []
+                    for item in stream():
+                        items.append(item)
+                        yield item
+                    result = combine(items)
+                    self._write(key, result)
+                else:
+                    yield result
+            call.result = result
+        except GeneratorExit:
+            call.abandoned = True
+            raise
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._leave(key, call)
+
+
+SINGLE_FLIGHT = SingleFlight()
@@ -0,0 +1,300 @@
+# pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+"""
+A module providing a persistent, columnar store of the financial metrics extracted
+by OCR, keyed by company, fiscal year and document type, for multi-year trend
+queries and portfolio-level scans.
+"""
+import os
+import time
+import uuid
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+KEY_COLUMNS = ['company_name', 'fiscal_year', 'doc_type']
+
+
+class FinStore:
+    """
+    A Parquet dataset of extracted metrics, hive-partitioned by document type and
+    fiscal year, with one string column per query alias from the OCR configuration
+    (ASSETS_TOTAL, EQUITY, NET_TURNOVER, ...). Every extraction is written as its own
+    file, and reads return the latest extraction per company, fiscal year and document
+    type. Filters on the keys are pushed down to the partitions and row groups, and
+    only the requested metric columns are read. The listing of the dataset files is
+    kept and extended by the writes of the store, so that reads do not list the whole
+    dataset (e.g. an S3 LIST growing with the history) every time; files written by
+    other processes are seen once the listing is refreshed.
+    Attributes:
+        path (str): The local directory or URI (e.g. s3://bucket/prefix) of the dataset.
+        ocr_config (Dict[str, Any]): The Textract queries per document type.
+        refresh_seconds (float): The time in seconds after which the listing
+            of the dataset files is refreshed.
+        metrics (List[str]): The metric columns, i.e. all query aliases.
+        schema (pa.Schema): The schema of the dataset files (without partition keys).
+    Methods:
+        put: Stores the OCR results of one document.
+        query: Reads the latest metrics matching the given filters.
+        get: Returns the stored OCR results of one document, if any.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            ocr_config: Dict[str, Any],
+            refresh_seconds: float = 60,
+    ):
+        self.path = path
+        self.ocr_config = ocr_config
+        self.refresh_seconds = refresh_seconds
+
+        if '://' in path:
+            self.filesystem, self._base = fs.FileSystem.from_uri(path)
+        else:
+            self.filesystem, self._base = fs.LocalFileSystem(), os.path.abspath(path)
+
+        self.metrics = list(dict.fromkeys(
+            query['Alias']
+            for queries in ocr_config.values()
+            for query in queries
+        ))
+        self._aliases = {
+            doc_type: {query['Text']: query['Alias'] for query in queries}
+            for doc_type, queries in ocr_config.items()
+        }
+        self.schema = pa.schema(
+            [
+                ('company_name', pa.string()),
+                ('file_id', pa.string()),
+                ('digest', pa.string()),
+                ('extracted_at', pa.timestamp('us', tz = 'UTC')),
+            ]
+            + [(metric, pa.string()) for metric in self.metrics]
+        )
+        partition_schema = pa.schema([
+            ('doc_type', pa.string()),
+            ('fiscal_year', pa.int32()),
+        ])
+        self._partitioning = ds.partitioning(
+            partition_schema,
+            flavor = 'hive',
+        )
+        self._dataset_schema = pa.unify_schemas([self.schema, partition_schema])
+
+        self._files: Optional[List[str]] = None
+        self._listed_at = 0.0
+        self._lock = threading.Lock()
+
+    def _list_files(
+            self,
+    ) -> List[str]:
+        selector = fs.FileSelector(self._base, recursive = True, allow_not_found = True)
+
+        return [
+            info.path
+            for info in self.filesystem.get_file_info(selector)
+            if info.type == fs.FileType.File
+            and info.base_name.endswith('.parquet')
+            and not info.base_name.startswith(('.', '_'))
+        ]
+
+    def _dataset(
+            self,
+    ) -> Optional[ds.Dataset]:
+        """
+        Returns the dataset of the listed files, listing them again once the listing
+        is older than `refresh_seconds`.
+        Returns:
+            Optional[ds.Dataset]: The dataset, or None if it has no files.
+        """
+        with self._lock:
+            if self._files is None or time.monotonic() - self._listed_at > self.refresh_seconds:
+                self._files = self._list_files()
+                self._listed_at = time.monotonic()
+            files = list(self._files)
+
+        if not files:
+            return None
+
+        return ds.FileSystemDataset.from_paths(
+            files,
+            schema = self._dataset_schema,
+            format = ds.ParquetFileFormat(),
+            filesystem = self.filesystem,
+            partitions = [
+                self._partitioning.parse(file[len(self._base) + 1:])
+                for file in files
+            ],
+        )
+
+    def put(
+            self,
+            company_name: str,
+            fiscal_year: int,
+            doc_type: str,
+            file_id: str,
+            ocr_results: Dict[str, str],
+            digest: Optional[str] = None,
+    ):
+        """
+        Stores the OCR results of one document as a new file of the dataset.
+        Args:
+            company_name (str): The company name.
+            fiscal_year (int): The fiscal year of the statement.
+            doc_type (str): The document type.
+            file_id (str): The ID of the processed file.
+            ocr_results (Dict[str, str]): The OCR results, mapping query texts to results.
+            digest (Optional[str]): The SHA-256 digest of the content of the processed file.
+        """
+        aliases = self._aliases[doc_type]
+        row = {
+            'company_name': company_name,
+            'file_id': file_id,
+            'digest': digest,
+            'extracted_at': datetime.now(timezone.utc),
+            ** {metric: None for metric in self.metrics},
+            ** {
+                aliases[text]: value
+                for text, value in ocr_results.items()
+                if text in aliases
+            },
+        }
+
+        directory = f"{self._base}/doc_type={doc_type}/fiscal_year={fiscal_year}"
+        name = f"{uuid.uuid4().hex}.parquet"
+        self.filesystem.create_dir(directory, recursive = True)
+
+        # Files starting with a dot are ignored by readers until they are complete
+        pq.write_table(
+            pa.Table.from_pylist([row], schema = self.schema),
+            f"{directory}/.{name}",
+            filesystem = self.filesystem,
+        )
+        self.filesystem.move(f"{directory}/.{name}", f"{directory}/{name}")
+
+        with self._lock:
+            if self._files is not None and f"{directory}/{name}" not in self._files:
+                self._files.append(f"{directory}/{name}")
+
+    def query(
+            self,
+            companies: Optional[Iterable[str]] = None,
+            fiscal_years: Optional[Iterable[int]] = None,
+            doc_types: Optional[Iterable[str]] = None,
+            metrics: Optional[List[str]] = None,
+            digests: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Reads the latest metrics per company, fiscal year and document type
+        matching the given filters.
+        Args:
+            companies (Optional[Iterable[str]]): The company names, all if None.
+            fiscal_years (Optional[Iterable[int]]): The fiscal years, all if None.
+            doc_types (Optional[Iterable[str]]): The document types, all if None.
+            metrics (Optional[List[str]]): The metric columns to read, all if None.
+            digests (Optional[Iterable[str]]): The content digests of the processed files,
+                all if None.
+        Returns:
+            pd.DataFrame: The key columns and the requested metrics, one row per key.
+        """
+        columns = KEY_COLUMNS + ['extracted_at'] + (metrics or self.metrics)
+
+        dataset = self._dataset()
+        if dataset is None:
+            return pd.DataFrame(columns = columns)
+
+        conditions = [
+            pc.field(column).isin(list(values))
+            for column, values in (
+                ('company_name', companies),
+                ('fiscal_year', fiscal_years),
+                ('doc_type', doc_types),
+                ('digest', digests),
+            )
+            if values is not None
+        ]
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        frame = dataset.to_table(
+            columns = columns,
+            filter = expression,
+        ).to_pandas()
+
+        return (
+            frame
+            .sort_values('extracted_at')
+            .drop_duplicates(KEY_COLUMNS, keep = 'last')
+            .sort_values(KEY_COLUMNS)
+            .reset_index(drop = True)
+        )
+
+    def get(
+            self,
+            company_name: str,
+            fiscal_year: int,
+            doc_type: str,
+            digest: Optional[str] = None,
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the stored OCR results of one document, in the shape returned by Textract.
+        Args:
+            company_name (str): The company name.
+            fiscal_year (int): The fiscal year of the statement.
+            doc_type (str): The document type.
+            digest (Optional[str]): If given, only results extracted from a file with
+                this content digest are returned.
+        Returns:
+            Optional[Dict[str, str]]: The OCR results mapping query texts to results,
+                or None if the document is not stored.
+        """
+        aliases = self._aliases[doc_type]
+        frame = self.query(
+            companies = [company_name],
+            fiscal_years = [fiscal_year],
+            doc_types = [doc_type],
+            metrics = list(dict.fromkeys(aliases.values())),
+            digests = None if digest is None else [digest],
+        )
+        if frame.empty:
+            return None
+
+        row = frame.iloc[0]
+
+        return {
+            text: row[alias]
+            for text, alias in aliases.items()
+            if pd.notna(row[alias])
+        }
+
+
+def build_store(
+        config: Optional[Dict[str, Any]],
+        ocr_config: Dict[str, Any],
+) -> Optional[FinStore]:
+    """
+    Builds the financial time-series store from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The store configuration with the `enabled`
+            flag, the `path` of the dataset (a local directory or an s3:// URI) and
+            the `refresh_seconds` of its file listing.
+        ocr_config (Dict[str, Any]): The Textract queries per document type.
+    Returns:
+        Optional[FinStore]: The store, or None if the store is disabled.
+    """
+    if not config or not config.get('enabled', True):
+        return None
+
+    return FinStore(
+        config['path'],
+        ocr_config,
+        config.get('refresh_seconds', 60),
+    )
@@ -0,0 +1,155 @@
+# pylint: disable=too-few-public-methods
+"""
+A module for compiling LLM request payloads with `<<placeholder>>` markers into
+templates that are validated once and rendered without deep copies.
+"""
+import re
+from typing import Dict, Any, Iterable, List, Optional, Set, Union
+
+PLACEHOLDER = re.compile(r'<<(\w+)>>')
+
+
+class _Text:
+    """
+    A compiled string with placeholders, split into its literal parts and placeholder names.
+    """
+
+    def __init__(
+            self,
+            text: str,
+    ):
+        # Odd positions hold placeholder names, even positions literal text
+        self.parts = PLACEHOLDER.split(text)
+        self.names = set(self.parts[1::2])
+
+    def render(
+            self,
+            values: Dict[str, str],
+    ) -> str:
+        """
+        Renders the string with values for its placeholders.
+        Args:
+            values (Dict[str, str]): The values by placeholder name.
+        Returns:
+            str: The rendered string.
+        """
+        return ''.join(
+            values[part] if i % 2 else part
+            for i, part in enumerate(self.parts)
+        )
+
+
+class PayloadTemplate:
+    """
+    A payload compiled once at load time: every string containing placeholders is found
+    anywhere in the nested structure, and rendering copies only the containers on the
+    paths to those strings while sharing the rest of the payload.
+    The rendered payloads must therefore be treated as read-only.
+    Attributes:
+        payload (Dict[str, Any]): The source payload.
+        placeholders (Set[str]): The names of all placeholders in the payload.
+    Methods:
+        render: Renders the payload with values for all placeholders.
+    """
+
+    def __init__(
+            self,
+            payload: Dict[str, Any],
+            placeholders: Optional[Iterable[str]] = None,
+    ):
+        """
+        Compiles a payload.
+        Args:
+            payload (Dict[str, Any]): The payload with `<<placeholder>>` markers.
+            placeholders (Optional[Iterable[str]]): The placeholders the payload must contain.
+        Raises:
+            ValueError: If the payload does not contain exactly the expected placeholders.
+        """
+        self.payload = payload
+        self.placeholders: Set[str] = set()
+        self._compiled = self._compile(payload)
+
+        if placeholders is not None and set(placeholders) != self.placeholders:
+            raise ValueError(
+                f"Payload placeholders {sorted(self.placeholders)} "
+                f"do not match the expected {sorted(placeholders)}."
+            )
+
+    def _compile(
+            self,
+            node: Any,
+    ) -> Union[None, _Text, Dict[Any, Any]]:
+        """
+        Compiles a node of the payload.
+        Returns:
+            None for nodes without placeholders, a compiled string, or a mapping
+            from keys (or list indices) to the compiled children with placeholders.
+        """
+        if isinstance(node, str):
+            text = _Text(node)
+            self.placeholders |= text.names
+            return text if text.names else None
+
+        if isinstance(node, dict):
+            children = node.items()
+        elif isinstance(node, list):
+            children = enumerate(node)
+        else:
+            return None
+
+        compiled = {
+            key: child
+            for key, child in (
+                (key, self._compile(value)) for key, value in children
+            )
+            if child is not None
+        }
+
+        return compiled or None
+
+    def _render(
+            self,
+            node: Any,
+            compiled: Union[_Text, Dict[Any, Any]],
+            values: Dict[str, str],
+    ) -> Any:
+        if isinstance(compiled, _Text):
+            return compiled.render(values)
+
+        copied: Union[Dict[Any, Any], List[Any]] = (
+            dict(node) if isinstance(node, dict) else list(node)
+        )
+        for key, child in compiled.items():
+            copied[key] = self._render(node[key], child, values)
+
+        return copied
+
+    def render(
+            self,
+            **values: Any,
+    ) -> Dict[str, Any]:
+        """
+        Renders the payload with values for all placeholders; non-string values
+        are converted with `str`.
+        Args:
+            **values (Any): The values by placeholder name.
+        Returns:
+            Dict[str, Any]: The rendered payload, sharing unchanged parts with the template.
+        Raises:
+            ValueError: If a value is missing for any placeholder.
+        """
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise ValueError(f"Missing values for placeholders: {sorted(missing)}")
+
+        if self._compiled is None:
+            return self.payload
+
+        return self._render(
+            self.payload,
+            self._compiled,
+            {
+                name: value if isinstance(value, str) else str(value)
+                for name, value in values.items()
+            },
+        )
@@ -0,0 +1,147 @@
+# pylint: disable=too-few-public-methods
+"""
+A module that answers the Textract queries of a financial statement from the text layer
+of a digitally generated PDF, so that such PDFs need no upload and no Textract job.
+"""
+import re
+import logging
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from src.utils import normalize_name
+
+logger = logging.getLogger(__name__)
+
+# A table cell holding an amount, e.g. '1 234 567', '(1 234)', '-12,5'
+AMOUNT = re.compile(r'[-−–]?\(?\s*\d[\d\s .,]*\)?')
+# Cells of a text line laid out in columns are separated by at least two spaces
+CELL_SEPARATOR = re.compile(r'\s{2,}')
+# A row number cell (č. ř.) in front of the amounts
+ROW_NUMBER = re.compile(r'\d{1,3}')
+
+
+class TextLayerExtractor:
+    """
+    Answers queries from the text layer of a PDF read in layout mode. The row of a query
+    is the shortest line whose label contains one of the row labels of the query alias,
+    and its answer is the amount in the current-period column of that row, chosen by
+    the number of amount cells of the row.
+    Attributes:
+        labels (Dict[str, List[str]]): The normalized row labels per query alias.
+        columns (Dict[int, int]): The index of the current-period amount
+            by the number of amount cells of a row.
+        min_coverage (float): The minimum fraction of the queries answered locally.
+    Methods:
+        parse_row: Splits a text line into its normalized label and its amount cells.
+        extract: Answers the queries of a document from the text layer.
+    """
+
+    def __init__(
+            self,
+            labels: Dict[str, Iterable[str]],
+            columns: Optional[Dict[int, int]] = None,
+            min_coverage: float = 0.8,
+    ):
+        self.labels = {
+            alias: [normalize_name(label) for label in alias_labels]
+            for alias, alias_labels in labels.items()
+        }
+        self.columns = {
+            int(count): int(index)
+            for count, index in (columns or {4: 2, 2: 0, 1: 0}).items()
+        }
+        self.min_coverage = min_coverage
+
+    def parse_row(
+            self,
+            line: str,
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Splits a text line into its normalized label and its current-period amount.
+        Args:
+            line (str): The text line.
+        Returns:
+            Tuple[str, Optional[str]]: The normalized label and the amount as written
+                in the PDF, or None if the row has no recognised amount columns.
+        """
+        cells = CELL_SEPARATOR.split(line.strip())
+        amounts = [cell for cell in cells if AMOUNT.fullmatch(cell)]
+        label = normalize_name(' '.join(cell for cell in cells if not AMOUNT.fullmatch(cell)))
+
+        if (
+                len(amounts) not in self.columns
+                and len(amounts) - 1 in self.columns
+                and ROW_NUMBER.fullmatch(amounts[0])
+        ):
+            amounts = amounts[1:]
+
+        if len(amounts) not in self.columns:
+            return label, None
+
+        return label, amounts[self.columns[len(amounts)]]
+
+    def extract(
+            self,
+            texts: List[str],
+            pages: List[int],
+            queries: List[Dict[str, Any]],
+    ) -> Optional[Dict[str, str]]:
+        """
+        Answers the queries of a document from the text layer of its pages.
+        Args:
+            texts (List[str]): The text layer of every page of the PDF, in layout mode.
+            pages (List[int]): The page numbers (1-based) of the document; empty for all.
+            queries (List[Dict[str, Any]]): The Textract queries of the document.
+        Returns:
+            Optional[Dict[str, str]]: A dictionary mapping query texts to their results,
+                as returned by Textract, or None if the PDF has no text layer or too few
+                queries are answered.
+        """
+        if not queries or not any(text.strip() for text in texts):
+            return None
+
+        rows = [
+            self.parse_row(line)
+            for page in (pages or range(1, len(texts) + 1))
+            for line in texts[page - 1].splitlines()
+        ]
+        rows = [(f" {label} ", amount) for label, amount in rows if amount is not None]
+
+        ocr_results = {}
+        for query in queries:
+            alias_labels = [f" {label} " for label in self.labels.get(query['Alias'], [])]
+            matches = [
+                (label, amount) for label, amount in rows
+                if any(alias_label in label for alias_label in alias_labels)
+            ]
+            if matches:
+                ocr_results[query['Text']] = min(matches, key = lambda row: len(row[0]))[1]
+
+        coverage = len(ocr_results) / len(queries)
+        if coverage < self.min_coverage:
+            logger.info(
+                "Text layer answers %.0f %% of the queries, falling back to Textract.",
+                100 * coverage,
+            )
+            return None
+
+        return ocr_results
+
+
+def build_text_layer(
+        config: Optional[Dict[str, Any]],
+) -> Optional[TextLayerExtractor]:
+    """
+    Builds the text-layer extractor from its configuration.
+    Args:
+        config (Optional[Dict[str, Any]]): The text-layer configuration with the `enabled`
+            flag, the `min_coverage`, the `columns` and the row `labels` per query alias.
+    Returns:
+        Optional[TextLayerExtractor]: The extractor, or None if it is disabled.
+    """
+    config = dict(config or {'enabled': False})
+    if not config.pop('enabled', True) or not config.get('labels'):
+        return None
+
+    return TextLayerExtractor(
+        ** config,
+    )
@@ -0,0 +1,574 @@
+# pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+"""
+A module providing process-wide tracing of the calls to S3, Textract, Tavily and Bedrock.
+Spans record the wall time, the status and numeric attributes (retries, polls, payload
+sizes, token counts, cost) of a call, inherit the correlation attributes (company,
+file ID) of their parent span and are exported offline as JSON lines and as metrics
+in the Prometheus text format.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_CURRENT_SPAN: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar(
+    'current_span',
+    default = None,
+)
+
+
+class Span:
+    """
+    A timed operation with attributes, part of the trace of its root span.
+    Attributes:
+        name (str): The name of the operation, e.g. 'bedrock.invoke'.
+        trace_id (str): The ID of the trace, shared by all spans of a root span.
+        span_id (str): The ID of the span.
+        parent_id (Optional[str]): The ID of the parent span, None for root spans.
+        correlation (Dict[str, Any]): The correlation attributes, inherited by child spans.
+        attributes (Dict[str, Any]): The attributes of the span.
+        start (float): The start time as a UNIX timestamp.
+        duration (Optional[float]): The wall time in seconds, None while running.
+        status (str): 'ok', or 'error' if the operation raised an exception.
+        error (Optional[str]): The type of the exception raised.
+    Methods:
+        set: Sets attributes of the span.
+        add: Adds amounts to numeric attributes of the span.
+        correlate: Sets correlation attributes of the span and its future children.
+        elapsed: Returns the wall time since the start of the span.
+        end: Ends the span.
+        to_dict: Returns the span as a JSON-serializable dictionary.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            parent: Optional['Span'] = None,
+            attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.correlation = dict(parent.correlation) if parent is not None else {}
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.duration = None
+        self.status = 'ok'
+        self.error = None
+
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(
+            self,
+            ** attributes: Any,
+    ):
+        """
+        Sets attributes of the span.
+        Args:
+            **attributes: The attribute values by name.
+        """
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(
+            self,
+            ** amounts: float,
+    ):
+        """
+        Adds amounts to numeric attributes of the span, e.g. retries or polls.
+        Args:
+            **amounts: The amounts by attribute name.
+        """
+        with self._lock:
+            for key, amount in amounts.items():
+                self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def correlate(
+            self,
+            ** attributes: Any,
+    ):
+        """
+        Sets correlation attributes of the span, inherited by the spans started
+        within it from now on (e.g. the company name or the file ID).
+        Args:
+            **attributes: The correlation attribute values by name.
+        """
+        with self._lock:
+            self.correlation.update(attributes)
+
+    def elapsed(
+            self,
+    ) -> float:
+        """
+        Returns the wall time since the start of the span.
+        Returns:
+            float: The wall time in seconds.
+        """
+        return time.perf_counter() - self._started
+
+    def end(
+            self,
+            error: Optional[BaseException] = None,
+    ):
+        """
+        Ends the span, recording its wall time and the exception it failed with.
+        Args:
+            error (Optional[BaseException]): The exception raised by the operation.
+        """
+        self.duration = self.elapsed()
+        if error is not None:
+            self.status = 'error'
+            self.error = type(error).__name__
+
+    def to_dict(
+            self,
+    ) -> Dict[str, Any]:
+        """
+        Returns the span as a JSON-serializable dictionary.
+        Returns:
+            Dict[str, Any]: The span.
+        """
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error,
+            ** self.correlation,
+            'attributes': self.attributes,
+        }
+
+
+class JsonLinesExporter:
+    """
+    Appends every finished span as a line of JSON to a local file.
+    Attributes:
+        path (str): The path of the file.
+    Methods:
+        export: Writes a finished span.
+        flush: Flushes the written spans to the file.
+    """
+
+    def __init__(
+            self,
+            path: str,
+    ):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(
+            self,
+            span: Span,
+    ):
+        """
+        Writes a finished span.
+        Args:
+            span (Span): The span.
+        """
+        line = json.dumps(span.to_dict(), ensure_ascii = False, default = str)
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+                self._file = open(self.path, 'a', encoding = 'utf-8')  # pylint: disable=consider-using-with
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def flush(
+            self,
+    ):
+        """
+        Flushes the written spans to the file.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+
+class PrometheusExporter:
+    """
+    Aggregates finished spans into metrics in the Prometheus text exposition format:
+    a histogram of span durations by span name and status, and counters of the numeric
+    attributes by span name. The metrics are rendered on demand and, if a path is given,
+    written to a file (e.g. for the node exporter textfile collector) at most once
+    per interval.
+    Attributes:
+        path (Optional[str]): The path of the metrics file, or None.
+        buckets (List[float]): The upper bounds of the duration histogram buckets.
+        interval (float): The minimum time in seconds between writes of the file.
+    Methods:
+        export: Aggregates a finished span.
+        render: Returns the metrics in the Prometheus text format.
+        flush: Writes the metrics file.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            buckets: Optional[List[float]] = None,
+            interval: float = 10,
+    ):
+        self.path = path
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.interval = interval
+
+        # (name, status) -> [bucket counts..., +Inf count], sum
+        self._durations: Dict[tuple, List[Any]] = {}
+        # (name, attribute) -> total
+        self._totals: Dict[tuple, float] = {}
+        self._written = 0.0
+        self._lock = threading.Lock()
+
+    def export(
+            self,
+            span: Span,
+    ):
+        """
+        Aggregates a finished span and writes the metrics file if it is due.
+        Args:
+            span (Span): The span.
+        """
+        with self._lock:
+            counts, _ = self._durations.setdefault(
+                (span.name, span.status),
+                [[0] * (len(self.buckets) + 1), 0.0],
+            )
+            counts[bisect_left(self.buckets, span.duration)] += 1
+            self._durations[(span.name, span.status)][1] += span.duration
+
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._totals[(span.name, key)] = self._totals.get((span.name, key), 0) + value
+
+            due = self.path is not None and time.monotonic() - self._written >= self.interval
+
+        if due:
+            self.flush()
+
+    def render(
+            self,
+    ) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        Returns:
+            str: The metrics.
+        """
+        lines = [
+            '# HELP span_duration_seconds The wall time of traced operations.',
+            '# TYPE span_duration_seconds histogram',
+        ]
+        with self._lock:
+            for (name, status), (counts, total) in sorted(self._durations.items()):
+                labels = f'span="{name}",status="{status}"'
+                cumulative = 0
+                for bound, count in zip([* self.buckets, '+Inf'], counts):
+                    cumulative += count
+                    lines.append(
+                        f'span_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f'span_duration_seconds_sum{{{labels}}} {total}')
+                lines.append(f'span_duration_seconds_count{{{labels}}} {cumulative}')
+
+            lines.extend([
+                '# HELP span_attribute_total The sum of numeric attributes of traced operations.',
+                '# TYPE span_attribute_total counter',
+            ])
+            for (name, key), total in sorted(self._totals.items()):
+                lines.append(f'span_attribute_total{{span="{name}",attribute="{key}"}} {total}')
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(
+            self,
+    ):
+        """
+        Writes the metrics file atomically, if a path is given.
+        """
+        if self.path is None:
+            return
+
+        text = self.render()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w', encoding = 'utf-8') as file:
+            file.write(text)
+        os.replace(temporary, self.path)
+
+        with self._lock:
+            self._written = time.monotonic()
+
+
+class Tracer:
+    """
+    The process-wide tracer. Spans are only recorded while it is enabled, so that
+    tracing costs next to nothing otherwise. The current span is held in a context
+    variable, so spans started in worker threads of `asyncio.to_thread` and in tasks
+    become children of the span that started them.
+    Attributes:
+        enabled (bool): If True, spans are recorded and exported.
+        exporters (List[Any]): The exporters of finished spans.
+        prices (Dict[str, Dict[str, float]]): The prices in USD per unit of numeric
+            attributes by span name, from which the `cost_usd` attribute is computed.
+    Methods:
+        configure: Replaces the exporters and prices with new ones from a configuration.
+        current_span: Returns the current span.
+        start_span: Starts a span without making it the current span.
+        end_span: Ends a span and exports it.
+        activate: Context manager making a span the current span.
+        span: Context manager running a block in a new current span.
+        set: Sets attributes of the current span.
+        add: Adds amounts to numeric attributes of the current span.
+        correlate: Sets correlation attributes of the current span.
+        prometheus: Returns the metrics in the Prometheus text format.
+        flush: Flushes the exporters.
+    """
+
+    def __init__(
+            self,
+    ):
+        self._lock = threading.Lock()
+        self._config = None
+        self.enabled = False
+        self.exporters: List[Any] = []
+        self.prices: Dict[str, Dict[str, float]] = {}
+
+    def configure(
+            self,
+            config: Optional[Dict[str, Any]],
+    ):
+        """
+        Replaces the exporters and prices with new ones built from a configuration.
+        Reconfiguring with an unchanged configuration keeps the current exporters
+        and their aggregated metrics.
+        Args:
+            config (Optional[Dict[str, Any]]): The tracing configuration with the `enabled`
+                flag, the `jsonl` and `prometheus` exporter settings and the `prices`.
+        """
+        self.flush()
+        with self._lock:
+            if config == self._config:
+                return
+            self._config = config
+
+            config = dict(config or {'enabled': False})
+            self.enabled = bool(config.get('enabled', True))
+            self.prices = config.get('prices') or {}
+            self.exporters = []
+            if config.get('jsonl'):
+                self.exporters.append(JsonLinesExporter(** config['jsonl']))
+            if config.get('prometheus') is not None:
+                self.exporters.append(PrometheusExporter(** (config['prometheus'] or {})))
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        """
+        Returns the current span.
+        Returns:
+            Optional[Span]: The current span, or None outside of spans or if disabled.
+        """
+        return _CURRENT_SPAN.get()
+
+    def start_span(
+            self,
+            name: str,
+            ** attributes: Any,
+    ) -> Optional[Span]:
+        """
+        Starts a child span of the current span without making it the current span,
+        e.g. for a stream consumed later. It has to be ended with `end_span`.
+        Args:
+            name (str): The name of the operation.
+            **attributes: The attributes of the span.
+        Returns:
+            Optional[Span]: The span, or None if tracing is disabled.
+        """
+        if not self.enabled:
+            return None
+
+        return Span(name, self.current_span(), attributes)
+
+    def end_span(
+            self,
+            span: Optional[Span],
+            error: Optional[BaseException] = None,
+    ):
+        """
+        Ends a span, computes its cost and exports it.
+        Args:
+            span (Optional[Span]): The span, nothing is done for None.
+            error (Optional[BaseException]): The exception raised by the operation.
+        """
+        if span is None:
+            return
+
+        span.end(error)
+        prices = self.prices.get(span.name)
+        if prices:
+            span.set(cost_usd = sum(
+                span.attributes.get(key, 0) * price
+                for key, price in prices.items()
+            ))
+
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except OSError as e:
+                logger.warning("Cannot export span %s: %s", span.name, e)
+
+    @staticmethod
+    @contextmanager
+    def activate(
+            span: Optional[Span],
+    ) -> Iterator[Optional[Span]]:
+        """
+        Context manager making a span the current span within a block, without ending it.
+        Args:
+            span (Optional[Span]): The span, nothing is done for None.
+        Yields:
+            Optional[Span]: The span.
+        """
+        if span is None:
+            yield None
+            return
+
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        finally:
+            _CURRENT_SPAN.reset(token)
+
+    @contextmanager
+    def span(
+            self,
+            name: str,
+            ** attributes: Any,
+    ) -> Iterator[Optional[Span]]:
+        """
+        Context manager running a block in a new span, the current span within it.
+        Args:
+            name (str): The name of the operation.
+            **attributes: The attributes of the span.
+        Yields:
+            Optional[Span]: The span, or None if tracing is disabled.
+        """
+        span = self.start_span(name, ** attributes)
+        with self.activate(span):
+            try:
+                yield span
+            except BaseException as e:
+                self.end_span(span, e)
+                raise
+            self.end_span(span)
+
+    def set(
+            self,
+            ** attributes: Any,
+    ):
+        """
+        Sets attributes of the current span, if any.
+        Args:
+            **attributes: The attribute values by name.
+        """
+        span = self.current_span()
+        if span is not None:
+            span.set(** attributes)
+
+    def add(
+            self,
+            ** amounts: float,
+    ):
+        """
+        Adds amounts to numeric attributes of the current span, if any.
+        Args:
+            **amounts: The amounts by attribute name.
+        """
+        span = self.current_span()
+        if span is not None:
+            span.add(** amounts)
+
+    def correlate(
+            self,
+            ** attributes: Any,
+    ):
+        """
+        Sets correlation attributes of the current span, if any, inherited by
+        the spans started within it from now on.
+        Args:
+            **attributes: The correlation attribute values by name.
+        """
+        span = self.current_span()
+        if span is not None:
+            span.correlate(** attributes)
+
+    def prometheus(
+            self,
+    ) -> str:
+        """
+        Returns the metrics aggregated by the Prometheus exporter.
+        Returns:
+            str: The metrics in the Prometheus text format, empty without the exporter.
+        """
+        return ''.join(
+            exporter.render()
+            for exporter in self.exporters
+            if isinstance(exporter, PrometheusExporter)
+        )
+
+    def flush(
+            self,
+    ):
+        """
+        Flushes the exporters, e.g. writes the metrics file.
+        """
+        for exporter in self.exporters:
+            try:
+                exporter.flush()
+            except OSError as e:
+                logger.warning("Cannot flush the trace exporter: %s", e)
+
+
+TRACER = Tracer()
+
+
+def traced(
+        name: str,
+        attributes: Optional[Callable[..., Dict[str, Any]]] = None,
+):
+    """
+    Decorator to run every call of a function in a span of the process-wide tracer.
+    Applied outside of `exponential_backoff` and `rate_limited`, the span covers
+    the retries and the time spent waiting for the rate limiter.
+    Args:
+        name (str): The name of the span.
+        attributes (Optional[Callable[..., Dict[str, Any]]]): A function returning
+            the attributes of the span from the arguments of the decorated function.
+    Returns:
+        function: Decorated function that is traced.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+
+            with TRACER.span(name, ** (attributes(*args, **kwargs) if attributes else {})):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,16 +1,65 @@
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods,too-many-statements
 """
 A module that defines a Streamlit application for OCR, web scraping, and financial analysis
 using Large Language Models (LLMs).
 """
-from concurrent.futures import ThreadPoolExecutor
+import time
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
 import streamlit as st
 
-from src.ocr import OCR
-from src.llm import (
-    LLMScraper,
-    LLMFinAnalyzer,
+from src.jobs import (
+    FINISHED,
+    JobQueue,
+    build_job_queue,
 )
+from src.pipeline import (
+    STAGES,
+    Pipeline,
+)
+from src.tracing import TRACER
+from src.utils import (
+    file_digest,
+    fingerprint,
+)
+
+
+@st.cache_resource(show_spinner = False)
+def _cached_pipeline(
+        _config: dict,
+        config_key: str,
+) -> Pipeline:
+    """
+    Builds the pipeline with its AWS clients once per configuration, shared by all
+    reruns and sessions of the app.
+    Args:
+        _config (dict): The app configuration (not hashed by Streamlit).
+        config_key (str): The fingerprint of the configuration.
+    Returns:
+        Pipeline: The pipeline.
+    """
+    del config_key
+
+    return Pipeline.from_config(_config)
+
+
+@st.cache_resource(show_spinner = False)
+def _cached_job_queue(
+        _config: dict,
+        config_key: str,
+) -> Optional[JobQueue]:
+    """
+    Opens the job queue once per configuration, shared by all reruns and sessions of the app.
+    Args:
+        _config (dict): The job configuration (not hashed by Streamlit).
+        config_key (str): The fingerprint of the job configuration.
+    Returns:
+        Optional[JobQueue]: The job queue, or None if jobs are disabled.
+    """
+    del config_key
+
+    return build_job_queue(_config)
+
 
 class App:
     """
@@ -25,6 +74,10 @@ class App:
         scraper (LLMScraper): An instance of the LLMScraper class for web scraping.
         fin_analyzer (LLMFinAnalyzer): An instance of
             the LLMFinAnalyzer class for financial analysis.
+        pipeline (Pipeline): The pipeline running OCR, web scraping
+            and financial analysis concurrently.
+        jobs (Optional[JobQueue]): The job queue the analyses are submitted to,
+            or None to run them in the Streamlit script run.
     Methods:
         __init__(config): Initializes the App with the provided configuration.
         run(): Runs the Streamlit application, setting up the UI and processing uploaded files.
@@ -39,14 +92,65 @@ class App:
 
         self.ui_config = config['ui']
 
-        self.ocr = OCR(self.config['ocr'])
-        self.scraper = LLMScraper(
-            self.config['scraper'],
-            self.config['llm']['web_scraping'],
-        )
-        self.fin_analyzer = LLMFinAnalyzer(
-            self.config['llm']['fin_analyzer'],
-        )
+        self.pipeline = _cached_pipeline(self.config, fingerprint(self.config))
+
+        self.ocr = self.pipeline.ocr
+        self.scraper = self.pipeline.scraper
+        self.fin_analyzer = self.pipeline.fin_analyzer
+
+        self.jobs = _cached_job_queue(config.get('jobs'), fingerprint(config.get('jobs')))
+
+    def _poll_jobs(
+            self,
+            groups: Dict[str, List[Any]],
+            on_done: Callable[[str, str, Any], None],
+            on_delta: Callable[[str, str, Any], None],
+    ):
+        """
+        Submits the analysis of every company to the job queue and renders the results
+        and partial results of the jobs as the workers save them, until all jobs finish.
+        Jobs of files submitted before (e.g. before a rerun) are not run again, unless
+        they were purged in the meantime.
+        Args:
+            groups (Dict[str, List[Any]]): The uploaded files by company name.
+            on_done (Callable[[str, str, Any], None]): Renders the result of a stage.
+            on_delta (Callable[[str, str, Any], None]): Renders the partial result of a stage.
+        """
+        job_ids = {
+            company_name: self.jobs.submit(company_name, company_files)
+            for company_name, company_files in groups.items()
+        }
+        shown = {}
+
+        while True:
+            jobs = {
+                company_name: self.jobs.get(job_id)
+                for company_name, job_id in job_ids.items()
+            }
+            for company_name, job in jobs.items():
+                if job is None:
+                    # A finished job purged after it was submitted is submitted again
+                    job_ids[company_name] = self.jobs.submit(company_name, groups[company_name])
+                    continue
+
+                updates = [
+                    (stage, job['results'][stage], on_done) if stage in job['results']
+                    else (stage, job['partials'][stage], on_delta)
+                    for stage in STAGES
+                    if stage in job['results'] or stage in job['partials']
+                ]
+                if job['status'] == 'failed':
+                    updates.append(('error', job['error'], on_done))
+
+                for stage, result, render in updates:
+                    if shown.get((company_name, stage)) != (render, result):
+                        shown[company_name, stage] = (render, result)
+                        render(company_name, stage, result)
+
+            if all(job is not None and job['status'] in FINISHED for job in jobs.values()):
+                return
+
+            time.sleep(self.config['jobs'].get('poll_interval', 1))
 
     def run(
             self,
@@ -56,7 +160,15 @@ class App:
         This method sets up the Streamlit UI, handles file uploads,
         performs OCR on the uploaded PDFs, scrapes data using the LLM,
         and analyzes financial documents using the LLM.
-        It displays the results of each step in the Streamlit app.
+        Uploaded files are grouped by company and all companies are processed
+        concurrently. Web scraping runs concurrently with OCR, and the results of each
+        step are displayed in the company's section of the Streamlit app as soon as
+        the step finishes; with streaming enabled, the LLM responses are rendered
+        while they are generated. With the job queue enabled, the analyses are
+        submitted to the worker processes and their results are polled instead.
+        The pipeline is built once and kept across reruns, and the results of every
+        company are kept in the session state by the content of its files, so a rerun
+        with the same files renders them without any external call.
         Returns:
             None
         """
@@ -79,35 +191,125 @@ class App:
         if not uploaded_files:
             return
 
-        st.info(f"📂 {len(uploaded_files)} file(s) selected. Processing…")
+        groups = self.pipeline.group_files(uploaded_files)
+
+        # Results of the companies analyzed in this session, by company and file content
+        memo = st.session_state.setdefault('results', {})
+        keys = {
+            company_name: fingerprint(
+                company_name,
+                sorted((file.name, file_digest(file)) for file in company_files),
+            )
+            for company_name, company_files in groups.items()
+        }
+        pending = {
+            company_name: company_files
+            for company_name, company_files in groups.items()
+            if keys[company_name] not in memo
+        }
+
+        if pending:
+            st.info(
+                f"📂 {len(uploaded_files)} file(s) of {len(groups)} company(ies) selected. "
+                "Processing…"
+            )
 
-        with st.spinner('Performing OCR on uploaded files...'):
-            with ThreadPoolExecutor() as executor:
-                ocr_results = list(
-                    executor.map(
-                        self.ocr.extract,
-                        uploaded_files,
-                    )
+        placeholders = {}
+        for company_name, company_files in groups.items():
+            with st.container(border = True):
+                st.subheader(company_name)
+                placeholders[company_name] = {
+                    name: st.empty()
+                    for name in ('ocr_results', 'scrape_results', 'fin_results')
+                }
+                placeholders[company_name]['ocr_results'].info(
+                    f"📄 Performing OCR on {len(company_files)} file(s)..."
+                )
+                placeholders[company_name]['scrape_results'].info(
+                    f"🔍 Scraping data for company: {company_name}..."
                 )
 
-        st.success(f"✅ OCR completed for {len(ocr_results)} file(s).")
+        def render(
+                company_name: str,
+                name: str,
+                result: Any,
+        ):
+            company_placeholders = placeholders[company_name]
 
-        company_name = list({res["company_name"] for res in ocr_results})[0]
+            if name == 'error':
+                company_placeholders['fin_results'].error(
+                    f"❌ Analysis of {company_name} failed: {result}"
+                )
+
+            elif name == 'ocr_results':
+                company_placeholders['ocr_results'].success(
+                    f"✅ OCR completed for {len(result)} document(s)."
+                )
 
+            elif name == 'scrape_results':
+                with company_placeholders['scrape_results'].container():
+                    st.success("✅ Web scraping completed.")
+                    st.header("LLM Scrape Results:")
+                    st.write(result)
 
-        with st.spinner(f"🔍 Scraping data for company: {company_name}..."):
-            scrape_response = self.scraper.analyze(company_name)
-            st.success("✅ Web scraping completed.")
-        st.header("LLM Scrape Results:")
-        st.write(scrape_response)
+            elif name == 'fin_results':
+                with company_placeholders['fin_results'].container():
+                    st.success("✅ Financial analysis completed.")
+                    st.header("Financial Analysis Results:")
+                    for k, v in result.items():
+                        st.write(f"**{k}**: {v}")
 
+        def on_delta(
+                company_name: str,
+                name: str,
+                partial: Any,
+        ):
+            company_placeholders = placeholders[company_name]
 
-        with st.spinner("💡 LLM analyzing financial documents..."):
-            fin_results = self.fin_analyzer.analyze(
-                ocr_results,
-                scrape_response,
+            if name == 'scrape_results':
+                with company_placeholders['scrape_results'].container():
+                    st.header("LLM Scrape Results:")
+                    st.write(partial)
+
+            elif name == 'fin_results':
+                with company_placeholders['fin_results'].container():
+                    st.header("Financial Analysis Results:")
+                    for k, v in partial.items():
+                        st.write(f"**{k}**: {v}")
+
+        for company_name in groups:
+            if company_name not in pending:
+                for name in STAGES:
+                    render(company_name, name, memo[keys[company_name]][name])
+
+        if not pending:
+            return
+
+        finished = {}
+
+        def on_done(
+                company_name: str,
+                name: str,
+                result: Any,
+        ):
+            render(company_name, name, result)
+
+            if name in STAGES:
+                finished.setdefault(company_name, {})[name] = result
+                if len(finished[company_name]) == len(STAGES):
+                    memo[keys[company_name]] = finished.pop(company_name)
+
+        if self.jobs is not None:
+            with st.spinner('Waiting for the workers to finish the analyses...'):
+                self._poll_jobs(pending, on_done, on_delta)
+            return
+
+        with st.spinner('Performing OCR, web scraping and financial analysis...'):
+            asyncio.run(
+                self.pipeline.run(
+                    [file for company_files in pending.values() for file in company_files],
+                    on_done = on_done,
+                    on_delta = on_delta if self.ui_config.get('streaming', True) else None,
+                )
             )
-            st.success("✅ Financial analysis completed.")
-        st.header("Financial Analysis Results:")
-        for k, v in fin_results.items():
-            st.write(f"**{k}**: {v}")
+        TRACER.flush()
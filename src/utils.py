@@ -1,15 +1,23 @@
 """
-Utility functions for YAML loading, exponential backoff, and job completion waiting.
+Utility functions for YAML loading, exponential backoff, job completion waiting,
+content hashing and name normalization.
 """
+import re
+import json
 import time
 import random
+import hashlib
 import logging
+import unicodedata
 from pathlib import Path
 from functools import wraps
 from typing import Dict, Any
 import yaml
 from botocore.exceptions import ClientError
 
+from src.ratelimit import THROTTLING_ERROR_CODES
+from src.tracing import TRACER
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -20,7 +28,9 @@ def exponential_backoff(
 ):
     """
     Decorator to apply exponential backoff with jitter for retrying operations
-    that may raise a ThrottlingException when invoking AWS services.
+    that may raise a throttling error (e.g. ThrottlingException) when invoking AWS services.
+    The clients of the rate-limited services do not retry throttling errors themselves,
+    so that every throttled attempt is reported to the process-wide rate limiter.
     Args:
         max_retries (int): Maximum number of retry attempts.
         base_delay (int): Base delay in seconds for the first retry.
@@ -38,7 +48,7 @@ def exponential_backoff(
                     return func(*args, **kwargs)
                 except ClientError as e:
                     error_code = e.response['Error']['Code']
-                    if error_code != 'ThrottlingException':
+                    if error_code not in THROTTLING_ERROR_CODES:
                         raise  # Don't retry on other errors
 
                     if attempt >= max_retries:
@@ -50,10 +60,11 @@ def exponential_backoff(
                     total_delay = delay + jitter
 
                     logger.warning(
-                        "ThrottlingException on attempt %d. Retrying in %.2f seconds...",
-                        attempt + 1, total_delay
+                        "%s on attempt %d. Retrying in %.2f seconds...",
+                        error_code, attempt + 1, total_delay
                     )
 
+                    TRACER.add(retries = 1, backoff_seconds = total_delay)
                     time.sleep(total_delay)
                     attempt += 1
         return wrapper
@@ -92,6 +103,64 @@ def wait_for_completion(
     return decorator
 
 
+def file_digest(
+        file: Any,
+) -> str:
+    """
+    Computes the SHA-256 digest of a file object's content without moving its position.
+    Args:
+        file: A binary, seekable file object (e.g. a Streamlit UploadedFile).
+    Returns:
+        str: The hexadecimal SHA-256 digest of the file content.
+    """
+    position = file.tell()
+    file.seek(0)
+    digest = hashlib.file_digest(file, 'sha256').hexdigest()
+    file.seek(position)
+
+    return digest
+
+
+def fingerprint(
+        *parts: Any,
+) -> str:
+    """
+    Computes a stable SHA-256 fingerprint of JSON-serializable values.
+    Args:
+        *parts: The values to fingerprint.
+    Returns:
+        str: The hexadecimal SHA-256 digest of the canonical JSON encoding of the values.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            parts,
+            sort_keys = True,
+            ensure_ascii = False,
+            default = str,
+        )
+        .encode('utf-8')
+    ).hexdigest()
+
+
+def normalize_name(
+        name: str,
+) -> str:
+    """
+    Normalizes a name or a text for comparison by removing diacritics, punctuation,
+    letter case and redundant whitespace, e.g. company names in cache keys
+    or statement headers and row labels in PDF text.
+    Args:
+        name (str): The name or text.
+    Returns:
+        str: The normalized name or text.
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r'[^\w\s]', ' ', name.lower())
+
+    return ' '.join(name.split())
+
+
 def _load_config(yaml_path: str) -> dict:
     """
     Load a YAML configuration file.
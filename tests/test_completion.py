@@ -0,0 +1,191 @@
+"""
+Tests of the strategies waiting on asynchronous Textract jobs.
+"""
+import json
+import unittest
+from unittest import mock
+
+from src.completion import AdaptivePoller, FakeQueue, NotificationListener
+
+
+class FakeClock:
+    """
+    A stand-in for the time module recording sleeps and advancing by them.
+    """
+
+    def __init__(
+            self,
+    ):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(
+            self,
+    ) -> float:
+        """
+        Returns the current fake time.
+        """
+        return self.now
+
+    def sleep(
+            self,
+            seconds: float,
+    ):
+        """
+        Records a sleep and advances the fake time by it.
+        """
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _statuses(
+        *statuses: str,
+):
+    responses = iter(statuses)
+
+    return lambda: {'JobStatus': next(responses)}
+
+
+class TestAdaptivePoller(unittest.TestCase):
+    """
+    Tests of polling with a delayed first poll and exponential backoff.
+    """
+
+    def setUp(
+            self,
+    ):
+        self.clock = FakeClock()
+        patcher = mock.patch('src.completion.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_poll_is_immediate_without_history(self):
+        """
+        Without previous jobs, the first poll is not delayed.
+        """
+        poller = AdaptivePoller()
+
+        result = poller.wait('job', _statuses('SUCCEEDED'))
+
+        self.assertEqual(result, {'JobStatus': 'SUCCEEDED'})
+        self.assertEqual(self.clock.sleeps, [0])
+        self.assertEqual(poller.poll_count, 1)
+
+    def test_first_poll_undershoots_median_duration(self):
+        """
+        The first poll is delayed by 0.8 times the median duration of previous jobs.
+        """
+        poller = AdaptivePoller()
+        poller.durations.extend([10, 30, 20])
+
+        poller.wait('job', _statuses('SUCCEEDED'))
+
+        self.assertEqual(self.clock.sleeps, [16])
+        self.assertEqual(poller.durations[-1], 16)
+
+    def test_interval_grows_by_backoff_up_to_max_interval(self):
+        """
+        The interval between polls grows by 1.5 from 0.5 seconds up to 5 seconds.
+        """
+        poller = AdaptivePoller()
+
+        poller.wait('job', _statuses(* ['IN_PROGRESS'] * 8, 'PARTIAL_SUCCESS'))
+
+        self.assertEqual(
+            self.clock.sleeps,
+            [0, 0.5, 0.75, 1.125, 1.6875, 2.53125, 3.796875, 5, 5],
+        )
+        self.assertEqual(poller.poll_count, 9)
+
+    def test_times_out(self):
+        """
+        A job not finishing within the maximum wait time raises TimeoutError.
+        """
+        poller = AdaptivePoller(max_wait_seconds = 2)
+
+        with self.assertRaises(TimeoutError):
+            poller.wait('job', lambda: {'JobStatus': 'IN_PROGRESS'})
+        self.assertFalse(poller.durations)
+
+
+class TestNotificationListener(unittest.TestCase):
+    """
+    Tests of waiting for jobs by their completion notifications on a FakeQueue.
+    """
+
+    def setUp(
+            self,
+    ):
+        self.queue = FakeQueue()
+
+    def _listener(
+            self,
+            max_wait_seconds: float = 5,
+    ) -> NotificationListener:
+        return NotificationListener(
+            sqs_client = self.queue,
+            queue_url = 'queue',
+            sns_topic_arn = 'topic',
+            role_arn = 'role',
+            max_wait_seconds = max_wait_seconds,
+            receive_wait_seconds = 1,
+            release_seconds = 0,
+        )
+
+    def test_wakes_up_on_own_notification(self):
+        """
+        The notification of a waited job wakes up its waiter and is deleted.
+        """
+        listener = self._listener()
+        self.queue.publish('job')
+
+        result = listener.wait('job', lambda: {'JobStatus': 'SUCCEEDED'})
+
+        self.assertEqual(result, {'JobStatus': 'SUCCEEDED'})
+        self.assertEqual(self.queue._messages.qsize(), 0)  # pylint: disable=protected-access
+        self.assertFalse(self.queue._received)  # pylint: disable=protected-access
+        self.assertFalse(listener._events)  # pylint: disable=protected-access
+
+    def test_releases_notification_of_other_process(self):
+        """
+        A notification of a job waited for by another listener on the same queue
+        is returned to the queue instead of being deleted.
+        """
+        first, second = self._listener(), self._listener()
+        self.queue.publish('second-job')
+        self.queue.publish('first-job')
+
+        self.assertEqual(
+            first.wait('first-job', lambda: 'first'),
+            'first',
+        )
+        self.assertEqual(
+            second.wait('second-job', lambda: 'second'),
+            'second',
+        )
+
+    def test_skips_messages_that_are_no_notifications(self):
+        """
+        Malformed messages are deleted without stopping the listener.
+        """
+        listener = self._listener()
+        self.queue.send_message(MessageBody = 'not json')
+        self.queue.send_message(MessageBody = json.dumps({'Type': 'SubscriptionConfirmation'}))
+        self.queue.publish('job')
+
+        self.assertEqual(listener.wait('job', lambda: 'done'), 'done')
+        self.assertFalse(self.queue._received)  # pylint: disable=protected-access
+
+    def test_times_out(self):
+        """
+        A job without notification raises TimeoutError and is unregistered.
+        """
+        listener = self._listener(max_wait_seconds = 0.2)
+
+        with self.assertRaises(TimeoutError):
+            listener.wait('job', lambda: 'done')
+        self.assertFalse(listener._events)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Runs worker processes executing the analyses submitted to the job queue by the UI
+(see config/jobs.yaml); running jobs are finished before the workers exit.
+"""
+import signal
+import asyncio
+import argparse
+import logging
+import multiprocessing
+from dotenv import load_dotenv
+from src.jobs import (
+    Worker,
+    build_job_queue,
+)
+from src.pipeline import Pipeline
+from src.tracing import TRACER
+from src.utils import _load_configs
+
+
+def serve(
+        app_config: dict,
+):
+    """
+    Runs a worker of the job queue until it receives SIGINT or SIGTERM.
+    Args:
+        app_config (dict): The app configuration.
+    """
+    worker = Worker(
+        Pipeline.from_config(app_config),
+        build_job_queue({** app_config['jobs'], 'enabled': True}),
+        app_config['jobs'],
+    )
+
+    async def _run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await worker.run(stop)
+
+    asyncio.run(_run())
+    TRACER.flush()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description = "Run the analyses submitted to the job queue by the UI.",
+    )
+    parser.add_argument(
+        "--processes",
+        type = int,
+        default = None,
+        help = "Number of worker processes (default: `processes` in config/jobs.yaml).",
+    )
+    args = parser.parse_args()
+
+    load_dotenv(override = True)
+    logging.basicConfig(level = logging.INFO)
+
+    config = _load_configs('config')
+
+    processes = [
+        multiprocessing.Process(target = serve, args = (config,))
+        for _ in range(args.processes or config['jobs'].get('processes', 1))
+    ]
+    for process in processes:
+        process.start()
+
+    def _stop(*_):
+        for worker_process in processes:
+            worker_process.terminate()
+
+    # Running jobs are finished before the workers exit
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    for process in processes:
+        process.join()